@@ -0,0 +1,72 @@
+"""
+Benchmark of the Drive service construction: time and allocations of build() with the full discovery document
+against the bundled per-resource documents, for the service and for the resource calls of a handler run.
+
+Run from the root of the repository:
+    python -m benchmarks.drive_discovery_bench --repeat 50 --calls 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import httplib2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from functions import drive_discovery
+from functions.drive_discovery import LazyDriveService
+
+
+def full_document(first, calls):
+    # What build() does with the static document: read and parse it, then build the service.
+    service = build_from_document(json.loads(discovery_cache.get_static_doc('drive', 'v3')), http=httplib2.Http())
+
+    # A handler run calls changes() once and files() for each transfer.
+    service.changes()
+    for _ in range(calls):
+        service.files()
+
+
+def bundled(first, calls):
+    if first:
+        drive_discovery.load_resource_document.cache_clear()
+
+    service = LazyDriveService(http=httplib2.Http())
+
+    service.changes()
+    for _ in range(calls):
+        service.files()
+
+
+def measure(function, repeat, calls):
+    start = time.perf_counter()
+    function(True, calls)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(False, calls)
+    warm = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    function(False, calls)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return cold, warm, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--calls', type=int, default=10, help='Number of files() calls per service, like the transfers of a handler run.')
+    args = parser.parse_args()
+
+    for name, function in (('full document', full_document), ('bundled', bundled)):
+        cold, warm, peak = measure(function, args.repeat, args.calls)
+        print(f"{name}: first build {cold * 1000:.1f} ms, next builds {warm * 1000:.2f} ms, peak allocations {peak / 1024:.0f} KiB")
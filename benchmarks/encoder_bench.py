@@ -0,0 +1,78 @@
+"""
+Benchmark of the output encoder: encoding time and size of a watermarked photo for each output format.
+
+Run from the root of the repository:
+    python -m benchmarks.encoder_bench --size 4000x3000 --repeat 3
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions.encoder import EncoderSettings, encode
+
+CASES = [
+    ('png (previous output)', EncoderSettings(format='png')),
+    ('png compress_level=1', EncoderSettings(format='png', compress_level=1)),
+    ('jpeg q85', EncoderSettings(format='jpeg', quality=85)),
+    ('jpeg q85 effort=0', EncoderSettings(format='jpeg', quality=85, effort=0)),
+    ('webp q80', EncoderSettings(format='webp', quality=80)),
+    ('webp q80 effort=0', EncoderSettings(format='webp', quality=80, effort=0)),
+    ('avif q60', EncoderSettings(format='avif', quality=60)),
+    ('heif q70', EncoderSettings(format='heif', quality=70)),
+]
+
+
+def make_photo(size) -> Image.Image:
+    """Photo-like RGBA image: smooth gradients with some blurred noise, as after the watermark compositing."""
+
+    width, height = size
+    rng = np.random.default_rng(0)
+
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = np.stack([200 * x * np.ones_like(y), 150 * y + 50 * x * y, 100 + 80 * np.sin(6 * x) * np.cos(4 * y)], axis=-1)
+
+    noise = Image.fromarray(rng.integers(0, 60, (height, width, 3), dtype=np.uint8)).filter(ImageFilter.GaussianBlur(2))
+    data = np.clip(base + np.asarray(noise, dtype=np.float32), 0, 255).astype(np.uint8)
+
+    return Image.fromarray(data).convert('RGBA')
+
+
+def measure(image, encoder, repeat) -> tuple:
+    times = []
+
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        encode(image, output, encoder, source_format='JPEG')
+        times.append(time.perf_counter() - start)
+
+    return min(times), output.tell()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='4000x3000', help='Width x height of the synthetic photo.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = tuple(int(param) for param in args.size.split('x'))
+    image = make_photo(size)
+
+    print(f"Photo of {size[0]}x{size[1]} pixels, best of {args.repeat}")
+
+    reference = None
+
+    for name, encoder in CASES:
+        seconds, nbytes = measure(image, encoder, args.repeat)
+        reference = reference or (seconds, nbytes)
+
+        print(f"{name:24} {seconds * 1000:8.0f} ms {nbytes / 1024:9.0f} KiB   "
+              f"time x{reference[0] / seconds:5.1f}   bytes x{reference[1] / nbytes:5.1f} smaller")
@@ -0,0 +1,297 @@
+"""
+Benchmark suite of the watermark and transfer pipeline, on synthetic JPEG, PNG and HEIC photos.
+
+Two kinds of scenarios, each run in its own process so that its peak RSS is measured alone:
+    steps/<format>/<size>     time of each Watermark step, image by image
+    handler/<format>/<size>   full gdrive_file_handler runs against a fake Drive (HttpMock) and an in-memory Firestore
+
+The results are printed, and written as JSON with --output for regression comparison with --baseline.
+
+Run from the root of the repository:
+    python -m benchmarks.pipeline_bench --formats jpeg,png,heic --sizes 1280x960,4000x3000 --images 8 --output bench.json
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+from pillow_heif import register_heif_opener
+from benchmarks.encoder_bench import make_photo
+
+MIME_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'heic': 'image/heic'}
+
+RESOURCE_ID = 'benchmark-resource'
+
+
+def make_input(image_format, size) -> bytes:
+    """Synthetic photo encoded as a camera or a phone would."""
+
+    photo = make_photo(size).convert('RGB')
+    output = io.BytesIO()
+
+    if image_format == 'jpeg':
+        photo.save(output, 'JPEG', quality=90)
+    elif image_format == 'png':
+        photo.save(output, 'PNG')
+    else:
+        register_heif_opener()
+        photo.save(output, 'HEIF', quality=80)
+
+    return output.getvalue()
+
+
+def make_logo(path):
+    logo = Image.new('RGBA', (800, 400), (0, 0, 0, 0))
+    logo.paste((0, 0, 0, 255), (100, 100, 700, 300))
+    logo.save(path)
+
+
+def percentiles(values) -> dict:
+    """p50 and p95 in milliseconds."""
+
+    values = sorted(values)
+
+    if not values:
+        return {'p50_ms': None, 'p95_ms': None}
+
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+
+    return {'p50_ms': round(statistics.median(values) * 1000, 2), 'p95_ms': round(p95 * 1000, 2)}
+
+
+def peak_rss() -> dict:
+    """Peak RSS of this process and of its largest child (the watermark processes), in MB."""
+
+    return {
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def prepare_workdir(folder, output_format):
+    """Working directory of the functions package: settings, logo and download folder."""
+
+    os.makedirs(os.path.join(folder, 'files', 'settings'))
+    os.makedirs(os.path.join(folder, 'files', 'logo'))
+    os.makedirs(os.path.join(folder, 'files', 'downloaded_files'))
+
+    with open(os.path.join(folder, 'files', 'settings', 'settings.json'), 'w') as f:
+        json.dump({'colors': '(255, 255, 255)', 'opacity': 50, 'output': {'format': output_format}}, f)
+
+    make_logo(os.path.join(folder, 'files', 'logo', 'logo.png'))
+
+    os.chdir(folder)
+    os.environ.update({
+        'LOGO_PATH': os.path.join(folder, 'files', 'logo', 'logo.png'),
+        'FILE_ID': 'watched-folder',
+        'RESULT_FILE_ID': 'result-folder',
+        'SETTING_FILE_ID': 'settings-folder',
+    })
+
+
+def run_steps(content, images, output_format) -> dict:
+    """
+    Time each step of the Watermark class on images copies of the same photo.
+    The total of an image is logo_prep (cache miss), decode, paste and save.
+    """
+
+    from functions.encoder import EncoderSettings
+    from functions.large_image import open_image
+    from functions.logo_cache import logo_cache
+    from functions.watermark import Watermark
+
+    steps = {name: [] for name in ('logo_open', 'img_color', 'img_resize', 'img_opacity', 'logo_prep', 'decode', 'paste', 'save', 'total')}
+
+    for _ in range(images):
+        wtmrk = Watermark('photo.jpg', os.environ['LOGO_PATH'], (255, 255, 255), 50, EncoderSettings(format=output_format))
+
+        # The logo transformations, as done by logo_prep() on a cache miss.
+        start = time.perf_counter()
+        logo = Image.open(wtmrk.path_logo).convert("RGBA")
+        steps['logo_open'].append(time.perf_counter() - start)
+
+        for name in ('img_color', 'img_resize', 'img_opacity'):
+            start = time.perf_counter()
+            logo = getattr(wtmrk, name)(logo)
+            steps[name].append(time.perf_counter() - start)
+
+        # logo_prep() itself, after the invalidation of the cache of the prepared logos.
+        logo_cache.invalidate()
+        begin = start = time.perf_counter()
+        wtmrk.logo_prep()
+        steps['logo_prep'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        buffer = io.BytesIO(content)
+        source = open_image(buffer)
+        image = wtmrk.img_fit(source, buffer)
+        image.load()
+        steps['decode'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        image = wtmrk.add_logo(image)
+        steps['paste'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        wtmrk.img_encode(image, source, io.BytesIO())
+        steps['save'].append(time.perf_counter() - start)
+
+        steps['total'].append(time.perf_counter() - begin)
+
+    total = sum(steps['total'])
+
+    return {
+        'images': images,
+        'images_per_sec': round(images / total, 3),
+        **percentiles(steps['total']),
+        'steps': {name: percentiles(values) for name, values in steps.items() if name != 'total'},
+    }
+
+
+def run_handler(content, images, image_format, runs) -> dict:
+    """Full gdrive_file_handler runs, each on images new files, against the fake Drive and Firestore."""
+
+    from local_harness import fake_firestore
+    db = fake_firestore.install()
+
+    from local_harness.fake_drive import FakeDrive, FakeDriveHttp
+    from functions import gdrive_file_handler as handler
+    from functions.drive_discovery import LazyDriveService
+    from functions.watermark_engine import get_watermark_engine
+    from functions.webhook import drive_service_factory
+
+    drive = FakeDrive()
+    credentials = object()
+
+    # The services of the factory (per thread and pooled) talk to the fake Drive, without authorization.
+    drive_service_factory.get_credentials = lambda: credentials
+    drive_service_factory.build = lambda creds: LazyDriveService(FakeDriveHttp(drive))
+
+    db.collection('webhook_tokens').document(RESOURCE_ID).set({'token': '0'})
+    save_path = os.path.join(os.getcwd(), 'files', 'downloaded_files') + '/'
+
+    def add_images(prefix):
+        for i in range(images):
+            drive.add_file(f"{prefix}_{i}.{image_format}", content, ['watched-folder'], MIME_TYPES[image_format])
+
+    # Warm-up run: process pool started, logo prepared, Drive clients built.
+    add_images('warmup')
+    handler.gdrive_file_handler(RESOURCE_ID, 'change', save_path, 'warmup')
+
+    walls = []
+
+    for run in range(runs):
+        add_images(f"run{run}")
+
+        start = time.perf_counter()
+        handler.gdrive_file_handler(RESOURCE_ID, 'change', save_path, f"run{run}")
+        walls.append(time.perf_counter() - start)
+
+    latencies = [event['upload'] - event['download'] for name, event in drive.events.items()
+                 if not name.startswith('warmup') and 'upload' in event and 'download' in event]
+
+    expected = images * (runs + 1)
+    if len(drive.uploads) != expected:
+        raise RuntimeError(f"{len(drive.uploads)} files uploaded instead of {expected}.")
+
+    get_watermark_engine().shutdown()
+
+    return {
+        'images': images * runs,
+        'runs': runs,
+        'images_per_sec': round(images * runs / sum(walls), 3),
+        'run_p50_s': round(statistics.median(walls), 3),
+        **percentiles(latencies),
+        'bytes_uploaded': sum(int(drive.files[file_id]['size']) for file_id in drive.uploads),
+    }
+
+
+def run_scenario(scenario, images, runs, output_format) -> dict:
+    kind, image_format, size = scenario.split('/')
+    width, height = (int(param) for param in size.split('x'))
+
+    content = make_input(image_format, (width, height))
+
+    with tempfile.TemporaryDirectory() as folder:
+        prepare_workdir(folder, output_format)
+
+        if kind == 'steps':
+            result = run_steps(content, images, output_format)
+        else:
+            result = run_handler(content, images, image_format, runs)
+
+        os.chdir(ROOT)
+
+    return {'scenario': scenario, 'input_bytes': len(content), **result, **peak_rss()}
+
+
+def compare(results, baseline_path):
+    """Print the change of images/s and p95 of each scenario against a previous JSON output."""
+
+    with open(baseline_path) as f:
+        baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+    for result in results:
+        previous = baseline.get(result['scenario'])
+
+        if not previous:
+            continue
+
+        speedup = result['images_per_sec'] / previous['images_per_sec']
+        print(f"{result['scenario']:28} images/s x{speedup:5.2f}   p95 {previous['p95_ms']} -> {result['p95_ms']} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--formats', default='jpeg,png,heic')
+    parser.add_argument('--sizes', default='1280x960,4000x3000', help='Width x height of the synthetic photos, comma separated.')
+    parser.add_argument('--kinds', default='steps,handler')
+    parser.add_argument('--images', type=int, default=8, help='Images per step scenario, and per handler run.')
+    parser.add_argument('--runs', type=int, default=3, help='Measured handler runs per scenario, after a warm-up run.')
+    parser.add_argument('--output-format', default='original', help="'output' format of settings.json.")
+    parser.add_argument('--output', help='Path of the JSON results.')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with.')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        # Child process: one scenario, JSON result on the last line of stdout.
+        print(json.dumps(run_scenario(args.scenario, args.images, args.runs, args.output_format)))
+        sys.exit(0)
+
+    scenarios = [f"{kind}/{image_format}/{size}" for kind in args.kinds.split(',')
+                 for image_format in args.formats.split(',') for size in args.sizes.split(',')]
+    results = []
+
+    for scenario in scenarios:
+        command = [sys.executable, '-m', 'benchmarks.pipeline_bench', '--scenario', scenario, '--images', str(args.images),
+                   '--runs', str(args.runs), '--output-format', args.output_format]
+        process = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+
+        if process.returncode != 0:
+            print(f"{scenario}: failed\n{process.stderr[-2000:]}")
+            continue
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        results.append(result)
+
+        print(f"{scenario:28} {result['images_per_sec']:8.2f} images/s   p50 {result['p50_ms']} ms   p95 {result['p95_ms']} ms   "
+              f"peak RSS {result['peak_rss_mb']} MB (workers {result['peak_child_rss_mb']} MB)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        compare(results, args.baseline)
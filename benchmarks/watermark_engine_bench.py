@@ -0,0 +1,74 @@
+"""
+Benchmark of the watermark engine: images watermarked per second with 1, 2, 4 and 8 processes.
+
+Run from the root of the repository:
+    python -m benchmarks.watermark_engine_bench --images 30 --size 4000x3000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions.watermark_engine import WatermarkEngine
+
+
+def make_images(folder, nb_images, size):
+    """Create a logo and nb_images noisy JPEG photos in folder."""
+
+    logo = Image.new('RGBA', (800, 400), (0, 0, 0, 0))
+    logo.paste((0, 0, 0, 255), (100, 100, 700, 300))
+    path_logo = os.path.join(folder, 'logo.png')
+    logo.save(path_logo)
+
+    rng = np.random.default_rng(0)
+    photo = Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8))
+    paths = []
+
+    for i in range(nb_images):
+        path = os.path.join(folder, f'photo_{i}.jpg')
+        photo.save(path, 'JPEG', quality=90)
+        paths.append(path)
+
+    return path_logo, paths
+
+
+def run(path_logo, paths, workers):
+    engine = WatermarkEngine(path_logo, max_workers=workers)
+
+    # Warm up the processes so the start-up cost is not measured.
+    engine.watermark(paths[:workers])
+
+    start = time.perf_counter()
+    results = engine.watermark(paths)
+    elapsed = time.perf_counter() - start
+
+    engine.shutdown()
+
+    if None in results:
+        raise RuntimeError('Some images failed during the benchmark.')
+
+    return len(paths) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=30)
+    parser.add_argument('--size', default='4000x3000', help='Width x height of the synthetic photos.')
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    size = tuple(int(param) for param in args.size.split('x'))
+
+    with tempfile.TemporaryDirectory() as folder:
+        path_logo, paths = make_images(folder, args.images, size)
+
+        print(f"{args.images} images of {size[0]}x{size[1]} pixels, {os.cpu_count()} CPUs available")
+
+        for workers in (int(param) for param in args.workers.split(',')):
+            print(f"{workers} process(es): {run(path_logo, paths, workers):.2f} images/s")
@@ -0,0 +1,243 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functions.tracing import NOOP_SPAN
+from functions.webhook import checkout_drive_service
+from functions.gdrive_token import save_startpagetoken
+
+# Maximum page size accepted by changes().list().
+MAX_PAGE_SIZE = 1000
+
+CHANGE_FIELDS = "nextPageToken,newStartPageToken,changes(fileId,file(name,parents,mimeType,trashed,shared,size,md5Checksum,modifiedTime))"
+
+
+class ChangePage():
+    def __init__(self, index, token, results):
+        """Page of changes().list(), with the token to save once every change of the page has been handled."""
+
+        self.index = index
+        self.token = token
+        self.changes = results.get('changes', [])
+        self.next_page_token = results.get('nextPageToken')
+        self.new_start_page_token = results.get('newStartPageToken')
+
+        self.pending = 0
+        self.sealed = False
+        self.committed = False
+        self.retry = False  # A job of the page failed: the page is read again by the next run.
+
+        # File IDs of the jobs of the page uploaded and failed, not written to the ledger yet.
+        self.done = []
+        self.failed = []
+
+
+    @property
+    def token_after(self) -> str:
+        """Token to resume from once this page is handled."""
+
+        return self.next_page_token or self.new_start_page_token
+
+
+class ChangeFeed():
+    def __init__(self, resource_id, start_token, drive_id=None, page_size=MAX_PAGE_SIZE, trace=NOOP_SPAN, ledger=None):
+        """
+        Reader of the Google Drive change feed of a resource, following nextPageToken until the end of the feed.
+
+        The pages are yielded by pages() while the next one is already requested in a background thread.
+        The token of a page is saved to Firestore only once the page is sealed and every job taken from it is done,
+        and in page order, so a crash never skips changes that were not handled. A page with a failed job is never
+        committed, nor the pages after it: the next run reads the feed again from that page and retries the file,
+        the files already handled being skipped by the idempotency ledger.
+        The states of the jobs of a page (uploaded or failed) are written to the ledger in one batch once every job
+        of the page is done, before the token after the page is saved.
+
+        Parameters
+        ----------
+        resource_id : String
+            ID of the watched resource, used to save the token.
+        start_token : String
+            Page token to start from.
+        drive_id : String, optional
+            ID of the Shared Drive, if the resource is one.
+        page_size : Integer, optional
+            Number of changes per page. The default is the maximum, 1000.
+        trace : Span, optional
+            Span of the job, parent of the spans of the changes().list() requests and token saves.
+        ledger : IdempotencyLedger, optional
+            Ledger of the claims of the files, whose finish() is given the states of the jobs of each page.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.resource_id = resource_id
+        self.start_token = start_token
+        self.drive_id = drive_id
+        self.page_size = page_size
+        self.trace = trace
+        self.ledger = ledger
+
+        self.pages_read = 0
+        self.changes_read = 0
+
+        self._pages = []
+        self._lock = threading.Lock()
+
+        # Held from the choice of the token to its save: two jobs ending together never save their tokens out of order.
+        self._save_lock = threading.Lock()
+
+
+    def _fetch(self, token) -> dict:
+        # Runs in the prefetch thread, created for each run: the Drive client is borrowed from the pool.
+        with self.trace.span('changes_list') as span, checkout_drive_service() as drive_service:
+            results = drive_service.changes().list(
+                pageToken=token,
+                pageSize=self.page_size,
+                supportsAllDrives=True,
+                includeRemoved=True,
+                driveId=self.drive_id,
+                fields=CHANGE_FIELDS
+            ).execute()
+
+            span.set(changes=len(results.get('changes', [])))
+
+        return results
+
+
+    def pages(self):
+        """Generator of the pages of changes, the next page being requested while the current one is handled."""
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='change-feed') as prefetch:
+            token = self.start_token
+            future = prefetch.submit(self._fetch, token)
+            index = 0
+
+            while future is not None:
+                page = ChangePage(index, token, future.result())
+
+                self.pages_read += 1
+                self.changes_read += len(page.changes)
+
+                with self._lock:
+                    self._pages.append(page)
+
+                if page.next_page_token:
+                    token = page.next_page_token
+                    future = prefetch.submit(self._fetch, token)
+                else:
+                    future = None
+
+                logging.info(f"Page {index} of changes for resource {self.resource_id}: {len(page.changes)} changes.")
+
+                yield page
+
+                self.seal(page)
+                index += 1
+
+
+    def add_job(self, page):
+        """Record a job taken from a page: its token waits for job_done()."""
+
+        with self._lock:
+            page.pending += 1
+
+
+    def job_done(self, page, ok=True, file_id=None):
+        """
+        Record the end of a job taken from a page, and the state of its file for the ledger.
+        A failed job (ok False) keeps the token before the page.
+        """
+
+        with self._lock:
+            page.pending -= 1
+
+            if file_id is not None:
+                (page.done if ok else page.failed).append(file_id)
+
+            if not ok and not page.retry:
+                page.retry = True
+                logging.warning(f"Job of page {page.index} of changes for resource {self.resource_id} failed: "
+                                f"the startPageToken stays at {page.token} at most, to read the page again in the next run.")
+
+        self._commit()
+
+
+    def retry(self, page):
+        """Keep the token before a page: a file of it is claimed by another run, it is read again by the next run."""
+
+        with self._lock:
+            page.retry = True
+
+        self._commit()
+
+
+    def seal(self, page):
+        """No more jobs will be taken from this page."""
+
+        with self._lock:
+            page.sealed = True
+
+        self._commit()
+
+
+    def _take_states(self, pages) -> tuple:
+        """Take the file IDs uploaded and failed of pages, not written to the ledger yet. Called with the lock held."""
+
+        done = []
+        failed = []
+
+        for page in pages:
+            done += page.done
+            failed += page.failed
+            page.done = []
+            page.failed = []
+
+        return done, failed
+
+
+    def _finish(self, done, failed):
+        if self.ledger is not None and (done or failed):
+            with self.trace.span('firestore_ledger', files=len(done) + len(failed)):
+                self.ledger.finish(done, failed)
+
+
+    def _commit(self):
+        """
+        Write the states of the jobs of the pages whose jobs are all done to the ledger, then save the token
+        after the last page handled, every previous page being handled too.
+        """
+
+        with self._save_lock:
+            token = None
+
+            with self._lock:
+                done, failed = self._take_states(page for page in self._pages if page.sealed and not page.pending)
+
+                for page in self._pages:
+                    if page.committed:
+                        continue
+
+                    if not page.sealed or page.pending or page.retry:
+                        break
+
+                    page.committed = True
+                    token = page.token_after
+
+            self._finish(done, failed)
+
+            if token:
+                with self.trace.span('firestore_save_token'):
+                    save_startpagetoken(self.resource_id, token)
+                logging.info(f"startPageToken updated to : {token} for resource {self.resource_id}")
+
+
+    def flush(self):
+        """Write the states of the jobs done to the ledger, for the pages left unfinished by a run that stopped early."""
+
+        with self._save_lock:
+            with self._lock:
+                done, failed = self._take_states(self._pages)
+
+            self._finish(done, failed)
@@ -0,0 +1,173 @@
+"""
+Bundled Google Drive v3 discovery document, split per resource, for network-free and fast service construction.
+
+Each bundled document only holds one resource, without the descriptions and with flat schemas, so that building
+a resource does not process the whole Drive API nor generate the documentation of its methods.
+
+The documents in files/discovery/ are generated from the discovery document shipped with googleapiclient
+(or downloaded when it is missing) by running, from the root of the repository:
+    python -m functions.drive_discovery
+"""
+
+import functools
+import json
+import logging
+import os
+from urllib.parse import urlsplit
+from googleapiclient.discovery import build_from_document
+
+DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files', 'discovery')
+
+# Resources of the Drive API used by the project.
+RESOURCES = ('files', 'changes', 'channels')
+
+
+def _schema_refs(node, refs):
+    """Collect the names of the schemas referenced ($ref) anywhere in a discovery document node."""
+
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == '$ref':
+                refs.add(value)
+            else:
+                _schema_refs(value, refs)
+    elif isinstance(node, list):
+        for value in node:
+            _schema_refs(value, refs)
+
+
+def _strip_descriptions(node):
+    """Copy of a discovery document node without the texts only used to generate the docstrings."""
+
+    if isinstance(node, dict):
+        return {key: _strip_descriptions(value) for key, value in node.items() if key not in ('description', 'enumDescriptions')}
+    if isinstance(node, list):
+        return [_strip_descriptions(value) for value in node]
+    return node
+
+
+def _schema_stub(schema) -> dict:
+    """
+    Flat version of a schema: only the names of its properties are kept.
+    googleapiclient needs them to add the list_next() methods, while the full nested schemas are only used to
+    generate the docstrings of the methods, which is most of the time spent building a resource.
+    """
+
+    properties = {name: {'type': 'string'} for name in schema.get('properties', {})}
+    return {'id': schema.get('id'), 'type': schema.get('type', 'object'), 'properties': properties}
+
+
+def split_document(document) -> dict:
+    """Split a full discovery document into one minimal document per resource, with stubs of the schemas it uses."""
+
+    base = {key: value for key, value in document.items() if key not in ('resources', 'schemas', 'icons', 'description')}
+    base['parameters'] = _strip_descriptions(base.get('parameters', {}))
+    documents = {}
+
+    for name in RESOURCES:
+        resource = _strip_descriptions(document['resources'][name])
+
+        refs = set()
+        _schema_refs(resource, refs)
+
+        documents[name] = dict(base, resources={name: resource}, schemas={ref: _schema_stub(document['schemas'][ref]) for ref in sorted(refs)})
+
+    return documents
+
+
+@functools.lru_cache(maxsize=None)
+def load_resource_document(name) -> dict:
+    """Load (once per process) the bundled discovery document of a resource."""
+
+    with open(os.path.join(DISCOVERY_DIR, f'drive.v3.{name}.json')) as f:
+        return json.load(f)
+
+
+def bundle_available() -> bool:
+    return all(os.path.exists(os.path.join(DISCOVERY_DIR, f'drive.v3.{name}.json')) for name in RESOURCES)
+
+
+def with_endpoint(document, api_endpoint) -> dict:
+    """
+    Point a discovery document to api_endpoint. build_from_document() moves only the host of the media upload URLs
+    to the api_endpoint of client_options, not the scheme, so rootUrl is replaced as well.
+    """
+
+    parts = urlsplit(api_endpoint)
+
+    return dict(document, rootUrl=f"{parts.scheme}://{parts.netloc}/")
+
+
+class LazyDriveService():
+    def __init__(self, http, client_options=None):
+        """
+        Drive service built lazily, resource by resource, from the bundled discovery documents.
+
+        service.files(), service.changes() and service.channels() behave like on a service made by build(),
+        but each resource is built on first use only, and then reused instead of being rebuilt on every call.
+        All the resources share the same authorised HTTP transport: like a built service, this object must not be
+        shared between threads.
+
+        Parameters
+        ----------
+        http : httplib2.Http
+            Authorised HTTP transport.
+        client_options : Dict, optional
+            Options given to build_from_document (e.g. api_endpoint).
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self._http = http
+        self._client_options = client_options
+        self._resources = {}
+
+
+    def _resource(self, name):
+        resource = self._resources.get(name)
+
+        if resource is None:
+            document = load_resource_document(name)
+
+            if self._client_options and self._client_options.get('api_endpoint'):
+                document = with_endpoint(document, self._client_options['api_endpoint'])
+
+            service = build_from_document(document, http=self._http, client_options=self._client_options)
+            resource = getattr(service, name)()
+            self._resources[name] = resource
+
+        return resource
+
+
+    def __getattr__(self, name):
+        if name not in RESOURCES:
+            raise AttributeError(f"Resource '{name}' is not bundled, add it to RESOURCES in functions/drive_discovery.py.")
+
+        return lambda: self._resource(name)
+
+
+if __name__ == '__main__':
+    from googleapiclient import discovery_cache
+
+    logging.basicConfig(level=logging.INFO)
+
+    document = discovery_cache.get_static_doc('drive', 'v3')
+
+    if document is None:
+        import urllib.request
+
+        with urllib.request.urlopen('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest') as response:
+            document = response.read().decode('utf-8')
+
+    os.makedirs(DISCOVERY_DIR, exist_ok=True)
+
+    for name, resource_document in split_document(json.loads(document)).items():
+        path = os.path.join(DISCOVERY_DIR, f'drive.v3.{name}.json')
+
+        with open(path, 'w') as f:
+            json.dump(resource_document, f, separators=(',', ':'), sort_keys=True)
+
+        logging.info(f"Discovery document of the resource {name} written to {path} ({os.path.getsize(path)} bytes).")
@@ -0,0 +1,157 @@
+import logging
+from dataclasses import dataclass
+from pillow_heif import register_heif_opener
+
+
+@dataclass(frozen=True)
+class OutputFormat():
+    """Format of a watermarked file: PIL format name, MIME type sent to Google Drive and file extension."""
+
+    pil_format: str
+    mime_type: str
+    extension: str
+
+
+OUTPUT_FORMATS = {
+    'jpeg': OutputFormat('JPEG', 'image/jpeg', 'jpg'),
+    'png': OutputFormat('PNG', 'image/png', 'png'),
+    'webp': OutputFormat('WEBP', 'image/webp', 'webp'),
+    'heif': OutputFormat('HEIF', 'image/heic', 'heic'),
+    'avif': OutputFormat('AVIF', 'image/avif', 'avif'),
+}
+
+# Output format used by 'original' for each format PIL can decode. Other formats (TIFF, GIF, BMP...) give PNG.
+SOURCE_FORMATS = {'JPEG': 'jpeg', 'MPO': 'jpeg', 'PNG': 'png', 'WEBP': 'webp', 'HEIF': 'heif', 'AVIF': 'avif'}
+
+# Image modes each format can save, the others are converted to the first one.
+SAVE_MODES = {
+    'JPEG': ('RGB', 'L', 'CMYK'),
+    'PNG': ('RGB', 'RGBA', 'L', 'LA', 'P', 'I', 'I;16', '1'),
+    'WEBP': ('RGB', 'RGBA'),
+    'HEIF': ('RGB', 'RGBA'),
+    'AVIF': ('RGB', 'RGBA'),
+}
+
+
+@dataclass(frozen=True)
+class EncoderSettings():
+    """
+    Settings of the output encoder, from the 'output' entry of settings.json.
+
+    format is 'original' (same format as the image received), 'jpeg', 'png', 'webp', 'heif' or 'avif'.
+    quality (1 to 100) is used by the lossy formats, effort (0 to 6) trades encoding time for size in JPEG, WebP and AVIF,
+    compress_level (0 to 9) is the zlib level of PNG. keep_metadata copies the EXIF and ICC profile of the original.
+    max_dimension limits the width and height of the output in pixels, 0 for no limit.
+    """
+
+    format: str = 'original'
+    quality: int = 85
+    effort: int = 4
+    compress_level: int = 6
+    keep_metadata: bool = True
+    max_dimension: int = 0
+
+
+def parse_encoder_settings(settings) -> EncoderSettings:
+    """Parse and validate the 'output' entry of settings.json."""
+
+    settings = settings or {}
+    encoder = EncoderSettings(
+        format=str(settings.get('format', EncoderSettings.format)).lower(),
+        quality=int(settings.get('quality', EncoderSettings.quality)),
+        effort=int(settings.get('effort', EncoderSettings.effort)),
+        compress_level=int(settings.get('compress_level', EncoderSettings.compress_level)),
+        keep_metadata=bool(settings.get('keep_metadata', EncoderSettings.keep_metadata)),
+        max_dimension=int(settings.get('max_dimension', EncoderSettings.max_dimension)),
+    )
+
+    if encoder.format != 'original' and encoder.format not in OUTPUT_FORMATS:
+        raise ValueError(f"output format must be 'original' or one of {list(OUTPUT_FORMATS)}, got {encoder.format}")
+    if not 1 <= encoder.quality <= 100:
+        raise ValueError(f"output quality must be from 1 to 100, got {encoder.quality}")
+    if not 0 <= encoder.effort <= 6:
+        raise ValueError(f"output effort must be from 0 to 6, got {encoder.effort}")
+    if not 0 <= encoder.compress_level <= 9:
+        raise ValueError(f"output compress_level must be from 0 to 9, got {encoder.compress_level}")
+    if encoder.max_dimension < 0:
+        raise ValueError(f"output max_dimension must be 0 or more, got {encoder.max_dimension}")
+
+    return encoder
+
+
+def output_format(encoder, source_format=None) -> OutputFormat:
+    """Return the format of the output for an image read in source_format (PIL format name)."""
+
+    if encoder.format == 'original':
+        return OUTPUT_FORMATS[SOURCE_FORMATS.get(source_format, 'png')]
+
+    return OUTPUT_FORMATS[encoder.format]
+
+
+def save_options(encoder, pil_format) -> dict:
+    """Options of Image.save() for a format."""
+
+    if pil_format == 'JPEG':
+        # optimize (Huffman tables) and progressive cost a bit of CPU for a smaller file.
+        return {'quality': encoder.quality, 'optimize': encoder.effort >= 2, 'progressive': encoder.effort >= 4}
+    if pil_format == 'PNG':
+        return {'compress_level': encoder.compress_level}
+    if pil_format == 'WEBP':
+        return {'quality': encoder.quality, 'method': encoder.effort}
+    if pil_format == 'AVIF':
+        # speed goes from 0 (slowest) to 10.
+        return {'quality': encoder.quality, 'speed': 10 - encoder.effort}
+    if pil_format == 'HEIF':
+        return {'quality': encoder.quality}
+
+    return {}
+
+
+def encode(image, fp, encoder=None, source_format=None, exif=None, icc_profile=None) -> OutputFormat:
+    """
+    Encode an image to fp (path or file object) following the encoder settings.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Image to encode.
+    fp : String or file object
+        Destination of the encoded image.
+    encoder : EncoderSettings, optional
+        Settings of the encoder. The default is EncoderSettings().
+    source_format : String, optional
+        PIL format of the original image, used by the 'original' format.
+    exif : bytes, optional
+        EXIF of the original image, copied if keep_metadata is set.
+    icc_profile : bytes, optional
+        ICC profile of the original image, copied if keep_metadata is set.
+
+    Returns
+    -------
+    output : OutputFormat
+        Format of the encoded image.
+
+    """
+
+    encoder = encoder or EncoderSettings()
+    output = output_format(encoder, source_format)
+
+    if output.pil_format == 'HEIF':
+        register_heif_opener()
+
+    if image.mode not in SAVE_MODES[output.pil_format]:
+        mode = 'RGBA' if 'A' in image.mode and 'RGBA' in SAVE_MODES[output.pil_format] else SAVE_MODES[output.pil_format][0]
+        logging.info(f'Converting the image from {image.mode} to {mode} for {output.pil_format}.')
+        image = image.convert(mode)
+
+    options = save_options(encoder, output.pil_format)
+
+    if encoder.keep_metadata:
+        if exif:
+            options['exif'] = exif
+        if icc_profile:
+            options['icc_profile'] = icc_profile
+
+    image.save(fp, output.pil_format, **options)
+
+    return output
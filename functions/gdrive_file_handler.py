@@ -1,13 +1,23 @@
+import hashlib
 import logging
-import io
-import json
 import os
+import tempfile
 import time
-from ast import literal_eval
+from functools import partial
+from itertools import chain
 import firebase_admin
 from firebase_admin import firestore
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from functions.watermark import Watermark
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, MediaFileUpload
+from functions.change_feed import ChangeFeed
+from functions.history import history
+from functions.idempotency import ledger
+from functions.metrics import firestore_seconds, images
+from functions.pipeline import Pipeline, Stage
+from functions.settings import settings_store
+from functions.settings_assets import SettingsAssetResolver
+from functions.tracing import start_trace
+from functions.transfer import TransferStage
+from functions.watermark_engine import get_watermark_engine
 from functions.webhook import get_drive_service
 from functions.gdrive_token import load_startpagetoken, save_startpagetoken
 
@@ -19,57 +29,108 @@ except ValueError:
 db = firestore.client()
 
 
-def download_file(drive_service, file_id, destination_path=None, expected_file_size=None) -> bytes:
+# Size of the chunks requested to Google Drive: the memory used by a download is bounded by it, whatever the file size.
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+
+
+# 'memory' passes the images between the download, watermark and upload stages in memory, 'disk' through FILE_SAVE_PATH.
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'memory')
+
+# In memory mode, images larger than this are still spilled to FILE_SAVE_PATH.
+PIPELINE_SPILL_SIZE = int(os.getenv('PIPELINE_SPILL_SIZE', 32 * 1024 * 1024))
+
+# Maximum number of writes of a Firestore batch.
+FIRESTORE_BATCH_SIZE = 500
+
+
+class HashingWriter():
+    """File object wrapper that counts the bytes and updates the MD5 of the content while it is written."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.fd.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+        return len(data)
+
+
+def download_file(drive_service, file_id, destination_path=None, expected_file_size=None, expected_md5=None, spool_size=None) -> dict:
     """
-    Download the content of a file from Google Drive.
+    Download the content of a file from Google Drive, streamed chunk by chunk to destination_path.
+    Without destination_path, the content goes to a spooled temporary file, kept in memory up to spool_size bytes.
+    Return the metadata of the download ('path' or 'file', 'size', 'md5'), or None if the download failed.
     """
+    part_path = None
+    file = None
+
     try:
         request = drive_service.files().get_media(fileId=file_id)
         logging.info(request)
-        file = io.BytesIO()
-        downloader = MediaIoBaseDownload(file, request)
+
+        if destination_path:
+            if not os.path.exists(os.path.dirname(destination_path)):
+                logging.info(f"Creating the directory for {destination_path}.")
+                os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+
+            # Hidden partial file, renamed once complete, so that nobody reads a file still being downloaded.
+            folder, name = os.path.split(destination_path)
+            part_path = os.path.join(folder, f".{name}.part")
+            file = open(part_path, 'wb')
+        else:
+            file = tempfile.SpooledTemporaryFile(max_size=spool_size or DOWNLOAD_CHUNK_SIZE)
+
+        writer = HashingWriter(file)
+        downloader = MediaIoBaseDownload(writer, request, chunksize=DOWNLOAD_CHUNK_SIZE)
         done = False
-        bytes_downloaded_total = 0 
-        logging.info(f"File object created for {file_id}. Initial size: {file.tell()} bytes.")
-        
+
         while not done:
             status, done = downloader.next_chunk()
             if status:
-                logging.info(f"Downloaded progress for {file_id}: {int(status.progress() * 100)}% - Bytes received: {file.tell()} / {status.total_size}")
-                bytes_downloaded_total = file.tell() 
+                logging.info(f"Downloaded progress for {file_id}: {int(status.progress() * 100)}% - Bytes received: {writer.size} / {status.total_size}")
             else:
                 logging.warning(f"Status is None during download loop for {file_id}. Done: {done}")
 
-        logging.info(f"Download completed for {file_id}. Total bytes written to buffer: {bytes_downloaded_total}")
+        metadata = {'file_id': file_id, 'size': writer.size, 'md5': writer.md5.hexdigest()}
 
-        file.seek(0)
-        file_content = file.read()
+        logging.info(f"Download completed for {file_id}. Total bytes received: {writer.size}")
 
-        if destination_path:
-            if not os.path.exists(os.path.dirname(destination_path)):
-                logging.info(f"Creating the directory for {destination_path}.")
-                os.makedirs(os.path.dirname(destination_path))
-                
-            with open(destination_path, 'wb') as f:
-                f.write(file_content)
-            logging.info(f"File {file_id} downloaded and saved at: {destination_path}")
+        if expected_file_size and writer.size != int(expected_file_size):
+            logging.error(f"CAREFUL: The downloaded file size ({writer.size} bytes) does NOT match the expected size ({expected_file_size} bytes) for {file_id}!")
 
+        if expected_md5 and metadata['md5'] != expected_md5:
+            file.close()
+            raise ValueError(f"MD5 checksum {metadata['md5']} does not match the expected checksum {expected_md5}")
 
-        logging.info(f"File {file_id} downloaded. Final size: {len(file_content)} bytes.")
+        if destination_path:
+            file.close()
+            os.replace(part_path, destination_path)
+            metadata['path'] = destination_path
+            logging.info(f"File {file_id} downloaded and saved at: {destination_path}")
+        else:
+            file.seek(0)
+            metadata['file'] = file
 
-        if expected_file_size and len(file_content) != expected_file_size:
-            logging.error(f"CAREFUL: The downloaded file size ({len(file_content)} bytes) does NOT match the expected size ({expected_file_size} bytes) for {file_id}!")
+        return metadata
 
-        return file_content
-        
     except Exception as e:
         logging.error(f"Error when downloading file {file_id} from Google Drive: {e}", exc_info=True)
+
+        if file:
+            file.close()
+
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
+
         return None
-    
 
-def upload_file(drive_service, new_file_name, local_file_path, new_mime_type, parent_folder_id=None) -> dict:
+
+def upload_file(drive_service, new_file_name, local_file_path, new_mime_type, parent_folder_id=None, buffer=None) -> dict:
     """
-    Upload a file to Google Drive.
+    Upload a file to Google Drive, from local_file_path or from an in-memory buffer (file object).
     """
 
     try:
@@ -78,7 +139,10 @@ def upload_file(drive_service, new_file_name, local_file_path, new_mime_type, pa
             'parents': [parent_folder_id],
         }
 
-        media_body = MediaFileUpload(local_file_path, new_mime_type, resumable=True)
+        if buffer is not None:
+            media_body = MediaIoBaseUpload(buffer, new_mime_type, resumable=True)
+        else:
+            media_body = MediaFileUpload(local_file_path, new_mime_type, resumable=True)
 
         new_file = drive_service.files().create(
             body=file_metadata,
@@ -96,22 +160,150 @@ def upload_file(drive_service, new_file_name, local_file_path, new_mime_type, pa
         return None
     
 
+settings_assets = SettingsAssetResolver(download_file)
+
+
+def ensure_settings_assets(drive_service):
+    """Download settings.json and logo.png from the settings folder on Google Drive if they are missing locally."""
+
+    if settings_assets.resolve(drive_service):
+        settings_store.invalidate()
+
+
+def download_stage(transfers, job) -> dict:
+    """Pipeline stage: download an image, in memory or to its path in FILE_SAVE_PATH."""
+
+    with job['trace'].span('download', in_memory=job['path'] is None):
+        if job['path'] is None:
+            download = transfers.run('download', job['name'], download_file, job['file_id'], expected_file_size=job['size'], expected_md5=job['md5'], spool_size=PIPELINE_SPILL_SIZE)
+        else:
+            download = transfers.run('download', job['name'], download_file, job['file_id'], destination_path=job['path'], expected_file_size=job['size'], expected_md5=job['md5'])
+
+    if not download:
+        logging.error(f"Downloading of the file {job['file_id']} failed.")
+        return None
+
+    logging.info(f"File {job['file_id']} downloaded. Size: {download['size']} bytes.")
+
+    job['download'] = download
+    return job
+
+
+def watermark_stage(job) -> dict:
+    """Pipeline stage: apply the watermark to a downloaded image, in the watermark engine processes."""
+
+    settings = settings_store.get()
+    engine = get_watermark_engine()
+
+    # Note: Make sure the image is in a compatible format (e.g. HEIC, PNG, etc.) for the PIL package.
+    with job['trace'].span('watermark') as span:
+        if 'file' in job['download']:
+            # Read from the spooled file into the shared memory of the engine, the result comes back in shared memory too.
+            with job['download'].pop('file') as file:
+                job['output'], job['output_format'], steps = engine.submit(file, settings.colors, settings.opacity, name=job['name'], encoder=settings.output, size=job['download']['size']).result()
+        else:
+            try:
+                job['output_path'], job['output_format'], steps = engine.submit(job['path'], settings.colors, settings.opacity, encoder=settings.output).result()
+            finally:
+                os.remove(job['path'])  # Delete the file in the folder
+                logging.info(f"Original file {job['name']} deleted after watermarking.")
+
+        # Steps timed in the watermark process: decode, logo, composite, encode.
+        span.attach(steps)
+
+    # Written with the trace of the file to log_time, to tell which settings.json an output was made with.
+    job['trace'].set(settings_version=settings.version)
+    logging.info(f"Watermark applied ot the file {job['name']} (settings {settings.version}).")
+    return job
+
+
+def upload_stage(transfers, job) -> dict:
+    """Pipeline stage: upload a watermarked image to the result folder, from memory or from disk."""
+
+    output_format = job['output_format']
+    new_file_name = f"{job['name'].split('.')[0]}_mrkd.{output_format.extension}"
+    logging.info(f"Upload of {new_file_name} in folder id {os.getenv('RESULT_FILE_ID')}.")
+
+    with job['trace'].span('upload', in_memory='output' in job):
+        if 'output' in job:
+            # Uploaded straight from the shared memory block of the result, released after the upload.
+            with job.pop('output') as output:
+                reply = transfers.run(
+                    'upload', new_file_name, upload_file,
+                    new_file_name=new_file_name,
+                    local_file_path=None,
+                    new_mime_type=output_format.mime_type,
+                    parent_folder_id=os.getenv('RESULT_FILE_ID'),
+                    buffer=output
+                    )
+        else:
+            reply = transfers.run(
+                'upload', new_file_name, upload_file,
+                new_file_name=new_file_name,
+                local_file_path=job['output_path'],
+                new_mime_type=output_format.mime_type,
+                parent_folder_id=os.getenv('RESULT_FILE_ID')
+                )
+
+            os.remove(job['output_path'])  # Delete the file in the folder
+            logging.info(f"Watermarked file {new_file_name} deleted after upload.")
+
+    if not reply:
+        return None
+
+    job['uploaded'] = True
+    return job
+
+
+def job_done(feed, job):
+    """
+    Called when an image leaves the pipeline: the feed writes the state of its claim (done, or failed to release it)
+    with those of its page, and saves the page token only if every image of the page was uploaded.
+    """
+
+    images.inc(result='uploaded' if job.get('uploaded') else 'failed')
+
+    job['trace'].set(uploaded=bool(job.get('uploaded')))
+    job['trace'].end()
+
+    feed.job_done(job['page'], ok=bool(job.get('uploaded')), file_id=job['file_id'])
+
+
+def save_file_traces(log_reference, trace):
+    """Write the trace of each file of a job to the 'files' subcollection of its log_time document."""
+
+    files = [child for child in trace.children if getattr(child, 'name', None) == 'file']
+
+    for i in range(0, len(files), FIRESTORE_BATCH_SIZE):
+        batch = db.batch()
+
+        for file in files[i:i + FIRESTORE_BATCH_SIZE]:
+            batch.set(log_reference.collection('files').document(file.attributes['file_id']), file.record())
+
+        batch.commit()
+
+
 def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_number):
     """
     Handle the asynchronous processing of Google Drive changes, and apply watermarks to images if criterias are met.
     """
 
     start = time.time()
+
+    # Nested spans of the run: Drive and Firestore calls, and each file through the pipeline stages.
+    trace = start_trace('job', resource_id=resource_id, message_number=message_number)
     
     logging.info(f"Beginning asynchronous processing for resource: {resource_id}, state: {resource_state}")
 
     drive_service = get_drive_service()
 
-    last_token = load_startpagetoken(resource_id)
+    with trace.span('firestore_load_token'):
+        last_token = load_startpagetoken(resource_id)
 
     if not last_token:
         logging.warning(f"No previous startPageToken found for resource {resource_id}. Attempting to retrieve the current token.")
-        start_page_token_response = drive_service.changes().getStartPageToken(supportsAllDrives=True).execute()
+        with trace.span('changes_get_start_page_token'):
+            start_page_token_response = drive_service.changes().getStartPageToken(supportsAllDrives=True).execute()
         last_token = start_page_token_response.get('startPageToken')
         save_startpagetoken(resource_id, last_token) # Sauvegarde ce token initial pour les futures exécutions.
         logging.info(f"Initial startPageToken retrieved and saved for {resource_id}: {last_token}")
@@ -122,43 +314,39 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
     # Shared Drive IDs are typically 33 characters long.
     is_shared_drive_resource = len(resource_id) == 33 
 
-    # Call the `changes().list()` method to get the actual list of changes.
-    results = drive_service.changes().list(
-        pageToken=last_token,
-        supportsAllDrives=True,
-        includeRemoved=True,
-        driveId=resource_id if is_shared_drive_resource else None, 
-        fields="nextPageToken,newStartPageToken,changes(fileId,file(name,parents,mimeType,trashed,shared,size))"
-    ).execute()
-
-    changes = results.get('changes', [])
-    new_start_page_token = results.get('newStartPageToken')
+    # Read the change feed page by page, following nextPageToken: the next page is requested while the current one is handled.
+    feed = ChangeFeed(resource_id, last_token, drive_id=resource_id if is_shared_drive_resource else None, trace=trace, ledger=ledger)
+    pages = feed.pages()
+    first_page = next(pages)
 
-    if last_token == new_start_page_token:
+    if not first_page.changes and first_page.new_start_page_token == last_token:
         logging.info(f"No new changes detected for resource {resource_id} since the last token {last_token}.")
+        pages.close()
         return
 
-    if new_start_page_token:
-        save_startpagetoken(resource_id, new_start_page_token)
-        logging.info(f"startPageToken updated to : {new_start_page_token} for resource {resource_id}")
+    transfers = TransferStage()
 
-    try:
+    # Each image flows through download -> watermark -> upload as soon as it is ready,
+    # with bounded queues between the stages.
+    # The token of a page of changes is saved once every image of the page went through the pipeline.
+    pipeline = Pipeline([
+        Stage('download', partial(download_stage, transfers), workers=transfers.max_workers),
+        Stage('watermark', watermark_stage, workers=get_watermark_engine().max_workers),
+        Stage('upload', partial(upload_stage, transfers), workers=transfers.max_workers),
+    ], on_done=partial(job_done, feed))
 
-        if changes:
+    assets_checked = False
 
-            file_ids = db.collection("file_treated").document("file_ids").get().to_dict()
+    try:
 
-            if file_ids is None or file_ids == {}:
-                logging.error(f"Error loading credentials from Firestore - {file_ids}")
-                file_ids = []
-            else:
-                file_ids = file_ids.get('file_ids')
-                
-            logging.info(f"Number of changes detected : {len(changes)}")
+        pipeline.start()
 
-            nb_file_downloaded = 0
+        for page in chain([first_page], pages):
+            logging.info(f"Number of changes detected : {len(page.changes)}")
 
-            for change in changes:
+            page_jobs = []
+
+            for change in page.changes:
                 file_id = change.get('fileId')
                 file_info = change.get('file')
 
@@ -168,7 +356,10 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
                     print(f"File {file_id} does not have a 'trashed' attribute. File info: {file_info}.")
                     continue
                 
-                if (file_info.get('trashed')) or (not 'image/' in file_info.get('mimeType')):
+                # The settings files are routed before the image filter: settings.json is not an image.
+                is_settings_file = os.getenv('SETTING_FILE_ID') in file_info.get('parents', [])
+
+                if (file_info.get('trashed')) or (not 'image/' in file_info.get('mimeType') and not is_settings_file):
                     logging.info(f"Changed ignored for the file ID: {file_id} (deleted or non-image).")
                     continue
 
@@ -181,28 +372,24 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
                         logging.info(f"File {file_info.get('name')} in a watched folder.")
                         is_param = False
 
-                        if file_id in file_ids:
+                        # Files already claimed by this process are rejected without any Firestore call.
+                        if ledger.is_known(file_id):
                             logging.info(f"Changes already handled for file ID: {file_id}. Ignored.")
                             continue
-                        else:
-                            file_ids.append(file_id)
-                            logging.info(f"Handling changes for file ID: {file_id}")
-
-                            # Use a list of the previously processed file IDs to avoid reprocessing, especially in case of multiple changes.
-                            file_ids = file_ids[-50:]  # Limite the size of the file_ids list to the last 50 processed files.
-
-                            db.collection("file_treated").document("file_ids").set({'file_ids': file_ids})
 
                     elif os.getenv('SETTING_FILE_ID') in parents:
                         logging.info(f"File {file_info.get('name')} is a settings file.")
                         is_param = True
 
-                        if file_info.get('name').endswith('.json'):
-                            folder = '/files/settings/'
-                        else:
-                            folder = '/files/logo/'
+                        # Downloaded to the local copy read by the settings store or the watermark engine, only if its checksum
+                        # differs from that copy: an edited settings.json or logo.png is picked up, other files are ignored.
+                        with trace.span('settings_asset', file=file_info.get('name')):
+                            fetched = settings_assets.fetch(drive_service, dict(file_info, id=file_id))
 
-                        download_file(drive_service, file_id, destination_path=os.getcwd() + folder + file_info.get('name'), expected_file_size=file_size)
+                        # The prepared logos are cached in the watermark processes, not here: a new logo is picked up there
+                        # because the cache key is the hash of the logo file, computed again when its mtime or size changes.
+                        if fetched:
+                            settings_store.invalidate()
                         continue
                     else:
                         logging.info(f"File {file_info.get('name')} not in a watched folder. Ignored.")
@@ -210,101 +397,62 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
 
                     logging.info(f"Changes in file/folder ID: {file_id}, Name: {file_info.get('name')}, Parents: {parents}, State: {'Deleted' if file_info.get('trashed') else 'Active'}, Size: {file_size} bytes")
 
-                    path_file = FILE_SAVE_PATH + file_info.get('name')
-
-                    # Check if settings and logo files exist, if not, download them from Google Drive.
-                    path_params = [os.getcwd() + '/files/settings/settings.json',
-                                    os.getcwd() + '/files/logo/logo.png']
-
-                    for param in path_params:
-                        if not os.path.exists(param):
-                            logging.error(f"File {param} not found. Starting the download of the file {param}.")
-
-                            if param.endswith('settings.json'):
-                                mime_type = 'application/json'
-                                name = 'settings.json'
-                            else:
-                                mime_type = 'image/png'
-                                name = 'logo.png'
-                                        
-                            param_file = drive_service.files().list(
-                                q=f"mimeType='{mime_type}'",
-                                spaces="drive",
-                                fields="nextPageToken, files(id, name, size)",
-                                pageToken=None,
-                            ).execute()
-
-                            for file in param_file.get('files', []):
-                                if file.get('name') == name:
-                                    param_file_id = file.get('id')
-                                    param_file_size = file.get('size')
-                                    download_file(drive_service, param_file_id, destination_path=param, expected_file_size=param_file_size)
-                                    break
-
-                    download = download_file(drive_service, file_id, destination_path=path_file, expected_file_size=file_size)
-
-                    if download:
-                        logging.info(f"File {file_id} downloaded in memory. Size: {len(download)} bytes.")
-
-                        nb_file_downloaded += 1
-                    else:
-                        logging.error(f"Downloading of the file {file_id} failed.")
-
-                else:
-                    logging.info(f"Changes in the folder/file ID: {file_id} (deleted or not found).")
-
-            nb_file_to_mrkd = 0
+                    # Prefixed by the file ID: the downloads of a run, and of the runs of other resources, share FILE_SAVE_PATH,
+                    # and two images of the same name (IMG_0001.jpg from two phones) must not share their files.
+                    path_file = FILE_SAVE_PATH + f"{file_id}_{file_info.get('name').replace('/', '_')}"
 
-            for file in os.listdir(FILE_SAVE_PATH):
-                if file.startswith('.') or file.endswith('_mrkd.png'):
-                    continue
-
-                logging.info(f"Adding the watermark on the file {file}...")
-
-                with open(os.getcwd() + '/files/settings/settings.json', 'r') as f:
-                    settings = json.load(f)
-
-                path_file = FILE_SAVE_PATH + file
-
-                wtmrk = Watermark(
-                    path=path_file,
-                    path_logo=os.getenv('LOGO_PATH'),
-                    colors=literal_eval(settings['colors']), 
-                    opacity=settings['opacity'] 
-                    )
+                    # Check once per run that the settings and logo files exist, if not, download them from Google Drive.
+                    if not assets_checked:
+                        with trace.span('settings_assets'):
+                            ensure_settings_assets(drive_service)
+                        assets_checked = True
 
-                # Apply the watermark to the image.
-                # Note: Make sure the image is in a compatible format (e.g. HEIC, PNG, etc.) for the PIL package.
-                new_file_path = wtmrk.img_watermark()
+                    # Images up to PIPELINE_SPILL_SIZE stay in memory (path None), bigger ones go through FILE_SAVE_PATH.
+                    in_memory = PIPELINE_MODE == 'memory' and file_size <= PIPELINE_SPILL_SIZE
 
-                logging.info(f"Watermark applied ot the file {file_info.get('name')}.")
+                    page_jobs.append({
+                        'file_id': file_id,
+                        'name': file_info.get('name'),
+                        'size': file_size,
+                        'md5': file_info.get('md5Checksum'),
+                        'path': None if in_memory else path_file,
+                        'page': page,
+                    })
 
-                os.remove(path_file)  # Delete the file in the folder
-                logging.info(f"Original file {file} deleted after watermarking.")
+                else:
+                    logging.info(f"Changes in the folder/file ID: {file_id} (deleted or not found).")
 
-                nb_file_to_mrkd += 1
+            # One claim per file in the ledger, written in a single batch for the page.
+            with trace.span('firestore_claim', files=len(page_jobs)):
+                claimed, held = ledger.claim(page_jobs)
 
-            nb_file_uploaded = 0
+            if held:
+                # Files of another run, still in its lease: the page is read again by a later run, which takes
+                # over their claims if that run never finished them (crash, or stopped before its drain ended).
+                logging.warning(f"Files {', '.join(sorted(held))} claimed by another run: changes of page {page.index} will be read again.")
+                feed.retry(page)
 
-            for file_mrkd in os.listdir(FILE_SAVE_PATH):
-                if file_mrkd.startswith('.') or not file_mrkd.endswith('_mrkd.png'):
+            for job in page_jobs:
+                if job['file_id'] not in claimed:
+                    logging.info(f"Changes already handled for file ID: {job['file_id']}. Ignored.")
                     continue
 
-                path_file = FILE_SAVE_PATH + file_mrkd
+                logging.info(f"Handling changes for file ID: {job['file_id']}")
+                job['trace'] = trace.span('file', file_id=job['file_id'], file=job['name'], size=job['size'])
+                feed.add_job(page)
+                pipeline.put(job)
 
-                logging.info(f"Upload in folder id {os.getenv('RESULT_FILE_ID')}.")
-                reply = upload_file(
-                    drive_service,
-                    new_file_name=path_file.split('/')[-1],
-                    local_file_path=path_file,
-                    new_mime_type='image/png',
-                    parent_folder_id=os.getenv('RESULT_FILE_ID')
-                    )
+        pipeline.close()
+        trace.end()
 
-                os.remove(path_file)  # Delete the file in the folder
-                logging.info(f"Watermarked file {file_mrkd} deleted after upload.")
+        if feed.changes_read:
+            pipeline_stats = pipeline.stats()
+            logging.info(f"Pipeline occupancy for resource {resource_id}: {pipeline_stats}")
+            logging.info(f"Change feed of resource {resource_id}: {feed.changes_read} changes in {feed.pages_read} pages.")
 
-                nb_file_uploaded += 1
+            nb_file_downloaded = pipeline_stats['download']['processed']
+            nb_file_to_mrkd = pipeline_stats['watermark']['processed']
+            nb_file_uploaded = pipeline_stats['upload']['processed']
 
             try:
                 logging.info(f"Processing summary for resource {resource_id}: Downloaded: {nb_file_downloaded}, Watermarked: {nb_file_to_mrkd}, Uploaded: {nb_file_uploaded}")
@@ -312,7 +460,18 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
                 timing = end - start
 
                 if nb_file_downloaded != 0:
-                    db.collection("log_time").document(message_number).set({'Processing time': timing, 'Number of files downloaded': nb_file_downloaded, 'Number of files watermarked': nb_file_to_mrkd, 'Number of files uploaded': nb_file_uploaded}, merge=True)
+                    record = {'resource_id': resource_id, 'Processing time': timing, 'Number of files downloaded': nb_file_downloaded, 'Number of files watermarked': nb_file_to_mrkd, 'Number of files uploaded': nb_file_uploaded, 'Transfers': transfers.report(), 'Pipeline': pipeline_stats}
+
+                    if trace:
+                        # The job and its Drive and Firestore calls here, the files in the 'files' subcollection.
+                        record.update({'Trace': trace.record(skip=('file',)), 'Stages': trace.stages()})
+
+                    # Written with the rollup of the day, for the /history endpoint.
+                    log_reference = history.record_run(message_number, record, timing)
+
+                    if trace:
+                        with firestore_seconds.time(operation='file_traces'):
+                            save_file_traces(log_reference, trace)
             except Exception as e:
                 logging.error(f"Error logging processing summary to Firestore: {e}", exc_info=True)   
             
@@ -323,4 +482,7 @@ def gdrive_file_handler(resource_id, resource_state, FILE_SAVE_PATH, message_num
         logging.error(f"Error while handling the webhook for resource {resource_id}: {e}", exc_info=True)
         response_data = {"status": "processed_with_error", "error": str(e)}
     finally:
+        pipeline.close()
+        # States of the images done in pages the run left unfinished.
+        feed.flush()
         logging.info(f"Thread for resource {resource_id} completed.")
\ No newline at end of file
@@ -1,6 +1,7 @@
 import logging
 import firebase_admin
 from firebase_admin import firestore
+from functions.metrics import firestore_seconds
 
 try:
     firebase_admin.initialize_app()
@@ -40,7 +41,9 @@ def load_startpagetoken(resource_id) -> dict:
         None
 
     doc_ref = db.collection('webhook_tokens').document(resource_id)
-    doc = doc_ref.get()
+
+    with firestore_seconds.time(operation='load_token'):
+        doc = doc_ref.get()
 
     if doc.exists:
         token_data = doc.to_dict()
@@ -60,5 +63,6 @@ def save_startpagetoken(resource_id, token) -> None:
         None
 
     doc_ref = db.collection('webhook_tokens').document(resource_id)
-    doc_ref.set({'token': token, 'last_updated': firestore.SERVER_TIMESTAMP})
+    with firestore_seconds.time(operation='save_token'):
+        doc_ref.set({'token': token, 'last_updated': firestore.SERVER_TIMESTAMP})
     logging.info(f"Token saved for resource {resource_id}: {token}")
\ No newline at end of file
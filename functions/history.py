@@ -0,0 +1,227 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import firebase_admin
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from functions.metrics import firestore_seconds
+from functions.tracing import HISTOGRAM_BUCKETS, Histogram
+
+try:
+    firebase_admin.initialize_app()
+except ValueError:
+    None
+
+db = firestore.client()
+
+LOG_COLLECTION = 'log_time'
+
+# One document per day (UTC), updated with atomic increments when a run is recorded.
+ROLLUP_COLLECTION = 'log_time_daily'
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 20))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 100))
+
+# Days of rollups returned when no range is given, and at most.
+ROLLUP_DAYS = int(os.getenv('HISTORY_ROLLUP_DAYS', 30))
+ROLLUP_MAX_DAYS = 366
+
+# Ranges of rollups kept in memory.
+ROLLUP_CACHE_SIZE = 64
+
+# Bounds of the histogram of the processing times of a day, in seconds: a run handles a batch of files for up to an hour.
+# The buckets of the tracing stop at 120 s, so the percentiles of the longer runs were all 120 s.
+RUN_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600)
+
+# Fields of a run returned by a page: the traces and transfers of the documents are left in Firestore.
+SUMMARY_FIELDS = ('finished_at', 'resource_id', 'Processing time', 'Number of files downloaded', 'Number of files watermarked', 'Number of files uploaded')
+
+
+def parse_time(value) -> datetime:
+    """Parse an ISO 8601 date or datetime of a query string, UTC if no timezone is given. None if value is empty."""
+
+    if not value:
+        return None
+
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class HistoryStore():
+    def __init__(self, cache_ttl=None):
+        """
+        Processing history of the handler runs: the log_time documents and their daily rollups.
+
+        Runs are read a page at a time, ordered and filtered on their finished_at field, so a request costs
+        the size of the page whatever the size of the history. The rollups (runs, mean, p50 and p95 processing
+        time per day) are incremented when a run is recorded, never recomputed from the runs, and cached in memory.
+
+        Parameters
+        ----------
+        cache_ttl : Float, optional
+            Seconds the rollups read from Firestore are reused. The default is the HISTORY_CACHE_TTL environment variable, or 60.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(os.getenv('HISTORY_CACHE_TTL', 60))
+
+        self._cache = {}
+        self._lock = threading.Lock()
+
+
+    def record_run(self, message_number, record, processing_time):
+        """
+        Write the log_time document of a run, and add it to the rollup of its day, in one batch.
+        Return the reference of the log_time document.
+        """
+
+        now = datetime.now(timezone.utc)
+        day = now.strftime('%Y-%m-%d')
+        bucket = bisect.bisect_left(RUN_BUCKETS, processing_time)
+
+        reference = db.collection(LOG_COLLECTION).document(message_number)
+
+        batch = db.batch()
+        batch.set(reference, dict(record, finished_at=now), merge=True)
+        batch.set(db.collection(ROLLUP_COLLECTION).document(day), {
+            'day': day,
+            'runs': firestore.Increment(1),
+            'processing_seconds': firestore.Increment(processing_time),
+            'files_uploaded': firestore.Increment(record.get('Number of files uploaded', 0)),
+            # Histogram of the processing times on RUN_BUCKETS, for the percentiles.
+            'run_buckets': {str(bucket): firestore.Increment(1)},
+        }, merge=True)
+
+        with firestore_seconds.time(operation='log_time'):
+            batch.commit()
+
+        with self._lock:
+            self._cache.clear()
+
+        return reference
+
+
+    def page(self, limit=None, cursor=None, start=None, end=None, descending=True) -> dict:
+        """
+        One page of runs, ordered by finished_at.
+
+        Parameters
+        ----------
+        limit : Integer, optional
+            Runs per page, at most HISTORY_MAX_PAGE_SIZE. The default is HISTORY_PAGE_SIZE.
+        cursor : String, optional
+            next_cursor of the previous page.
+        start, end : datetime, optional
+            Runs finished from start (included) to end (excluded).
+        descending : Boolean, optional
+            Most recent runs first. The default is True.
+
+        Returns
+        -------
+        page : Dict
+            'runs': list of runs (message_number and SUMMARY_FIELDS), 'next_cursor': cursor of the next page or None.
+
+        """
+
+        limit = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+        collection = db.collection(LOG_COLLECTION)
+
+        query = collection.select([FieldPath(field).to_api_repr() for field in SUMMARY_FIELDS])
+
+        if start:
+            query = query.where(filter=firestore.FieldFilter('finished_at', '>=', start))
+        if end:
+            query = query.where(filter=firestore.FieldFilter('finished_at', '<', end))
+
+        query = query.order_by('finished_at', direction=firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING)
+
+        if cursor:
+            # The cursor is the ID of the last run of the previous page: the query resumes after its snapshot.
+            snapshot = collection.document(cursor).get()
+
+            if not snapshot.exists:
+                raise ValueError(f"Unknown cursor {cursor}")
+
+            query = query.start_after(snapshot)
+
+        # One more run than the page, to know if there is a next page.
+        snapshots = list(query.limit(limit + 1).stream())
+        runs = [dict({key: _json_value(value) for key, value in snapshot.to_dict().items()}, message_number=snapshot.id) for snapshot in snapshots[:limit]]
+
+        return {'runs': runs, 'next_cursor': snapshots[limit - 1].id if len(snapshots) > limit else None}
+
+
+    def daily(self, start=None, end=None) -> list:
+        """
+        Rollups of the days from start to end (included), the last ROLLUP_DAYS days by default, oldest first.
+        Each one has the day, the number of runs, the files uploaded and the mean, p50 and p95 processing time in seconds.
+        """
+
+        end_day = (end or datetime.now(timezone.utc)).strftime('%Y-%m-%d')
+        start_day = (start or datetime.now(timezone.utc) - timedelta(days=ROLLUP_DAYS - 1)).strftime('%Y-%m-%d')
+        key = (start_day, end_day)
+
+        with self._lock:
+            cached = self._cache.get(key)
+
+            if cached and time.monotonic() - cached[0] < self.cache_ttl:
+                return cached[1]
+
+        query = (db.collection(ROLLUP_COLLECTION)
+                 .where(filter=firestore.FieldFilter('day', '>=', start_day))
+                 .where(filter=firestore.FieldFilter('day', '<=', end_day))
+                 .order_by('day')
+                 .limit(ROLLUP_MAX_DAYS))
+
+        rollups = [self._rollup(snapshot.to_dict()) for snapshot in query.stream()]
+
+        with self._lock:
+            # Ranges asked by the clients are arbitrary: the cache is emptied rather than growing without limit.
+            if len(self._cache) >= ROLLUP_CACHE_SIZE:
+                self._cache.clear()
+
+            self._cache[key] = (time.monotonic(), rollups)
+
+        logging.info(f"Rollups of the processing history from {start_day} to {end_day} loaded: {len(rollups)} days.")
+
+        return rollups
+
+
+    def _rollup(self, document) -> dict:
+        histogram = Histogram(RUN_BUCKETS)
+        buckets = document.get('run_buckets', {})
+        histogram.counts = [int(buckets.get(str(i), 0)) for i in range(len(histogram.counts))]
+
+        # Days recorded before RUN_BUCKETS, on the buckets of the tracing: each count goes to the bucket of its upper bound,
+        # the runs above 120 s to the bucket after 120 s.
+        for i, count in document.get('buckets', {}).items():
+            bound = HISTOGRAM_BUCKETS[int(i)] if int(i) < len(HISTOGRAM_BUCKETS) else HISTOGRAM_BUCKETS[-1] + 1
+            histogram.counts[bisect.bisect_left(RUN_BUCKETS, bound)] += int(count)
+
+        histogram.count = sum(histogram.counts)
+        histogram.sum = document.get('processing_seconds', 0)
+
+        runs = document.get('runs', 0)
+
+        return {
+            'day': document['day'],
+            'runs': runs,
+            'files_uploaded': document.get('files_uploaded', 0),
+            'mean_seconds': round(histogram.sum / runs, 3) if runs else None,
+            'p50_seconds': round(histogram.quantile(0.5), 3) if histogram.count else None,
+            'p95_seconds': round(histogram.quantile(0.95), 3) if histogram.count else None,
+        }
+
+
+history = HistoryStore()
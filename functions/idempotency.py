@@ -0,0 +1,283 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import firebase_admin
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, Conflict
+from functions.metrics import firestore_seconds
+
+try:
+    firebase_admin.initialize_app()
+except ValueError:
+    None
+
+db = firestore.client()
+
+# Seconds a claim is reserved to its run: longer than a page of files takes to go through the pipeline.
+LEDGER_LEASE_SECONDS = int(os.getenv('LEDGER_LEASE_SECONDS', 1800))
+
+# Claims of a file (failed or expired ones included) after which it is given up.
+LEDGER_MAX_ATTEMPTS = int(os.getenv('LEDGER_MAX_ATTEMPTS', 3))
+
+# Maximum number of writes of a Firestore batch.
+FIRESTORE_BATCH_SIZE = 500
+
+# State of a claim, from the point of view of a run that wants the file.
+FREE = 'free'  # No claim, a failed one or an expired one: the file can be claimed.
+HELD = 'held'  # Claimed by a run whose lease is not over.
+DONE = 'done'  # Uploaded, or given up after LEDGER_MAX_ATTEMPTS claims.
+
+
+class IdempotencyLedger():
+    def __init__(self, collection='file_ledger', cache_size=None, lease=None, max_attempts=None):
+        """
+        Ledger of the files already handled, with one claim document per file ID in Firestore.
+
+        A claim is created atomically (create() fails if the document exists), so two handler runs, even on two
+        instances, never process the same file. It is marked done once the watermarked file is uploaded, or failed
+        when its processing failed, in one batch for the files of a page of changes (see finish()). A failed claim, or a claim whose lease is over (its process crashed or was
+        stopped), is taken over in a transaction by the next run that sees the file, up to max_attempts claims.
+        The IDs claimed or done in this process are kept in an in-memory LRU set, so repeated notifications for
+        a file are rejected without any Firestore call.
+        An exact set is used rather than a Bloom filter: a false positive would silently skip a new image.
+
+        Parameters
+        ----------
+        collection : String, optional
+            Firestore collection of the claims. The default is 'file_ledger'.
+        cache_size : Integer, optional
+            Number of IDs kept in memory. The default is the LEDGER_CACHE_SIZE environment variable, or 100000.
+        lease : Integer, optional
+            Seconds a claim is reserved to its run. The default is LEDGER_LEASE_SECONDS (environment variable), or 1800.
+        max_attempts : Integer, optional
+            Claims of a file before it is given up. The default is LEDGER_MAX_ATTEMPTS (environment variable), or 3.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.collection = db.collection(collection)
+        self.cache_size = cache_size or int(os.getenv('LEDGER_CACHE_SIZE', 100000))
+        self.lease = lease or LEDGER_LEASE_SECONDS
+        self.max_attempts = max_attempts or LEDGER_MAX_ATTEMPTS
+
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.local_hits = 0
+        self.remote_hits = 0
+        self.claims = 0
+        self.takeovers = 0
+
+
+    def _remember(self, file_ids):
+        with self._lock:
+            for file_id in file_ids:
+                self._known[file_id] = None
+                self._known.move_to_end(file_id)
+
+            while len(self._known) > self.cache_size:
+                self._known.popitem(last=False)
+
+
+    def is_known(self, file_id) -> bool:
+        """True if this process already claimed the file or saw it done: no network call."""
+
+        with self._lock:
+            if file_id in self._known:
+                self.local_hits += 1
+                return True
+
+        return False
+
+
+    def _status(self, file_id, claim, now) -> str:
+        """FREE, HELD or DONE, for a claim document. Claims written before the states were added are done."""
+
+        state = claim.get('state', 'done')
+
+        if state == 'done':
+            return DONE
+
+        if state == 'claimed':
+            claimed_at = claim.get('claimed_at')
+            lease = claim.get('lease_seconds', self.lease)
+
+            if claimed_at is not None and now - claimed_at < timedelta(seconds=lease):
+                return HELD
+
+        if claim.get('attempts', 1) >= self.max_attempts:
+            logging.error(f"File {file_id} given up after {claim.get('attempts', 1)} attempts ({state} claim).")
+            return DONE
+
+        return FREE
+
+
+    def claim(self, jobs) -> tuple:
+        """
+        Claim a batch of files, with one read and one batched write for the files never claimed.
+        jobs is a list of dicts with at least 'file_id'.
+        Return (claimed, held): the sets of file IDs claimed by this call, and of those claimed by another run
+        whose lease is not over, to try again in a later run.
+        """
+
+        jobs = [job for job in jobs if not self.is_known(job['file_id'])]
+
+        if not jobs:
+            return set(), set()
+
+        refs = {job['file_id']: self.collection.document(job['file_id']) for job in jobs}
+
+        with firestore_seconds.time(operation='ledger_read'):
+            existing = {snapshot.id: snapshot.to_dict() for snapshot in db.get_all(list(refs.values())) if snapshot.exists}
+
+        now = datetime.now(timezone.utc)
+        status = {file_id: self._status(file_id, claim, now) for file_id, claim in existing.items()}
+
+        done = {file_id for file_id, value in status.items() if value == DONE}
+        held = {file_id for file_id, value in status.items() if value == HELD}
+        self.remote_hits += len(done) + len(held)
+        self._remember(done)
+
+        claimed, conflicts = self._create([job for job in jobs if job['file_id'] not in existing], refs)
+        held |= conflicts
+
+        # Failed and expired claims, one transaction each: two runs may try to take over the same claim.
+        for job in jobs:
+            if status.get(job['file_id']) != FREE:
+                continue
+
+            result = self._take_over(refs[job['file_id']], job)
+
+            if result == FREE:
+                claimed.add(job['file_id'])
+                self.takeovers += 1
+            elif result == HELD:
+                held.add(job['file_id'])
+            else:
+                self._remember([job['file_id']])
+
+        self.claims += len(claimed)
+        self._remember(claimed)
+
+        return claimed, held
+
+
+    def _create(self, jobs, refs) -> tuple:
+        """Create the claims of files never claimed, in one batch. Return (claimed, conflicts): the IDs claimed, and those claimed by another run meanwhile."""
+
+        if not jobs:
+            return set(), set()
+
+        batch = db.batch()
+        for job in jobs:
+            batch.create(refs[job['file_id']], self._record(job))
+
+        try:
+            with firestore_seconds.time(operation='ledger_claim'):
+                batch.commit()
+            return {job['file_id'] for job in jobs}, set()
+        except (AlreadyExists, Conflict):
+            # Another run claimed some of the files in between: claim them one by one.
+            logging.warning("Batch claim conflicted with another handler run, claiming the files one by one.")
+
+        claimed = set()
+        conflicts = set()
+
+        for job in jobs:
+            try:
+                refs[job['file_id']].create(self._record(job))
+                claimed.add(job['file_id'])
+            except (AlreadyExists, Conflict):
+                self.remote_hits += 1
+                conflicts.add(job['file_id'])
+
+        return claimed, conflicts
+
+
+    def _take_over(self, reference, job) -> str:
+        """
+        Claim a file whose claim failed or expired, if it still is in a transaction.
+        Return the status the transaction found: FREE when the file was claimed, else HELD or DONE.
+        """
+
+        @firestore.transactional
+        def take_over(transaction):
+            snapshot = reference.get(transaction=transaction)
+
+            if not snapshot.exists:
+                transaction.create(reference, self._record(job))
+                return FREE
+
+            claim = snapshot.to_dict()
+            status = self._status(reference.id, claim, datetime.now(timezone.utc))
+
+            if status == FREE:
+                transaction.set(reference, self._record(job, attempts=claim.get('attempts', 1) + 1))
+                logging.warning(f"Claim of the file {reference.id} ({claim.get('state')}) taken over, attempt {claim.get('attempts', 1) + 1}.")
+
+            return status
+
+        with firestore_seconds.time(operation='ledger_takeover'):
+            return take_over(db.transaction())
+
+
+    def _record(self, job, attempts=1) -> dict:
+        return {
+            'name': job.get('name'),
+            'md5': job.get('md5'),
+            'state': 'claimed',
+            'claimed_at': firestore.SERVER_TIMESTAMP,
+            'lease_seconds': self.lease,
+            'attempts': attempts,
+        }
+
+
+    def finish(self, done, failed):
+        """
+        Write the states of the claims of the files of a page of changes, in one batch: done for the files uploaded,
+        which no later run handles again, and failed for the others, which a later run can retry.
+        """
+
+        writes = [(file_id, {'state': 'done', 'done_at': firestore.SERVER_TIMESTAMP}) for file_id in done]
+        writes += [(file_id, {'state': 'failed', 'failed_at': firestore.SERVER_TIMESTAMP}) for file_id in failed]
+
+        for i in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+            chunk = writes[i:i + FIRESTORE_BATCH_SIZE]
+            batch = db.batch()
+
+            for file_id, state in chunk:
+                batch.update(self.collection.document(file_id), state)
+
+            try:
+                with firestore_seconds.time(operation='ledger_finish'):
+                    batch.commit()
+                continue
+            except Exception as e:
+                # A claim deleted meanwhile fails the whole batch: the others are written one by one.
+                logging.warning(f"Batch update of {len(chunk)} claims failed ({e}), writing them one by one.")
+
+            for file_id, state in chunk:
+                try:
+                    self.collection.document(file_id).update(state)
+                except Exception as e:
+                    # The claim expires at the end of its lease: a file done would then be watermarked again.
+                    logging.error(f"Error when marking the claim of the file {file_id} {state['state']}: {e}", exc_info=True)
+
+        if failed:
+            logging.info(f"Claims of the files {', '.join(failed)} released.")
+
+            with self._lock:
+                for file_id in failed:
+                    self._known.pop(file_id, None)
+
+
+    def stats(self) -> dict:
+        return {'known': len(self._known), 'local hits': self.local_hits, 'remote hits': self.remote_hits, 'claims': self.claims, 'takeovers': self.takeovers}
+
+
+ledger = IdempotencyLedger()
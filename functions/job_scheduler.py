@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+import time
+
+
+class JobScheduler():
+    def __init__(self, target, max_workers=None, max_queue=None, quiet_period=None, max_delay=None):
+        """
+        Bounded pool of worker threads fed by an in-process job queue.
+
+        Jobs are keyed (by Drive resource_id): a job submitted while another job with the same key
+        is still waiting in the queue is merged into it, keeping the most recent arguments.
+        A job waits until no job was submitted for its key during quiet_period seconds, and at most max_delay
+        seconds after the first one, so a burst of notifications (an upload of many files) is handled by one run.
+        At most one job runs per key: the jobs submitted meanwhile are merged into a single follow-up run.
+
+        Parameters
+        ----------
+        target : Callable
+            Function called by the workers as target(key, *args).
+        max_workers : Integer, optional
+            Number of worker threads. The default is the WORKER_COUNT environment variable, or 4.
+        max_queue : Integer, optional
+            Maximum number of jobs waiting for a worker. The default is the JOB_QUEUE_SIZE environment variable, or 32.
+        quiet_period : Float, optional
+            Seconds without a new job for the key before its job runs. The default is the JOB_QUIET_PERIOD environment variable, or 2.
+        max_delay : Float, optional
+            Seconds after the first job merged before the job runs, even if jobs keep coming. The default is the JOB_MAX_DELAY environment variable, or 10.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.target = target
+        self.max_workers = max_workers or int(os.getenv('WORKER_COUNT', 4))
+        self.max_queue = max_queue or int(os.getenv('JOB_QUEUE_SIZE', 32))
+        self.quiet_period = quiet_period if quiet_period is not None else float(os.getenv('JOB_QUIET_PERIOD', 2))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('JOB_MAX_DELAY', 10))
+
+        self._pending = {}  # key -> args of the job waiting in the queue, in the order of the first submission
+        self._submitted_at = {}  # key -> (first, last) submission times of the job waiting
+        self._running = set()  # keys of the jobs running
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._workers = []
+        self._busy = 0
+        self._stopping = False
+
+        self.submitted = 0
+        self.merged = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+
+    def start(self):
+        """Start the worker threads if they are not running yet."""
+
+        with self._lock:
+            if self._workers:
+                return
+
+            for i in range(self.max_workers):
+                worker = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+        logging.info(f"Job scheduler started with {self.max_workers} workers and a queue of {self.max_queue} jobs "
+                     f"(quiet period {self.quiet_period} s, max delay {self.max_delay} s).")
+
+
+    def submit(self, key, *args) -> bool:
+        """
+        Queue a job, or merge it into the job already waiting for the same key.
+        Return False when the queue is saturated and the job was refused.
+        """
+
+        self.start()
+        now = time.monotonic()
+
+        with self._condition:
+            if self._stopping:
+                self.rejected += 1
+                return False
+
+            if key in self._pending:
+                self._pending[key] = args
+                self._submitted_at[key] = (self._submitted_at[key][0], now)
+                self.merged += 1
+                logging.info(f"Job for {key} merged into the job already waiting in the queue.")
+                # The due time of the job moved: the workers waiting for it compute it again.
+                self._condition.notify_all()
+                return True
+
+            if len(self._pending) >= self.max_queue:
+                self.rejected += 1
+                logging.warning(f"Job queue saturated ({len(self._pending)} jobs waiting). Job for {key} refused.")
+                return False
+
+            self._pending[key] = args
+            self._submitted_at[key] = (now, now)
+            self.submitted += 1
+
+            if key in self._running:
+                logging.info(f"Job for {key} running: follow-up job queued.")
+
+            self._condition.notify_all()
+
+        return True
+
+
+    def _due(self, key) -> float:
+        """Time at which the job waiting for key can run: at the end of its quiet period, or of its max delay."""
+
+        first, last = self._submitted_at[key]
+        return min(last + self.quiet_period, first + self.max_delay)
+
+
+    def _next_job(self):
+        """
+        Wait for a job that can run, and mark its key running. Called with the lock held.
+        Return (key, args), or None when the scheduler stops and no job is left.
+        """
+
+        while True:
+            now = time.monotonic()
+            wait = None
+
+            for key in self._pending:
+                if key in self._running:
+                    continue
+
+                # When stopping, the jobs left run without waiting for their quiet period.
+                due = now if self._stopping else self._due(key)
+
+                if due <= now:
+                    args = self._pending.pop(key)
+                    del self._submitted_at[key]
+                    self._running.add(key)
+                    self._busy += 1
+                    return key, args
+
+                wait = due - now if wait is None else min(wait, due - now)
+
+            if self._stopping and not self._pending:
+                return None
+
+            # Woken by a submission, the end of a job or the shutdown, or when the next job is due.
+            self._condition.wait(wait)
+
+
+    def _worker(self):
+        """Worker loop: take the next job due whose key is not running, and run the target with its latest arguments."""
+
+        while True:
+            with self._condition:
+                job = self._next_job()
+
+            if job is None:
+                return
+
+            key, args = job
+
+            try:
+                self.target(key, *args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Job for {key} failed: {e}", exc_info=True)
+            finally:
+                with self._condition:
+                    self._running.discard(key)
+                    self._busy -= 1
+                    # A follow-up job of the key can run now.
+                    self._condition.notify_all()
+
+
+    def stats(self) -> dict:
+        """Return the queue depth, the worker utilisation and the job counters."""
+
+        with self._lock:
+            busy = self._busy
+            depth = len(self._pending)
+
+        return {
+            'queue_depth': depth,
+            'queue_size': self.max_queue,
+            'workers': self.max_workers,
+            'workers_busy': busy,
+            'utilisation': busy / self.max_workers,
+            'quiet_period': self.quiet_period,
+            'max_delay': self.max_delay,
+            'submitted': self.submitted,
+            'merged': self.merged,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+
+    def shutdown(self, timeout=None, cancel_pending=False) -> bool:
+        """
+        Refuse new jobs, let the workers finish the queued ones (without their quiet period) and stop them.
+        With cancel_pending, the jobs still waiting are dropped and only the running ones are finished: the changes
+        of a dropped job stay in the Drive change feed, as its page token is not saved, and are read by the next run.
+        Return True if every worker stopped before the timeout.
+        """
+
+        with self._condition:
+            self._stopping = True
+            workers = list(self._workers)
+
+            if cancel_pending and self._pending:
+                logging.warning(f"Job scheduler stopping: {len(self._pending)} jobs waiting dropped ({', '.join(self._pending)}).")
+                self._pending.clear()
+                self._submitted_at.clear()
+
+            self._condition.notify_all()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for worker in workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+        return not any(worker.is_alive() for worker in workers)
@@ -0,0 +1,193 @@
+import logging
+import math
+import os
+import threading
+from contextlib import contextmanager
+import PIL
+from PIL import Image
+
+# The images are routed by their number of pixels, read from the file header (see route()):
+# - up to PIXEL_BUDGET, decoded at full resolution by every watermark process at the same time;
+# - up to MAX_DECODE_PIXELS, decoded at full resolution too, holding one of the LARGE_IMAGE_SLOTS shared by the processes;
+# - above, downscaled while decoding to fit in PIXEL_BUDGET, holding a slot: the full resolution of such images
+#   is lost (a warning is logged). The formats that can only be decoded whole (PNG, WebP, HEIF, compressed TIFF...)
+#   cannot be downscaled while decoding, and are refused.
+# A decoded image takes 3 or 4 bytes per pixel, and up to about 4 times that while compositing and encoding: the memory
+# of the processes stays under their number times PIXEL_BUDGET, plus LARGE_IMAGE_SLOTS times MAX_DECODE_PIXELS.
+
+# Pixels decoded at once by each watermark process. The default (150 MB in RGB) holds the photos of most cameras.
+PIXEL_BUDGET = int(os.getenv('WATERMARK_PIXEL_BUDGET', 50_000_000))
+
+# Pixels decoded at full resolution while holding a slot. The default, 4 times the budget, holds the 200 MP sensors.
+MAX_DECODE_PIXELS = int(os.getenv('WATERMARK_MAX_DECODE_PIXELS', 4 * PIXEL_BUDGET))
+
+# Number of images above the budget processed at the same time, over all the watermark processes.
+LARGE_IMAGE_SLOTS = int(os.getenv('WATERMARK_LARGE_IMAGE_SLOTS', 1))
+
+# Routes of an image, from route().
+FULL = 'full'  # Decoded at full resolution.
+LARGE = 'large'  # Decoded at full resolution, holding a slot.
+BOUNDED = 'bounded'  # Downscaled while decoding, holding a slot.
+
+# Rows decoded at once by the strip path.
+STRIP_ROWS = 512
+
+# The strip path sets the tiles and the size of an image before it is loaded, which PIL has no public API for.
+# It is used with the major version of Pillow pinned in requirements.txt only: with another one, such images are refused.
+STRIP_DECODING = PIL.__version__.split('.')[0] == '11'
+
+_slots = None
+_open_lock = threading.Lock()
+
+
+class ImageTooLarge(Exception):
+    """The image cannot be decoded within the memory budget."""
+
+
+def open_image(fp) -> Image.Image:
+    """
+    Image.open() without the decompression bomb check of PIL, which would refuse large panoramas: the images
+    are held to PIXEL_BUDGET and MAX_DECODE_PIXELS instead. The limit of PIL is lifted for the time of the call only.
+    """
+
+    with _open_lock:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+
+        try:
+            return Image.open(fp)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+def route(image) -> str:
+    """FULL, LARGE or BOUNDED: how an image just opened is decoded, from its number of pixels."""
+
+    pixels = image.width * image.height
+
+    if pixels <= PIXEL_BUDGET:
+        return FULL
+
+    if pixels <= MAX_DECODE_PIXELS:
+        return LARGE
+
+    return BOUNDED
+
+
+def set_large_image_slots(slots):
+    """Initializer of the watermark processes: share the semaphore limiting the large images in progress."""
+
+    global _slots
+    _slots = slots
+
+
+@contextmanager
+def large_image_slot(image):
+    """Hold one of the LARGE_IMAGE_SLOTS while an image above PIXEL_BUDGET is processed."""
+
+    global _slots
+
+    if route(image) == FULL:
+        yield
+        return
+
+    if _slots is None:
+        _slots = threading.BoundedSemaphore(LARGE_IMAGE_SLOTS)
+
+    _slots.acquire()
+    try:
+        yield
+    finally:
+        _slots.release()
+
+
+def fit_size(size, max_pixels, max_dimension=0) -> tuple:
+    """Largest size with the aspect ratio of size, within max_pixels and max_dimension (0 for no limit)."""
+
+    width, height = size
+    scale = min(1, math.sqrt(max_pixels / (width * height)))
+
+    if max_dimension:
+        scale = min(scale, max_dimension / max(width, height))
+
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _decode_strips(fp, image, factor) -> Image.Image:
+    """
+    Decode an image made of several tiles (TIFF strips or tiles) band by band, each band shrunk by factor
+    with reduce() before the next one is decoded: only STRIP_ROWS rows at full resolution are in memory.
+    """
+
+    width, height = image.size
+    band_rows = factor * math.ceil(STRIP_ROWS / factor)
+    output = Image.new(image.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+
+    for y0 in range(0, height, band_rows):
+        y1 = min(y0 + band_rows, height)
+        # Tiles are (decoder, (x0, y0, x1, y1), offset, arguments).
+        tiles = [tile for tile in image.tile if tile[1][1] < y1 and tile[1][3] > y0]
+
+        top = min(tile[1][1] for tile in tiles)
+        bottom = max(tile[1][3] for tile in tiles)
+
+        if hasattr(fp, 'seek'):
+            fp.seek(0)
+
+        # Same file, reduced to the tiles of the band (see STRIP_DECODING).
+        band = open_image(fp)
+        band.tile = [type(tile)(tile[0], (tile[1][0], tile[1][1] - top, tile[1][2], tile[1][3] - top), tile[2], tile[3]) for tile in tiles]
+        band._size = (width, bottom - top)
+        band.load()
+
+        band = band.crop((0, y0 - top, width, y1 - top))
+        output.paste(band.reduce(factor) if factor > 1 else band, (0, y0 // factor))
+
+    return output
+
+
+def load_bounded(fp, image, max_dimension=0) -> Image.Image:
+    """
+    Decode an image above MAX_DECODE_PIXELS in bounded memory, downscaled to fit in PIXEL_BUDGET and in max_dimension.
+    A JPEG is decoded at a reduced scale, an image made of several strips or tiles band by band, the others are refused.
+
+    Parameters
+    ----------
+    fp : String or file object
+        The file the image was opened from, read again by the strip path.
+    image : PIL.Image
+        Image just opened, not loaded yet.
+    max_dimension : Integer, optional
+        Maximum width and height of the result, 0 for no limit.
+
+    Returns
+    -------
+    image : PIL.Image
+        Decoded image, with at most PIXEL_BUDGET pixels.
+
+    """
+
+    pixels = image.width * image.height
+    target = fit_size(image.size, PIXEL_BUDGET, max_dimension)
+    factor = max(1, min(image.width // target[0], image.height // target[1]))
+
+    if target != fit_size(image.size, pixels, max_dimension):
+        logging.warning(f'Image of {image.size[0]}x{image.size[1]} pixels above WATERMARK_MAX_DECODE_PIXELS ({MAX_DECODE_PIXELS} pixels): '
+                        f'its resolution is reduced to {target[0]}x{target[1]}.')
+
+    if image.format in ('JPEG', 'MPO'):
+        # Scaled by 1/2, 1/4 or 1/8 in the DCT domain while decoding, never below the target size.
+        logging.info(f'Large JPEG of {image.size}: decoding at reduced scale for {target}.')
+        image.draft(image.mode, target)
+        image.load()
+
+    elif STRIP_DECODING and len(image.tile) > 1 and not getattr(image, 'use_load_libtiff', False) and image.mode in ('RGB', 'RGBA', 'L', 'LA', 'CMYK'):
+        logging.info(f'Large image of {image.size} in {len(image.tile)} tiles: decoding by strips, reduced by {factor}.')
+        image = _decode_strips(fp, image, factor)
+
+    else:
+        raise ImageTooLarge(f'{image.format} image of {image.size[0]}x{image.size[1]} pixels cannot be decoded in bounded memory (limit {MAX_DECODE_PIXELS} pixels).')
+
+    image.thumbnail(target, Image.LANCZOS)
+
+    return image
@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class LogoCache():
+    def __init__(self, max_bytes=None):
+        """
+        Process-wide LRU cache of the prepared (coloured, resized, faded) logos.
+
+        A prepared logo is keyed by the hash of the logo file content, the colors, the opacity and the scale,
+        so a new logo file or new settings give a new entry and the old ones are evicted when the memory bound is reached.
+        No explicit invalidation is needed: each watermark process has its own cache, out of reach of the handler,
+        and the hash of the logo file is computed again as soon as its modification time or size changes.
+
+        Parameters
+        ----------
+        max_bytes : Integer, optional
+            Memory bound of the cached RGBA logos. The default is the LOGO_CACHE_BYTES environment variable, or 64 MB.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.max_bytes = max_bytes or int(os.getenv('LOGO_CACHE_BYTES', 64 * 1024 * 1024))
+
+        self._logos = OrderedDict()  # key -> prepared logo
+        self._hashes = {}  # path -> (mtime, size, content hash)
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def _content_hash(self, path_logo) -> str:
+        """Hash of the logo file, recomputed only when its modification time or size changes."""
+
+        stat = os.stat(path_logo)
+        known = self._hashes.get(path_logo)
+
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+
+        with open(path_logo, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        self._hashes[path_logo] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+
+    def get(self, path_logo, colors, opacity, scale, prepare):
+        """
+        Return the prepared logo, calling prepare() to build it when it is not cached yet.
+        The returned image is shared: it must not be modified.
+        """
+
+        with self._lock:
+            key = (self._content_hash(path_logo), tuple(colors), opacity, scale)
+
+            logo = self._logos.get(key)
+
+            if logo is not None:
+                self._logos.move_to_end(key)
+                self.hits += 1
+                return logo
+
+            self.misses += 1
+            logo = prepare()
+
+            self._logos[key] = logo
+            self._size += len(logo.mode) * logo.width * logo.height
+
+            while self._size > self.max_bytes and len(self._logos) > 1:
+                _, evicted = self._logos.popitem(last=False)
+                self._size -= len(evicted.mode) * evicted.width * evicted.height
+
+            return logo
+
+
+    def invalidate(self):
+        """Drop every prepared logo of this process (benchmarks)."""
+
+        with self._lock:
+            self._logos.clear()
+            self._hashes.clear()
+            self._size = 0
+
+        logging.info("Prepared logo cache invalidated.")
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'logos': len(self._logos), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses}
+
+
+logo_cache = LogoCache()
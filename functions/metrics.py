@@ -0,0 +1,260 @@
+import os
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+from functions.tracing import HISTOGRAM_BUCKETS, Histogram, stage_histograms
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+class Metric():
+    def __init__(self, name, help, labels=(), collect=None):
+        """
+        Metric of the Prometheus text format, one series per combination of label values.
+
+        Parameters
+        ----------
+        name : String
+            Name of the metric.
+        help : String
+            Description, on the HELP line.
+        labels : Tuple, optional
+            Names of the labels of the series. The default is no label.
+        collect : Callable, optional
+            Read at each scrape instead of the values recorded: returns {tuple of label values: value}.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._series = {}
+        self._lock = threading.Lock()
+
+
+    def _key(self, labels) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+        if self.collect is not None:
+            series = self.collect()
+
+            with self._lock:
+                self._series = dict(series)
+
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+
+        return lines
+
+
+    def _render_series(self, key, value) -> list:
+        return [f'{self.name}{_labels(self.labels, key)} {value}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=HISTOGRAM_BUCKETS, collect=None):
+        super().__init__(name, help, labels, collect)
+        self.buckets = buckets
+
+
+    def observe(self, seconds, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            histogram = self._series.get(key)
+
+            if histogram is None:
+                histogram = self._series[key] = Histogram(self.buckets)
+
+            histogram.observe(seconds)
+
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def _render_series(self, key, histogram) -> list:
+        lines = []
+        cumulative = 0
+
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), key + (bound,))} {cumulative}')
+
+        lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), key + ("+Inf",))} {histogram.count}')
+        lines.append(f'{self.name}_sum{_labels(self.labels, key)} {histogram.sum}')
+        lines.append(f'{self.name}_count{_labels(self.labels, key)} {histogram.count}')
+
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        """Metrics of the process, rendered in the Prometheus text format by the /metrics endpoint."""
+
+        self.metrics = []
+
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+webhook_ack_seconds = registry.register(HistogramMetric('webhook_ack_seconds', 'Time to acknowledge a Google Drive notification.'))
+webhook_requests = registry.register(Counter('webhook_requests_total', 'Notifications received, by response status.', ('status',)))
+images = registry.register(Counter('images_total', 'Images that went through the pipeline, by result (uploaded or failed).', ('result',)))
+transfer_bytes = registry.register(Counter('drive_transfer_bytes_total', 'Bytes downloaded from and uploaded to Google Drive.', ('direction',)))
+drive_calls = registry.register(Counter('drive_api_calls_total', 'HTTP requests to the Google Drive API, by API method and status.', ('method', 'status')))
+firestore_seconds = registry.register(HistogramMetric('firestore_call_seconds', 'Duration of the Firestore calls, by operation.', ('operation',)))
+stage_seconds = registry.register(HistogramMetric('stage_seconds', 'Duration of the traced stages (download, decode, encode...), by stage. Empty when TRACING_ENABLED is false.', ('stage',),
+                                                  collect=lambda: {(name,): histogram for name, histogram in stage_histograms.snapshot().items()}))
+
+
+def drive_method(method, uri) -> str:
+    """Name of the Drive API method of a request, e.g. 'changes.list' or 'files.get_media'."""
+
+    parts = urlsplit(uri)
+    path = parts.path
+
+    if path.endswith('/changes/startPageToken'):
+        return 'changes.getStartPageToken'
+    if path.endswith('/changes/watch'):
+        return 'changes.watch'
+    if path.endswith('/changes'):
+        return 'changes.list'
+    if path.endswith('/channels/stop'):
+        return 'channels.stop'
+    if path.startswith('/upload/'):
+        return 'files.create'
+    if re.search(r'/files/[^/]+$', path):
+        return 'files.get_media' if parse_qs(parts.query).get('alt') == ['media'] else f'files.{method.lower()}'
+    if path.endswith('/files'):
+        return 'files.list'
+    return 'other'
+
+
+class MeteredHttp():
+    def __init__(self, http):
+        """HTTP transport counting the requests of a Drive client in drive_calls. Everything else goes to http."""
+
+        self.http = http
+
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        name = drive_method(method, uri)
+
+        try:
+            response, content = self.http.request(uri, method, *args, **kwargs)
+        except Exception:
+            drive_calls.inc(method=name, status='error')
+            raise
+
+        drive_calls.inc(method=name, status=response.status)
+        return response, content
+
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+def resident_memory(pid='self') -> int:
+    """Resident set size of a process in bytes, 0 if it cannot be read (no /proc)."""
+
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def register_scheduler(scheduler):
+    """Metrics of the jobs (handler runs) of the JobScheduler of the webhook, read from scheduler.stats() at each scrape."""
+
+    def in_progress():
+        stats = scheduler.stats()
+        return {('running',): stats['workers_busy'], ('queued',): stats['queue_depth']}
+
+    def jobs():
+        stats = scheduler.stats()
+        return {(result,): stats[result] for result in ('submitted', 'merged', 'rejected', 'processed', 'failed')}
+
+    registry.register(Gauge('jobs_in_progress', 'Handler runs running and waiting in the queue.', ('state',), collect=in_progress))
+    registry.register(Counter('jobs_total', 'Jobs submitted to the scheduler, by result.', ('result',), collect=jobs))
+
+
+def process_memory() -> dict:
+    memory = {('current',): resident_memory(), ('peak',): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+    # Imported here: the engine imports the watermark modules, not needed to render the metrics.
+    from functions.watermark_engine import watermark_engine_pids
+
+    memory[('watermark_workers',)] = sum(resident_memory(pid) for pid in watermark_engine_pids())
+    return memory
+
+
+registry.register(Gauge('resident_memory_bytes', 'Resident memory of the service (current and peak) and of its watermark processes.', ('process',), collect=process_memory))
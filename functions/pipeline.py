@@ -0,0 +1,205 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+_END = object()  # Sentinel closing the queue of a stage.
+
+
+class Stage():
+    def __init__(self, name, function, workers=1):
+        """
+        Step of a pipeline: function(item) runs in `workers` threads and returns the item for the next stage,
+        or None to drop it.
+        """
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+        self.queue = None
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy = 0
+        self.busy_seconds = 0
+        self.queue_samples = 0
+        self.queue_total = 0
+        self.queue_max = 0
+
+
+class Pipeline():
+    def __init__(self, stages, queue_size=None, on_done=None):
+        """
+        Streaming producer/consumer pipeline: each item flows through the stages as soon as it is ready.
+
+        The stages are linked by bounded queues, so a slow stage makes the previous ones wait (backpressure)
+        instead of piling up items in memory.
+
+        Parameters
+        ----------
+        stages : List of Stage
+            Stages, in order.
+        queue_size : Integer, optional
+            Size of the queue in front of each stage. The default is the PIPELINE_QUEUE_SIZE environment variable, or 4.
+        on_done : Callable, optional
+            Called with each item leaving the pipeline, whether it went through every stage, was dropped or failed.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.stages = stages
+        self.queue_size = queue_size or int(os.getenv('PIPELINE_QUEUE_SIZE', 4))
+        self.on_done = on_done
+        self.results = []
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        self._alive = {}
+        self._start = None
+
+
+    def start(self):
+        self._start = time.time()
+
+        for stage in self.stages:
+            stage.queue = queue.Queue(maxsize=self.queue_size)
+            self._alive[stage.name] = stage.workers
+
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(index,), name=f"{stage.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        return self
+
+
+    def _put(self, stage, item):
+        """Put an item in the queue of a stage, waiting while it is full, and sample the queue occupancy."""
+
+        stage.queue.put(item)
+
+        with self._lock:
+            depth = stage.queue.qsize()
+            stage.queue_samples += 1
+            stage.queue_total += depth
+            stage.queue_max = max(stage.queue_max, depth)
+
+
+    def put(self, item):
+        """Feed an item to the first stage. Block while the first stage is saturated."""
+
+        self._put(self.stages[0], item)
+
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+        while True:
+            item = stage.queue.get()
+
+            if item is _END:
+                break
+
+            with self._lock:
+                stage.busy += 1
+
+            start = time.time()
+            original = item
+
+            try:
+                item = stage.function(item)
+            except Exception as e:
+                logging.error(f"Pipeline stage {stage.name} failed: {e}", exc_info=True)
+                item = None
+                failed = True
+            else:
+                failed = False
+
+            with self._lock:
+                stage.busy -= 1
+                stage.busy_seconds += time.time() - start
+
+                if failed:
+                    stage.failed += 1
+                elif item is None:
+                    stage.dropped += 1
+                else:
+                    stage.processed += 1
+
+            if item is None:
+                self._done(original)
+                continue
+
+            if next_stage:
+                self._put(next_stage, item)
+            else:
+                with self._lock:
+                    self.results.append(item)
+                self._done(item)
+
+        with self._lock:
+            self._alive[stage.name] -= 1
+            last = self._alive[stage.name] == 0
+
+        # The last worker of a stage closes the next one, once every item of this stage was passed on.
+        if last and next_stage:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(_END)
+
+
+    def _done(self, item):
+        if self.on_done is None:
+            return
+
+        try:
+            self.on_done(item)
+        except Exception as e:
+            logging.error(f"Pipeline completion callback failed: {e}", exc_info=True)
+
+
+    def close(self) -> list:
+        """Signal the end of the input, wait for every item to go through the pipeline and return the results."""
+
+        if self._closed or self._start is None:
+            return self.results
+
+        self._closed = True
+
+        for _ in range(self.stages[0].workers):
+            self.stages[0].queue.put(_END)
+
+        for thread in self._threads:
+            thread.join()
+
+        return self.results
+
+
+    def stats(self) -> dict:
+        """Occupancy of each stage: items handled, worker utilisation and queue depth."""
+
+        wall = max(time.time() - (self._start or time.time()), 1e-9)
+        stats = {'Wall time': round(wall, 3)}
+
+        with self._lock:
+            for stage in self.stages:
+                stats[stage.name] = {
+                    'workers': stage.workers,
+                    'processed': stage.processed,
+                    'dropped': stage.dropped,
+                    'failed': stage.failed,
+                    'busy': stage.busy,
+                    'busy seconds': round(stage.busy_seconds, 3),
+                    'utilisation': round(stage.busy_seconds / (stage.workers * wall), 3),
+                    'queue mean': round(stage.queue_total / stage.queue_samples, 2) if stage.queue_samples else 0,
+                    'queue max': stage.queue_max,
+                }
+
+        return stats
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from ast import literal_eval
+from dataclasses import dataclass
+from functions.encoder import EncoderSettings, parse_encoder_settings
+
+SETTINGS_PATH = os.getcwd() + '/files/settings/settings.json'
+
+
+@dataclass(frozen=True)
+class WatermarkSettings():
+    """Watermark settings parsed and validated from settings.json. version is a hash of the file content."""
+
+    colors: tuple
+    opacity: float
+    version: str
+    output: EncoderSettings = EncoderSettings()
+
+
+def parse_settings(content) -> WatermarkSettings:
+    """Parse and validate the content of settings.json."""
+
+    settings = json.loads(content)
+
+    colors = settings['colors']
+    if isinstance(colors, str):
+        colors = literal_eval(colors)
+    colors = tuple(int(color) for color in colors)
+
+    if len(colors) != 3 or not all(0 <= color <= 255 for color in colors):
+        raise ValueError(f"colors must be 3 integers from 0 to 255, got {settings['colors']}")
+
+    opacity = float(settings['opacity'])
+
+    if not 0 <= opacity <= 100:
+        raise ValueError(f"opacity must be from 0 to 100, got {settings['opacity']}")
+
+    version = hashlib.sha256(content if isinstance(content, bytes) else content.encode('utf-8')).hexdigest()[:12]
+
+    return WatermarkSettings(colors=colors, opacity=opacity, version=version, output=parse_encoder_settings(settings.get('output')))
+
+
+class SettingsStore():
+    def __init__(self, path=SETTINGS_PATH, check_interval=None):
+        """
+        Hold the parsed settings and reload them only when they change.
+
+        The settings are reloaded after invalidate() (a new settings file arrived through the Drive change feed)
+        or when the modification time of the file changes, checked at most every check_interval seconds.
+
+        Parameters
+        ----------
+        path : String, optional
+            Path to settings.json.
+        check_interval : Float, optional
+            Seconds between two checks of the file. The default is the SETTINGS_CHECK_INTERVAL environment variable, or 5.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.path = path
+        self.check_interval = check_interval if check_interval is not None else float(os.getenv('SETTINGS_CHECK_INTERVAL', 5))
+
+        self._settings = None
+        self._stat = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+
+    def get(self) -> WatermarkSettings:
+        """Return the current settings."""
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self._settings is not None and now - self._checked < self.check_interval:
+                return self._settings
+
+            self._checked = now
+            stat = os.stat(self.path)
+
+            if self._settings is None or (stat.st_mtime_ns, stat.st_size) != self._stat:
+                with open(self.path, 'rb') as f:
+                    self._settings = parse_settings(f.read())
+
+                self._stat = (stat.st_mtime_ns, stat.st_size)
+                logging.info(f"Settings loaded: {self._settings}")
+
+            return self._settings
+
+
+    def invalidate(self):
+        """Force a check of the settings file on the next get()."""
+
+        with self._lock:
+            self._checked = 0
+            self._stat = None
+
+
+settings_store = SettingsStore()
@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import threading
+from functions.settings import SETTINGS_PATH
+
+# Local copy of each settings asset stored in the SETTING_FILE_ID folder on Google Drive.
+ASSET_PATHS = {
+    'settings.json': SETTINGS_PATH,
+    'logo.png': os.getcwd() + '/files/logo/logo.png',
+}
+
+# The index describes the local copies, so it is kept next to them.
+INDEX_PATH = os.getcwd() + '/files/settings/.asset_index.json'
+
+ASSET_FIELDS = "files(id,name,size,md5Checksum,modifiedTime)"
+
+
+class SettingsAssetResolver():
+    def __init__(self, download, folder_id=None, index_path=INDEX_PATH, asset_paths=ASSET_PATHS):
+        """
+        Resolver of the settings assets (settings.json and logo.png) in the settings folder on Google Drive.
+
+        The assets are looked up by parent folder and exact name, in a single files().list() request,
+        and the md5Checksum and modifiedTime of each local copy are kept in an index saved to index_path.
+        An asset is downloaded only when it is missing locally or when its checksum changed on Google Drive.
+
+        Parameters
+        ----------
+        download : Function
+            download_file(drive_service, file_id, destination_path=..., expected_file_size=..., expected_md5=...).
+        folder_id : String, optional
+            ID of the settings folder. The default is the SETTING_FILE_ID environment variable.
+        index_path : String, optional
+            Path of the index file.
+        asset_paths : Dict, optional
+            Local path of each asset, by name.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.download = download
+        self.folder_id = folder_id or os.getenv('SETTING_FILE_ID')
+        self.index_path = index_path
+        self.asset_paths = asset_paths
+
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"Could not read the settings asset index {self.index_path}: {e}")
+            return {}
+
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + '.part'
+
+        with open(temp_path, 'w') as f:
+            json.dump(self._index, f, indent=2)
+
+        os.replace(temp_path, self.index_path)
+
+
+    def is_current(self, file_id, md5) -> bool:
+        """True if the local copy of the file exists and has this checksum."""
+
+        entry = self._index.get(file_id)
+
+        return bool(entry) and entry.get('md5Checksum') == md5 and os.path.exists(entry.get('path', ''))
+
+
+    def fetch(self, drive_service, file_info, destination_path=None) -> bool:
+        """
+        Download an asset described by its Drive metadata (id, name, size, md5Checksum, modifiedTime),
+        unless the local copy is already current. Return True if the asset was downloaded.
+        """
+
+        file_id = file_info.get('id')
+        name = file_info.get('name')
+        md5 = file_info.get('md5Checksum')
+        destination_path = destination_path or self.asset_paths.get(name)
+
+        if destination_path is None:
+            logging.info(f"File {name} is not a settings asset. Ignored.")
+            return False
+
+        with self._lock:
+            if md5 and self.is_current(file_id, md5):
+                logging.info(f"Settings asset {name} unchanged (md5 {md5}). Not downloaded.")
+                return False
+
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            download = self.download(drive_service, file_id, destination_path=destination_path, expected_file_size=file_info.get('size'), expected_md5=md5)
+
+            if not download:
+                logging.error(f"Downloading of the settings asset {name} ({file_id}) failed.")
+                return False
+
+            self._index[file_id] = {
+                'name': name,
+                'md5Checksum': download.get('md5') or md5,
+                'modifiedTime': file_info.get('modifiedTime'),
+                'path': destination_path,
+            }
+            self._save_index()
+
+        logging.info(f"Settings asset {name} downloaded to {destination_path}.")
+        return True
+
+
+    def resolve(self, drive_service, names=None) -> list:
+        """
+        Make sure the local copies of the assets exist: the missing ones are looked up by parent and name
+        in one request, then downloaded. Return the names of the assets downloaded.
+        """
+
+        names = [name for name in (names or self.asset_paths) if not os.path.exists(self.asset_paths[name])]
+
+        if not names:
+            return []
+
+        logging.warning(f"Settings assets missing locally: {names}. Looking them up in folder {self.folder_id}.")
+
+        names_query = ' or '.join(f"name = '{name}'" for name in names)
+        reply = drive_service.files().list(
+            q=f"'{self.folder_id}' in parents and ({names_query}) and trashed = false",
+            fields=ASSET_FIELDS,
+            orderBy='modifiedTime desc',
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        ).execute()
+
+        downloaded = []
+        seen = set()
+
+        for file_info in reply.get('files', []):
+            name = file_info.get('name')
+
+            # Newest first: keep only the most recent file of each name.
+            if name not in names or name in seen:
+                continue
+
+            seen.add(name)
+            if self.fetch(drive_service, file_info):
+                downloaded.append(name)
+
+        for name in names:
+            if not os.path.exists(self.asset_paths[name]):
+                logging.error(f"Settings asset {name} not found in folder {self.folder_id}.")
+
+        return downloaded
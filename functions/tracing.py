@@ -0,0 +1,251 @@
+import bisect
+import copy
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+# Switch off to make every span a no-op: the handler then writes only its counters to log_time.
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() in ('true', '1', 'yes')
+
+# Upper bounds, in seconds, of the buckets of the stage histograms.
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_current = ContextVar('span', default=None)
+
+
+class Histogram():
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        """Durations in fixed buckets: constant memory whatever the number of observations."""
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts the durations above the last bound.
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+    def quantile(self, share) -> float:
+        """Quantile interpolated linearly in the bucket holding it (as Prometheus does), the last bound if it is above it."""
+
+        rank = share * self.count
+        seen = 0
+        lower = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+
+            seen += count
+            lower = bound
+
+        return self.buckets[-1]
+
+
+class StageHistograms():
+    def __init__(self):
+        """Histogram of the durations of each span name, over every job of the process."""
+
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+
+            histogram.observe(seconds)
+
+
+    def snapshot(self) -> dict:
+        """Copy of the histograms, by span name."""
+
+        with self._lock:
+            return copy.deepcopy(self.histograms)
+
+
+    def summary(self) -> dict:
+        """Count, total and approximate p50/p95/p99 in milliseconds of each stage."""
+
+        with self._lock:
+            return {name: {
+                'count': histogram.count,
+                'total ms': round(histogram.sum * 1000, 1),
+                'p50 ms': round(histogram.quantile(0.5) * 1000, 1),
+                'p95 ms': round(histogram.quantile(0.95) * 1000, 1),
+                'p99 ms': round(histogram.quantile(0.99) * 1000, 1),
+            } for name, histogram in sorted(self.histograms.items())}
+
+
+stage_histograms = StageHistograms()
+
+
+class Span():
+    __slots__ = ('name', 'attributes', 'children', 'start', 'duration', '_token')
+
+    def __init__(self, name, /, **attributes):
+        """
+        Timed operation, with attributes (bytes, dimensions, retries...) and child spans. Started when created.
+
+        Used as a context manager, it ends on exit and is the current span meanwhile: span() then opens its children.
+        Spans outside a context manager (a file going through the pipeline threads) are ended by end().
+        """
+
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.start = time.perf_counter()
+        self.duration = None
+        self._token = None
+
+
+    def __bool__(self):
+        return True
+
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current.reset(self._token)
+
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+
+        self.end()
+
+
+    def span(self, name, /, **attributes):
+        """Start a child span."""
+
+        child = Span(name, **attributes)
+        # list.append is atomic: spans of several threads can be added to the same parent.
+        self.children.append(child)
+        return child
+
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+    def add(self, key, value=1):
+        """Add value to a counter attribute, e.g. add('retries')."""
+
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+
+    def attach(self, record):
+        """Add a span recorded in another process (record() of a Span), its durations to the histograms."""
+
+        if not record:
+            return
+
+        self.children.append(record)
+        _observe(record)
+
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start
+            stage_histograms.observe(self.name, self.duration)
+
+
+    def record(self, skip=()) -> dict:
+        """Compact dict of the span and its children, durations in milliseconds, without the children named in skip."""
+
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.start
+        record = {'name': self.name, 'ms': round(duration * 1000, 1), **self.attributes}
+        children = [child if isinstance(child, dict) else child.record() for child in self.children if _name(child) not in skip]
+
+        if children:
+            record['spans'] = children
+
+        return record
+
+
+    def stages(self) -> dict:
+        """Number and total milliseconds of the spans of each name, over the whole tree."""
+
+        stages = {}
+        _total(self.record(), stages)
+        return {name: {'count': count, 'ms': round(ms, 1)} for name, (count, ms) in sorted(stages.items())}
+
+
+class NoopSpan():
+    """Span of a disabled tracing, or of an operation run outside any trace: records nothing."""
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return None
+
+    def span(self, name, /, **attributes):
+        return self
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, value=1):
+        pass
+
+    def attach(self, record):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def _name(child) -> str:
+    return child['name'] if isinstance(child, dict) else child.name
+
+
+def _observe(record):
+    stage_histograms.observe(record['name'], record['ms'] / 1000)
+
+    for child in record.get('spans', ()):
+        _observe(child)
+
+
+def _total(record, stages):
+    count, ms = stages.get(record['name'], (0, 0))
+    stages[record['name']] = (count + 1, ms + record['ms'])
+
+    for child in record.get('spans', ()):
+        _total(child, stages)
+
+
+def start_trace(name, /, **attributes):
+    """Root span of a job, or NOOP_SPAN when the tracing is disabled."""
+
+    return Span(name, **attributes) if TRACING_ENABLED else NOOP_SPAN
+
+
+def current_span():
+    """Span opened by the innermost `with span:` of the current thread, or NOOP_SPAN."""
+
+    return _current.get() or NOOP_SPAN
+
+
+def span(name, /, **attributes):
+    """Child of the current span, or NOOP_SPAN outside any trace."""
+
+    return current_span().span(name, **attributes)
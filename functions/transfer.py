@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from functions.metrics import transfer_bytes
+from functions.tracing import current_span
+from functions.webhook import checkout_drive_service
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity):
+        """
+        Token bucket shared by every transfer worker, to stay under the per-user Google Drive quota.
+
+        Parameters
+        ----------
+        rate : Float
+            Tokens (requests) added per second.
+        capacity : Integer
+            Maximum number of tokens, i.e. the size of the bursts allowed.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self, tokens=1) -> float:
+        """Take tokens from the bucket, waiting for them if needed. Return the time waited in seconds."""
+
+        waited = 0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+
+                delay = (tokens - self._tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+# Shared by every handler run of the process, as the quota is per user.
+drive_quota = TokenBucket(rate=float(os.getenv('DRIVE_REQUESTS_PER_SECOND', 10)), capacity=int(os.getenv('DRIVE_REQUESTS_BURST', 20)))
+
+
+class TransferStage():
+    def __init__(self, max_workers=None, bucket=drive_quota):
+        """
+        Google Drive downloads and uploads of a handler run, made concurrently by the worker threads of the pipeline
+        stages (max_workers of them per stage). Each transfer borrows a Drive client from the pool of the process:
+        the stage threads end with the run, the clients and their connections are reused by the next runs.
+
+        Parameters
+        ----------
+        max_workers : Integer, optional
+            Number of worker threads of the download and upload stages. The default is the TRANSFER_WORKERS environment variable, or 8.
+        bucket : TokenBucket, optional
+            Rate limiter acquired before each transfer. The default is the process-wide Drive quota.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.max_workers = max_workers or int(os.getenv('TRANSFER_WORKERS', 8))
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.timings = []
+
+
+    def run(self, kind, name, function, *args, **kwargs):
+        """
+        Run function(drive_service, *args, **kwargs) in the current thread, with a pooled Drive client and the quota applied.
+        kind ('download' or 'upload') and name label the transfer in the timings.
+        The quota wait and the bytes transferred are added to the current span.
+        """
+
+        waited = self.bucket.acquire() if self.bucket else 0
+        start = time.time()
+
+        with checkout_drive_service() as drive_service:
+            result = function(drive_service, *args, **kwargs)
+
+        timing = {
+            'kind': kind,
+            'file': name,
+            'seconds': round(time.time() - start, 3),
+            'quota_wait': round(waited, 3),
+            'bytes': result.get('size') if isinstance(result, dict) else None,
+            'ok': bool(result),
+        }
+
+        with self._lock:
+            self.timings.append(timing)
+
+        current_span().set(quota_wait=timing['quota_wait'], bytes=int(timing['bytes'] or 0))
+        transfer_bytes.inc(int(timing['bytes'] or 0), direction=kind)
+
+        logging.info(f"Transfer {kind} of {name} done in {timing['seconds']}s (quota wait {timing['quota_wait']}s).")
+        return result
+
+
+    def report(self) -> dict:
+        """Aggregate timings of the transfers, to be written to the log_time collection."""
+
+        with self._lock:
+            timings = list(self.timings)
+
+        report = {'Wall time': round(time.time() - self._start, 3)}
+
+        for kind in ('download', 'upload'):
+            seconds = [timing['seconds'] for timing in timings if timing['kind'] == kind]
+
+            report[kind] = {
+                'count': len(seconds),
+                'total seconds': round(sum(seconds), 3),
+                'max seconds': max(seconds, default=0),
+                'bytes': sum(int(timing['bytes'] or 0) for timing in timings if timing['kind'] == kind),
+            }
+
+        report['files'] = timings
+        return report
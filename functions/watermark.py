@@ -5,14 +5,39 @@ Created on Tue Nov 26 19:25:23 2024
 @author: alram
 """
 
+import io
 import logging
 import os
 import numpy as np
-from PIL import Image, ImageEnhance
+from PIL import ExifTags, Image, ImageEnhance
 from pillow_heif import register_heif_opener
+from functions.encoder import EncoderSettings, encode, output_format
+from functions.large_image import BOUNDED, large_image_slot, load_bounded, open_image, route
+from functions.logo_cache import logo_cache
+from functions.tracing import span
+
+# Size of the watermark relative to the logo file.
+LOGO_SCALE = 0.5
+
+# Before the final LANCZOS resize, the image is reduced (JPEG DCT scaling, then reduce()) down to this many times the output size.
+REDUCING_GAP = 2.0
+
+# Modes in which the watermark is composited without converting the image. Other modes are converted to RGB(A) first.
+NATIVE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK')
+
+# Transposition turning the pixels upright, by value of the EXIF Orientation tag (1 is upright).
+ORIENTATIONS = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
 
 class Watermark():
-    def __init__(self, path, path_logo, colors=(255, 255, 255), opacity=100):
+    def __init__(self, path, path_logo, colors=(255, 255, 255), opacity=100, encoder=None):
         """
         Class to add a watermark to an image.
 
@@ -24,6 +49,8 @@ class Watermark():
             Color for the output. The default is (255, 255, 255).
         opacity : Integer, optional
             From 0 (transparent) to 255 (fully visible). The default is 120.
+        encoder : EncoderSettings, optional
+            Format and quality of the output. The default is EncoderSettings().
 
         Returns
         -------
@@ -36,6 +63,9 @@ class Watermark():
         self.path_logo = path_logo
         self.colors = colors
         self.opacity = (opacity / 100) * 255
+        self.encoder = encoder or EncoderSettings()
+        self.output_format = None
+        self.orientation = 1
 
 
     def img_color(self, image):
@@ -84,7 +114,7 @@ class Watermark():
         
         logging.info('Changing the size of the logo...')
         
-        resize = tuple(param/2 for param in image.size)
+        resize = tuple(param * LOGO_SCALE for param in image.size)
         image.thumbnail(resize, Image.LANCZOS)
         
         logging.info('Changing the size done.')
@@ -141,15 +171,239 @@ class Watermark():
 
         """
 
+        # The prepared logo only depends on the logo file and the settings: it is built once and cached.
+        self.logo = logo_cache.get(self.path_logo, self.colors, self.opacity, LOGO_SCALE, self._logo_transform)
+
+
+    def _logo_transform(self):
+        """Open the logo and apply the color, size and opacity transformations."""
+
         logging.info(f'Transforming the logo in directory: {self.path_logo}')
-        
-        self.logo = Image.open(self.path_logo).convert("RGBA")
-        self.logo = self.img_color(self.logo)
-        self.logo = self.img_resize(self.logo)
-        self.logo = self.img_opacity(self.logo)
-        
+
+        logo = Image.open(self.path_logo).convert("RGBA")
+        logo = self.img_color(logo)
+        logo = self.img_resize(logo)
+        logo = self.img_opacity(logo)
+
         logging.info('Transformation of the logo done.')
 
+        return logo
+
+
+    def img_downscale(self, image):
+        """
+        Fit the image in encoder.max_dimension, before the watermark is added.
+
+        For a JPEG, draft() makes the decoder scale the image by 1/2, 1/4 or 1/8 in the DCT domain, so the full
+        resolution is never decoded. The other formats are decoded, then reduce() shrinks them by an integer factor.
+        Both stop at REDUCING_GAP times the output size, and a LANCZOS resize gives the final size.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            Image just opened, not loaded yet.
+
+        Returns
+        -------
+        image : PIL.Image
+            Image fitting in max_dimension x max_dimension, or the image unchanged.
+
+        """
+
+        max_dimension = self.encoder.max_dimension
+
+        if not max_dimension or max(image.size) <= max_dimension:
+            return image
+
+        logging.info(f'Downscaling the image from {image.size} to fit in {max_dimension} pixels...')
+
+        # thumbnail() calls draft() then reduce() before the resize, and keeps the aspect ratio.
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+        logging.info(f'Downscaling done: {image.size}.')
+
+        return image
+
+
+    def img_fit(self, image, fp):
+        """
+        Decode an image just opened, routed by its number of pixels read from the file header.
+
+        Images up to MAX_DECODE_PIXELS are decoded at full resolution and fitted in max_dimension by img_downscale().
+        Larger images are decoded in bounded memory by load_bounded(), downscaled to fit in PIXEL_BUDGET.
+        The pixels are then turned upright following the EXIF Orientation of the file, so that the logo is upright
+        and centred on the image as it is displayed: img_encode() writes an Orientation of 1.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            Image just opened, not loaded yet.
+        fp : String or file object
+            The file the image was opened from.
+
+        Returns
+        -------
+        image : PIL.Image
+            Decoded image.
+
+        """
+
+        # Read from the header: the image decoded in bounded memory has no EXIF.
+        self.orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+
+        with span('decode', format=image.format, mode=image.mode, width=image.width, height=image.height) as decode:
+            if route(image) == BOUNDED:
+                image = load_bounded(fp, image, self.encoder.max_dimension)
+            else:
+                image = self.img_downscale(image)
+
+            # Decoded here rather than on the first access to the pixels, so that the time is counted in this step.
+            image.load()
+
+            if self.orientation in ORIENTATIONS:
+                image = image.transpose(ORIENTATIONS[self.orientation])
+                decode.set(orientation=self.orientation)
+
+            decode.set(decoded_width=image.width, decoded_height=image.height)
+
+        return image
+
+
+    def add_logo(self, image):
+        """
+        Paste the prepared logo at the center of an image.
+
+        The image stays in its own mode: only the rectangle under the logo is converted to RGBA,
+        alpha-composited with the logo and pasted back, so no RGBA copy of the whole image is made.
+        A CMYK image does not survive that round trip through RGBA, so the logo is converted to CMYK instead,
+        and pasted through its alpha.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            Image where the watermark needs to be added.
+
+        Returns
+        -------
+        image : PIL.Image
+            Image with the watermark, in the mode of the original (RGB or RGBA for the modes not in NATIVE_MODES).
+
+        """
+
+        with span('logo'):
+            self.logo_prep()
+
+        with span('composite'):
+            return self._composite(image)
+
+
+    def _composite(self, image):
+        if image.mode not in NATIVE_MODES:
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+        width1, height1 = image.size
+        width2, height2 = self.logo.size
+
+        center_x, center_y = (width1//2), (height1//2)
+
+        im2_x = int(center_x - (width2/2))
+        im2_y = int(center_y - (height2/2))
+
+        # Part of the image covered by the logo, and the matching part of the logo when it is larger than the image.
+        box = (max(im2_x, 0), max(im2_y, 0), min(im2_x + width2, width1), min(im2_y + height2, height1))
+
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return image
+
+        logo = self.logo.crop((box[0] - im2_x, box[1] - im2_y, box[2] - im2_x, box[3] - im2_y))
+
+        if image.mode == 'CMYK':
+            # CMYK -> RGBA -> CMYK changes every pixel: the pixels under the transparent parts of the logo must stay as they are.
+            image.paste(logo.convert('CMYK'), box[:2], logo.getchannel('A'))
+            return image
+
+        region = Image.alpha_composite(image.crop(box).convert("RGBA"), logo)
+        image.paste(region.convert(image.mode), box[:2])
+
+        return image
+
+
+    def img_encode(self, image, source, fp):
+        """
+        Encode the watermarked image with the encoder settings, keeping the metadata of the original.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            Watermarked image.
+        source : PIL.Image
+            Original image, for its format, EXIF and ICC profile.
+        fp : String or file object
+            Destination of the encoded image.
+
+        Returns
+        -------
+        output_format : OutputFormat
+            Format of the encoded image, also kept in self.output_format.
+
+        """
+
+        exif = source.info.get('exif')
+
+        if exif and self.orientation != 1:
+            # The pixels were turned upright by img_fit(): the viewers must not rotate them again.
+            upright = Image.Exif()
+            upright.load(exif)
+            upright[ExifTags.Base.Orientation] = 1
+            exif = upright.tobytes()
+
+        with span('encode', mode=image.mode) as encoding:
+            self.output_format = encode(image, fp, self.encoder, source.format, exif, source.info.get('icc_profile'))
+            encoding.set(format=self.output_format.pil_format)
+
+            if hasattr(fp, 'tell'):
+                encoding.set(bytes=fp.tell())
+
+        return self.output_format
+
+
+    def img_watermark_buffer(self, buffer):
+        """
+        Add a watermark to an image held in memory.
+
+        Parameters
+        ----------
+        buffer : bytes or file object
+            Content of the image where the watermark needs to be added.
+
+        Returns
+        -------
+        output : io.BytesIO
+            Watermarked image encoded in self.output_format, positioned at the start.
+
+        """
+
+        register_heif_opener()
+
+        logging.info(f'Adding the watermark on buffer: {self.file}')
+
+        if isinstance(buffer, (bytes, bytearray, memoryview)):
+            buffer = io.BytesIO(buffer)
+
+        source = open_image(buffer)
+
+        # Images above the pixel budget are processed a few at a time, over all the processes.
+        with large_image_slot(source):
+            image = self.add_logo(self.img_fit(source, buffer))
+
+            output = io.BytesIO()
+            self.img_encode(image, source, output)
+            output.seek(0)
+
+        logging.info(f'Watermark added successfully on buffer {self.file}.')
+
+        return output
+
 
     def img_watermark(self):
         """
@@ -168,32 +422,27 @@ class Watermark():
 
         Returns
         -------
-        None.
+        file_mrkd : String
+            Path of the watermarked file, with the extension of self.output_format.
 
         """
-        
+
         register_heif_opener()
-        
-        logging.info(f'Adding the watermark on file: {self.file}')
 
-        image = Image.open(self.path).convert("RGBA")
-        self.logo_prep()
-        
-        width1, height1 = image.size
-        width2, height2 = self.logo.size
+        logging.info(f'Adding the watermark on file: {self.file}')
 
-        center_x, center_y = (width1//2), (height1//2)
+        source = open_image(self.path)
 
-        im2_x = int(center_x - (width2/2))
-        im2_y = int(center_y - (height2/2))
+        file = os.path.splitext(self.file)[0]
 
-        image.paste(self.logo, (im2_x, im2_y), self.logo)
-            
-        file = self.file.split('.')[0]
-        path = self.path.rsplit('/', 1)[0]
+        # Next to the source, named after its whole path: two sources of the same name never share an output.
+        extension = output_format(self.encoder, source.format).extension
+        file_mrkd = f'{os.path.splitext(self.path)[0]}_mrkd.{extension}'
 
-        file_mrkd = f'{path}/{file}_mrkd.png'
-        image.save(file_mrkd, 'PNG')
+        # Images above the pixel budget are processed a few at a time, over all the processes.
+        with large_image_slot(source):
+            image = self.add_logo(self.img_fit(source, self.path))
+            self.img_encode(image, source, file_mrkd)
         
         logging.info(f'Watermark added successfully on file {self.file}.')
         logging.info(f'New file saved as {file}.')
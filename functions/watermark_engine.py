@@ -0,0 +1,307 @@
+import io
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from functions.large_image import LARGE_IMAGE_SLOTS, set_large_image_slots
+from functions.tracing import start_trace
+from functions.watermark import Watermark
+
+
+def available_cpus() -> int:
+    """
+    CPUs the process can use: its CPU affinity, capped by the CPU quota of its cgroup (container limits,
+    e.g. Cloud Run), which os.cpu_count() ignores.
+    """
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" without limit.
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()
+            if limit != 'max':
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means no limit.
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as g:
+                limit, period = int(f.read()), int(g.read())
+                if limit > 0:
+                    quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+
+    return cpus
+
+
+class SharedBuffer(io.RawIOBase):
+    def __init__(self, shm, size, unlink=False):
+        """
+        Read-only file object over the first bytes of a shared-memory block: the block is read in place,
+        each read() copies the bytes asked for only.
+
+        Parameters
+        ----------
+        shm : SharedMemory
+            Block holding the content.
+        size : Integer
+            Size of the content, the block can be larger.
+        unlink : Boolean, optional
+            Unlink the block when the file is closed, for the owner of the block. The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.shm = shm
+        self.size = size
+        self.unlink = unlink
+
+        self._view = shm.buf[:size]
+        self._position = 0
+
+
+    def readable(self) -> bool:
+        return True
+
+
+    def seekable(self) -> bool:
+        return True
+
+
+    def read(self, size=-1) -> bytes:
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        data = bytes(self._view[self._position:end])
+        self._position = max(self._position, end)
+        return data
+
+
+    def readinto(self, buffer) -> int:
+        with memoryview(buffer).cast('B') as target:
+            size = max(0, min(target.nbytes, self.size - self._position))
+            target[:size] = self._view[self._position:self._position + size]
+
+        self._position += size
+        return size
+
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+
+    def tell(self) -> int:
+        return self._position
+
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            self.shm.close()
+
+            if self.unlink:
+                self.shm.unlink()
+
+        super().close()
+
+
+def _watermark_path(path, path_logo, colors, opacity, encoder) -> tuple:
+    """Worker: watermark an image on disk and return the path of the watermarked file, its format and the trace of the steps."""
+
+    with start_trace('process') as trace:
+        wtmrk = Watermark(path=path, path_logo=path_logo, colors=colors, opacity=opacity, encoder=encoder)
+        file_mrkd = wtmrk.img_watermark()
+
+    return file_mrkd, wtmrk.output_format, trace.record() if trace else None
+
+
+def _watermark_shared(shm_name, size, name, path_logo, colors, opacity, encoder) -> tuple:
+    """
+    Worker: watermark an image held in a shared-memory block. The encoded result is written to a new block, handed over
+    to the parent process: return (block, size of the result), its format and the trace of the steps.
+    """
+
+    # The block belongs to the parent process, which unlinks it once the result is back.
+    with SharedBuffer(shared_memory.SharedMemory(name=shm_name), size) as source:
+        with start_trace('process') as trace:
+            wtmrk = Watermark(path=name, path_logo=path_logo, colors=colors, opacity=opacity, encoder=encoder)
+            output = wtmrk.img_watermark_buffer(source)
+
+    # Copied once into the block, instead of being pickled to the parent. The block is attached again by the parent.
+    content = output.getbuffer()
+    result = shared_memory.SharedMemory(create=True, size=max(content.nbytes, 1))
+    result.buf[:content.nbytes] = content
+    size = content.nbytes
+
+    content.release()
+    result.close()
+
+    return (result, size), wtmrk.output_format, trace.record() if trace else None
+
+
+class WatermarkEngine():
+    def __init__(self, path_logo, max_workers=None):
+        """
+        Run the watermark compositing in a pool of processes, to use every CPU core.
+
+        Parameters
+        ----------
+        path_logo : String
+            Path to the logo used as watermark.
+        max_workers : Integer, optional
+            Number of processes. The default is the WATERMARK_WORKERS environment variable, or the CPUs available to the container.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.path_logo = path_logo
+        self.max_workers = max_workers or int(os.getenv('WATERMARK_WORKERS', available_cpus()))
+
+        # 'spawn' avoids forking a process that holds the locks of the webhook threads.
+        context = multiprocessing.get_context(os.getenv('WATERMARK_START_METHOD', 'spawn'))
+
+        # Shared by the processes, so that the images above the pixel budget are processed a few at a time.
+        self._large_image_slots = context.BoundedSemaphore(LARGE_IMAGE_SLOTS)
+
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                             initializer=set_large_image_slots, initargs=(self._large_image_slots,))
+
+        logging.info(f"Watermark engine started with {self.max_workers} processes.")
+
+
+    def submit(self, item, colors=(255, 255, 255), opacity=100, name='buffer', encoder=None, size=None):
+        """
+        Watermark one image in the pool, encoded following encoder (EncoderSettings).
+
+        A path (String) gives a future with the path of the watermarked file, its OutputFormat and the trace of the steps.
+        Bytes, or a file object of size bytes read from its current position, are passed to the worker through shared memory
+        and give a future with a SharedBuffer of the watermarked image, to close once read, its OutputFormat and the trace
+        of the steps. The trace is the record() of a Span, None when the tracing is disabled.
+        """
+
+        if isinstance(item, str):
+            return self._executor.submit(_watermark_path, item, self.path_logo, colors, opacity, encoder)
+
+        if hasattr(item, 'readinto'):
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+            try:
+                # Read straight into the block.
+                with shm.buf[:size] as view:
+                    filled = 0
+                    while filled < size:
+                        read = item.readinto(view[filled:])
+                        if not read:
+                            raise ValueError(f"File of {name} ended after {filled} bytes, {size} expected.")
+                        filled += read
+            except Exception:
+                shm.close()
+                shm.unlink()
+                raise
+        else:
+            data = memoryview(item)
+            size = data.nbytes
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            shm.buf[:size] = data.cast('B')
+
+        future = self._executor.submit(_watermark_shared, shm.name, size, name, self.path_logo, colors, opacity, encoder)
+        result = Future()
+
+        def done(future):
+            shm.close()
+            shm.unlink()
+
+            try:
+                (output, output_size), output_format, steps = future.result()
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result((SharedBuffer(output, output_size, unlink=True), output_format, steps))
+
+        future.add_done_callback(done)
+        return result
+
+
+    def watermark(self, items, colors=(255, 255, 255), opacity=100, encoder=None) -> list:
+        """
+        Watermark several images in parallel.
+        Return the results of submit() in the order of the items, with None for the images that failed.
+        """
+
+        futures = [self.submit(item, colors, opacity, encoder=encoder) for item in items]
+        results = []
+
+        for item, future in zip(items, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                label = item if isinstance(item, str) else f"buffer of {len(item)} bytes"
+                logging.error(f"Error when adding the watermark on {label}: {e}", exc_info=True)
+                results.append(None)
+
+        return results
+
+
+    def pids(self) -> list:
+        """PIDs of the processes of the pool started so far."""
+
+        # ProcessPoolExecutor keeps its processes in a private dict, None once shut down.
+        return list(self._executor._processes or ())
+
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_watermark_engine() -> WatermarkEngine:
+    """Return the process-wide watermark engine, created on first use."""
+
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = WatermarkEngine(os.getenv('LOGO_PATH'))
+
+    return _engine
+
+
+def shutdown_watermark_engine(wait=True):
+    """Stop the processes of the watermark engine, if it was started. A later get_watermark_engine() starts a new one."""
+
+    global _engine
+
+    with _engine_lock:
+        engine, _engine = _engine, None
+
+    if engine is not None:
+        engine.shutdown(wait=wait)
+        logging.info("Watermark engine stopped.")
+
+
+def watermark_engine_pids() -> list:
+    """PIDs of the processes of the watermark engine, without starting it."""
+
+    engine = _engine
+    return engine.pids() if engine is not None else []
@@ -1,16 +1,23 @@
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import build_http
 import uuid
 import json
 import os
 from dotenv import load_dotenv
 import logging
 import datetime
+import threading
 import time
+from contextlib import contextmanager
 import firebase_admin
 from firebase_admin import firestore
+from functions.drive_discovery import LazyDriveService, bundle_available, with_endpoint
+from functions.metrics import MeteredHttp
 
 SCOPES = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/drive.readonly']
 
@@ -19,6 +26,9 @@ DRIVE_SHARED_ID = None
 
 load_dotenv()
 
+# Root URL of the Drive API, to run against a local stand-in (see local_harness). The default is the Google endpoint.
+DRIVE_API_ENDPOINT = os.getenv('DRIVE_API_ENDPOINT')
+
 try:
     firebase_admin.initialize_app()
 except ValueError:
@@ -48,50 +58,231 @@ def load_credentials():
     return creds
 
 
-def get_drive_service():
-    
-    logging.info("Initialisation of Google Drive service for the receiver.")
+def authorize_credentials(creds):
+    """Refresh the credentials, or run the authentication flow if they cannot be refreshed, and save them to Firestore."""
 
-    try:
-        credentials = load_credentials()
-    except Exception as e:
-        logging.info(f"Could not load credentials: {e}")
-        credentials = None
+    if creds and creds.refresh_token:
+        logging.info("Credentials have expired. Refreshing token...")
+        try:
+            creds.refresh(Request())
+        except Exception as e:
+            logging.info(f"Error refreshing token: {e}")
+            logging.info("Re-authentication is required.")
+            # Fallback to re-authentication
+            flow = InstalledAppFlow.from_client_secrets_file(os.getenv('SERCRET_FILE_PATH'), SCOPES)
+            creds = flow.run_local_server(port=0)
+    else:
+        logging.info("No valid credentials found. Starting authentication flow...")
+        # This will open a browser window for the user to grant consent.
+        flow = InstalledAppFlow.from_client_secrets_file(os.getenv('SERCRET_FILE_PATH'), SCOPES)
+        creds = flow.run_local_server(port=0)
 
-    # The file token.json stores the user's access and refresh tokens.
-    try:
-        creds = Credentials.from_authorized_user_info(credentials, SCOPES)
-    except Exception as e:
-        logging.info(f"Error loading credentials: {e} - {credentials}")
-        return None
+    creds_to_upload = json.loads(creds.to_json())
+
+    db.collection("credentials").document("user_credentials").set(creds_to_upload)
+    logging.info(f"Credentials saved to Firestore.")
+
+    return creds
+
+
+class DriveServiceFactory():
+    def __init__(self, refresh_margin=None, pool_size=None):
+        """
+        Process-wide, thread-safe factory of Google Drive services.
+
+        The credentials and the parsed discovery document are shared by every thread, and the credentials are
+        refreshed only when they are about to expire. A service is never used by two threads at once, as the HTTP
+        transport of httplib2 is not thread-safe: long-lived threads keep their own service (get()), and the threads
+        created for each handler run (pipeline stages, change feed prefetch) borrow one from a pool (checkout()),
+        so the clients and their open connections outlive these threads.
+
+        Parameters
+        ----------
+        refresh_margin : Integer, optional
+            Seconds before expiry when the credentials are refreshed. The default is the CREDENTIALS_REFRESH_MARGIN environment variable, or 300.
+        pool_size : Integer, optional
+            Number of idle services kept in the pool. The default is the DRIVE_SERVICE_POOL_SIZE environment variable, or 32.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.refresh_margin = refresh_margin or int(os.getenv('CREDENTIALS_REFRESH_MARGIN', 300))
+        self.pool_size = pool_size or int(os.getenv('DRIVE_SERVICE_POOL_SIZE', 32))
+
+        self._creds = None
+        self._document = None
+        self._local = threading.local()
+        self._pool = []  # (service, credentials) of the idle services, the most recently returned last
+        self._lock = threading.Lock()
+
+        self.stats = {'service hits': 0, 'service misses': 0, 'credentials loads': 0, 'credentials refreshes': 0, 'discovery loads': 0}
+
+
+    def _credentials_usable(self) -> bool:
+        if not self._creds or not self._creds.token:
+            return False
+
+        if self._creds.expiry is None:
+            return True
+
+        remaining = self._creds.expiry - datetime.datetime.utcnow()
+        return remaining.total_seconds() > self.refresh_margin
+
+
+    def get_credentials(self):
+        """Return the shared credentials, loaded from Firestore once and refreshed only near expiry."""
+
+        with self._lock:
+            if self._credentials_usable():
+                return self._creds
+
+            if self._creds is None:
+                try:
+                    credentials = load_credentials()
+                except Exception as e:
+                    logging.info(f"Could not load credentials: {e}")
+                    credentials = None
+
+                # The file token.json stores the user's access and refresh tokens.
+                try:
+                    self._creds = Credentials.from_authorized_user_info(credentials, SCOPES)
+                except Exception as e:
+                    logging.info(f"Error loading credentials: {e} - {credentials}")
+                    return None
+
+                self.stats['credentials loads'] += 1
+
+                if self._credentials_usable():
+                    return self._creds
+
+            # If there are no (valid) credentials available, let the user log in.
+            self._creds = authorize_credentials(self._creds)
+            self.stats['credentials refreshes'] += 1
+
+            return self._creds
+
+
+    def get_document(self, creds):
+        """Return the parsed Drive v3 discovery document, loaded once for the process."""
+
+        with self._lock:
+            if self._document is None:
+                document = discovery_cache.get_static_doc('drive', 'v3')
+
+                if document:
+                    self._document = json.loads(document)
+                else:
+                    logging.info("No static discovery document for Drive v3, fetching it.")
+                    self._document = build('drive', 'v3', credentials=creds, static_discovery=False, cache_discovery=False)._rootDesc
+
+                self.stats['discovery loads'] += 1
+
+            return self._document
 
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            logging.info("Credentials have expired. Refreshing token...")
-            try:
-                creds.refresh(Request())
-            except Exception as e:
-                logging.info(f"Error refreshing token: {e}")
-                logging.info("Re-authentication is required.")
-                # Fallback to re-authentication
-                flow = InstalledAppFlow.from_client_secrets_file(os.getenv('SERCRET_FILE_PATH'), SCOPES)
-                creds = flow.run_local_server(port=0)
+
+    def build(self, creds):
+        """Build a Drive service, with its own HTTP transport, from the shared document and credentials."""
+
+        client_options = {'api_endpoint': DRIVE_API_ENDPOINT} if DRIVE_API_ENDPOINT else None
+
+        # Every request of the client is counted by API method and status in the /metrics endpoint.
+        http = MeteredHttp(AuthorizedHttp(creds, http=build_http()))
+
+        if bundle_available():
+            # Resources built lazily from the bundled documents: no network access and no full document to process.
+            service = LazyDriveService(http, client_options=client_options)
         else:
-            logging.info("No valid credentials found. Starting authentication flow...")
-            # This will open a browser window for the user to grant consent.
-            flow = InstalledAppFlow.from_client_secrets_file(os.getenv('SERCRET_FILE_PATH'), SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        creds_to_upload = json.loads(creds.to_json())
+            document = with_endpoint(self.get_document(creds), DRIVE_API_ENDPOINT) if DRIVE_API_ENDPOINT else self.get_document(creds)
+            service = build_from_document(document, http=http, client_options=client_options)
 
-        db.collection("credentials").document("user_credentials").set(creds_to_upload)
-        logging.info(f"Credentials saved to Firestore.")
+        return service
 
-    drive_service_receiver = build('drive', 'v3', credentials=creds)
 
-    return drive_service_receiver
-    
+    def get(self):
+        """Return the Drive service of the current thread. For long-lived threads: a thread created per run should use checkout()."""
+
+        creds = self.get_credentials()
+
+        if creds is None:
+            return None
+
+        service = getattr(self._local, 'service', None)
+
+        if service is not None and self._local.creds is creds:
+            self.stats['service hits'] += 1
+            return service
+
+        self.stats['service misses'] += 1
+
+        service = self.build(creds)
+
+        self._local.service = service
+        self._local.creds = creds
+
+        return service
+
+
+    @contextmanager
+    def checkout(self):
+        """Lend a Drive service of the pool for the block, or a new one if none is idle. None without credentials."""
+
+        creds = self.get_credentials()
+
+        if creds is None:
+            yield None
+            return
+
+        service = None
+
+        with self._lock:
+            while self._pool:
+                pooled, pooled_creds = self._pool.pop()
+
+                # Services of older credentials are dropped.
+                if pooled_creds is creds:
+                    service = pooled
+                    break
+
+            self.stats['service hits' if service is not None else 'service misses'] += 1
+
+        if service is None:
+            service = self.build(creds)
+
+        try:
+            yield service
+        finally:
+            with self._lock:
+                if len(self._pool) < self.pool_size:
+                    self._pool.append((service, creds))
+
+
+    def hit_rates(self) -> dict:
+        """Cache statistics of the factory."""
+
+        stats = dict(self.stats)
+        calls = stats['service hits'] + stats['service misses']
+        stats['service hit rate'] = stats['service hits'] / calls if calls else 0
+        return stats
+
+
+drive_service_factory = DriveServiceFactory()
+
+
+def get_drive_service():
+
+    logging.info("Initialisation of Google Drive service for the receiver.")
+
+    return drive_service_factory.get()
+
+
+def checkout_drive_service():
+    """Drive service borrowed from the pool of the factory for a with block, in the threads created per handler run."""
+
+    return drive_service_factory.checkout()
+
 
 def create_drive_changes_webhook_channel(service, webhook_url, start_page_token, channel_token=None, drive_id=None) -> dict:
     """Create a webhook channel for Drive changes."""
@@ -1,6 +1,9 @@
 import firebase_admin
 from firebase_admin import firestore
 import logging
+import os
+import threading
+from functions.metrics import firestore_seconds
 
 try:
     firebase_admin.initialize_app()
@@ -10,25 +13,181 @@ except ValueError:
 db = firestore.client()
 
 
-def sync_check(message_number, collection_name, document_name, dict_name):
+class MessageNumberTracker():
+    def __init__(self, collection_name, dict_name, flush_interval=None):
+        """
+        High-water mark of the message numbers received per channel, kept in memory.
 
-    message_number = int(message_number)
+        The check of a message is a compare-and-set under a lock, with no database call on the request path.
+        The new high-water marks are written to Firestore by a background thread, in a transaction keeping the
+        highest of the stored and local numbers, as several processes (gunicorn workers, Cloud Run instances)
+        share the documents: a higher number stored by another process becomes the local mark. The marks are
+        read back from Firestore when the tracker is created (at startup).
+
+        Parameters
+        ----------
+        collection_name : String
+            Firestore collection holding one document per channel.
+        dict_name : String
+            Field of the document holding the last message number.
+        flush_interval : Float, optional
+            Seconds between two flushes to Firestore. The default is the SYNC_FLUSH_INTERVAL environment variable, or 1.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.collection_name = collection_name
+        self.dict_name = dict_name
+        self.flush_interval = flush_interval or float(os.getenv('SYNC_FLUSH_INTERVAL', 1))
+
+        self._last = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self.rehydrate()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name=f"flush-{collection_name}", daemon=True)
+        self._thread.start()
+
+
+    def rehydrate(self):
+        """Load the last message number of every channel from Firestore."""
+
+        try:
+            for doc in db.collection(self.collection_name).stream():
+                try:
+                    self._last[doc.id] = int(doc.to_dict()[self.dict_name])
+                except Exception:
+                    continue
+        except Exception as e:
+            logging.error(f"{self.collection_name} - Could not load the last message numbers from Firestore: {e}", exc_info=True)
+
+        logging.info(f"{self.collection_name} - Last message numbers loaded for {len(self._last)} channels.")
+
+
+    def check(self, document_name, message_number) -> bool:
+        """Return True if the message was already processed, else record it as the last one."""
+
+        with self._lock:
+            last_message_number = self._last.get(document_name, 0)
+
+            if message_number < last_message_number:
+                return True
+
+            self._last[document_name] = message_number
+            self._dirty.add(document_name)
+            return False
+
+
+    def flush(self):
+        """
+        Write the high-water marks changed since the last flush to Firestore, in one transaction that never lowers
+        a stored number, and take the higher numbers stored by other processes.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                dirty = {name: self._last[name] for name in self._dirty}
+                self._dirty.clear()
+
+            if not dirty:
+                return
+
+            refs = {name: db.collection(self.collection_name).document(name) for name in dirty}
+
+            @firestore.transactional
+            def save(transaction) -> dict:
+                stored = {}
+
+                # Every read of a transaction comes before its writes.
+                for name, reference in refs.items():
+                    snapshot = reference.get(transaction=transaction)
+
+                    try:
+                        stored[name] = int(snapshot.to_dict()[self.dict_name])
+                    except Exception:
+                        stored[name] = 0
+
+                for name, message_number in dirty.items():
+                    if message_number > stored[name]:
+                        transaction.set(refs[name], {self.dict_name: message_number})
 
-    last_message_info = db.collection(collection_name).document(document_name)
+                return stored
 
-    try:
-        last_message_number = int(last_message_info.get().to_dict()[dict_name])
-    except Exception:
-        last_message_number = 0
+            try:
+                with firestore_seconds.time(operation='tracker_flush'):
+                    stored = save(db.transaction())
+            except Exception as e:
+                logging.error(f"{self.collection_name} - Error when saving the last message numbers: {e}", exc_info=True)
 
-    if message_number < last_message_number:
+                with self._lock:
+                    self._dirty.update(dirty)
+                return
+
+            with self._lock:
+                for name, message_number in stored.items():
+                    if message_number > self._last.get(name, 0):
+                        self._last[name] = message_number
+
+            logging.info(f"{self.collection_name} - Last message numbers saved for {len(dirty)} channels.")
+
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+    def stop(self):
+        """Stop the background flush, after a last flush."""
+
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(collection_name, dict_name) -> MessageNumberTracker:
+    """Return the process-wide tracker of a collection, created (and rehydrated) on first use."""
+
+    with _trackers_lock:
+        tracker = _trackers.get((collection_name, dict_name))
+
+        if tracker is None:
+            tracker = MessageNumberTracker(collection_name, dict_name)
+            _trackers[(collection_name, dict_name)] = tracker
+
+    return tracker
+
+
+def stop_trackers():
+    """Stop the trackers of the process, after a last flush of their message numbers to Firestore."""
+
+    with _trackers_lock:
+        trackers = list(_trackers.values())
+
+    for tracker in trackers:
+        tracker.stop()
+
+
+def sync_check(message_number, collection_name, document_name, dict_name):
+
+    message_number = int(message_number)
+
+    if get_tracker(collection_name, dict_name).check(document_name, message_number):
         logging.error(f"{collection_name} - Message number {message_number} has already been processed. Ignoring duplicate.")
         return True
     else:
-        last_message_info.set({dict_name: message_number})
         logging.info(f"{collection_name} - Message number {message_number} recorded as last processed message.")
         return False
-    
-    
+
+
 if __name__ == "__main__":
-    sync_check(1)
\ No newline at end of file
+    sync_check(1)
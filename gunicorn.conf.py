@@ -0,0 +1,42 @@
+"""
+Production server of the webhook service: gunicorn --config gunicorn.conf.py main:app
+
+The application is imported once by the master (preload_app) and shared by the forked workers. The background
+work of a worker (job scheduler, message number trackers) is started after the fork, and drained when it exits:
+on SIGTERM, Cloud Run gives the container 10 seconds before killing it.
+"""
+
+import math
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+
+# One process by default: the queue of jobs, the claims of the files in progress and the message numbers are held in
+# memory by each process. The CPUs are used by the watermark engine, whose processes are sized to the container.
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+
+# Threads answering the notifications: a request only queues a job, the handler runs on the scheduler workers.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+preload_app = True
+
+# Cloud Run sets the request timeout: gunicorn never kills a busy worker itself.
+timeout = 0
+
+# Time given to a worker to drain after SIGTERM, before the master kills it. A bit more than main.DRAIN_TIMEOUT.
+graceful_timeout = math.ceil(float(os.getenv('DRAIN_TIMEOUT', 8))) + 1
+
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+
+
+def post_fork(server, worker):
+    import main
+    main.startup()
+
+
+def worker_exit(server, worker):
+    import main
+    main.shutdown()
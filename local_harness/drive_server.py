@@ -0,0 +1,212 @@
+"""
+Fake Google Drive REST server, to run the webhook service end to end without a Google account.
+
+It serves a FakeDrive over HTTP (changes.list, changes.getStartPageToken, changes.watch, channels.stop,
+files.list, files.get with alt=media and the resumable files.create), with an added latency and random errors.
+The settings folder is seeded with a settings.json and a logo.png.
+
+Harness endpoints, used by the load generator:
+    POST /_harness/files?count=10&format=jpeg&size=1280x960    add images to the watched folder
+    GET  /_harness/stats                                        requests by API method and status, files uploaded
+
+Run from the root of the repository:
+    python -m local_harness.drive_server --port 8081 --latency-ms 40 --jitter-ms 20 --error-rate 0.01
+The service then uses DRIVE_API_ENDPOINT=http://127.0.0.1:8081/drive/v3/ (see local_harness.serve).
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from benchmarks.pipeline_bench import MIME_TYPES, make_input
+from functions.metrics import drive_method
+from local_harness.fake_drive import FakeDrive
+
+WATCHED_FOLDER = 'watched-folder'
+RESULT_FOLDER = 'result-folder'
+SETTINGS_FOLDER = 'settings-folder'
+
+
+def seed_settings(drive):
+    """Put a settings.json and a logo.png in the settings folder."""
+
+    settings = json.dumps({'colors': '(255, 255, 255)', 'opacity': 50, 'output': {'format': 'jpeg', 'quality': 85}}).encode('utf-8')
+    drive.add_file('settings.json', settings, [SETTINGS_FOLDER], 'application/json', record_change=False)
+
+    logo = Image.new('RGBA', (800, 400), (0, 0, 0, 0))
+    logo.paste((0, 0, 0, 255), (100, 100, 700, 300))
+    output = io.BytesIO()
+    logo.save(output, 'PNG')
+    drive.add_file('logo.png', output.getvalue(), [SETTINGS_FOLDER], 'image/png', record_change=False)
+
+
+class DriveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, error_methods=None):
+        """
+        HTTP server of a FakeDrive.
+
+        Parameters
+        ----------
+        address : Tuple
+            (host, port) to listen on.
+        latency : Float, optional
+            Seconds added to every API request. The default is 0.
+        jitter : Float, optional
+            Random extra seconds, from 0 to jitter, added to every API request. The default is 0.
+        error_rate : Float, optional
+            Share of the API requests answered with error_status. The default is 0.
+        error_status : Integer, optional
+            Status of the injected errors. The default is 503.
+        error_methods : List, optional
+            API methods the errors are injected in (e.g. ['files.get_media']). The default is all of them.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        super().__init__(address, DriveRequestHandler)
+
+        self.drive = FakeDrive(root_url=f"http://{address[0]}:{self.server_address[1]}/")
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_methods = set(error_methods or [])
+
+        self.requests = Counter()
+        self._images = {}
+        self._lock = threading.Lock()
+
+        seed_settings(self.drive)
+
+
+    def add_images(self, count, image_format='jpeg', size=(1280, 960)) -> list:
+        """Add count images to the watched folder, each one a change of the feed."""
+
+        key = (image_format, size)
+
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = make_input(image_format, size)
+
+        content = self._images[key]
+        start = len(self.drive.files)
+
+        return [self.drive.add_file(f"harness_{start + i}.{image_format}", content, [WATCHED_FOLDER], MIME_TYPES[image_format])
+                for i in range(count)]
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = {f"{method} {status}": count for (method, status), count in sorted(self.requests.items())}
+
+        return {'requests': requests, 'files': len(self.drive.files), 'changes': len(self.drive.changes), 'uploads': len(self.drive.uploads)}
+
+
+class DriveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+    def _send(self, status, headers, content):
+        self.send_response(status)
+
+        for key, value in headers.items():
+            if key.lower() != 'content-length':
+                self.send_header(key, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        server = self.server
+
+        if parts.path.startswith('/_harness/'):
+            return self._harness(method, parts.path, query)
+
+        name = drive_method(method, self.path)
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        if server.error_rate and (not server.error_methods or name in server.error_methods) and random.random() < server.error_rate:
+            status, headers, content = server.drive.error(server.error_status, 'Injected error')
+        else:
+            status, headers, content = server.drive.handle(method, f"http://{self.headers.get('Host')}{self.path}", dict(self.headers), body)
+
+        with server._lock:
+            server.requests[(name, status)] += 1
+
+        self._send(status, headers, content)
+
+
+    def _harness(self, method, path, query):
+        server = self.server
+
+        if path == '/_harness/files' and method == 'POST':
+            size = tuple(int(param) for param in query.get('size', ['1280x960'])[0].split('x'))
+            file_ids = server.add_images(int(query.get('count', ['1'])[0]), query.get('format', ['jpeg'])[0], size)
+            return self._send(200, {'content-type': 'application/json'}, json.dumps({'files': file_ids}).encode('utf-8'))
+
+        if path == '/_harness/stats':
+            return self._send(200, {'content-type': 'application/json'}, json.dumps(server.stats()).encode('utf-8'))
+
+        self._send(404, {}, b'')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--error-methods', default='', help='Comma separated API methods, e.g. files.get_media,files.create. The default is all.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = DriveServer((args.host, args.port), args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate,
+                         args.error_status, [method for method in args.error_methods.split(',') if method])
+
+    logging.info(f"Fake Drive listening on http://{args.host}:{server.server_address[1]}/ - DRIVE_API_ENDPOINT=http://{args.host}:{server.server_address[1]}/drive/v3/")
+    server.serve_forever()
@@ -0,0 +1,244 @@
+"""
+In-process stand-in of the Google Drive v3 REST API, for the benchmarks and the local harness.
+
+FakeDrive keeps the files and the change feed in memory and answers the requests made by the handler:
+changes.list, changes.getStartPageToken, changes.watch, channels.stop, files.list, files.get with alt=media
+(with Range) and the resumable files.create. FakeDriveHttp plugs it into googleapiclient as an HttpMock, drive_server serves it over HTTP.
+"""
+
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+import httplib2
+from googleapiclient.http import HttpMock
+
+
+class FakeDrive():
+    def __init__(self, root_url='https://www.googleapis.com/'):
+        """
+        Files and change feed of a fake Google Drive account.
+
+        Parameters
+        ----------
+        root_url : String, optional
+            URL the requests are sent to, used for the resumable upload sessions.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.root_url = root_url.rstrip('/') + '/'
+
+        self.files = {}
+        self.changes = []
+        self.channels = {}
+        self.uploads = []
+
+        # Time of the first download and of the upload of each file, by file name stem, for the latencies.
+        self.events = {}
+
+        self._sessions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+
+    def add_file(self, name, content, parents, mime_type, record_change=True) -> str:
+        """Create a file, and a change in the change feed. Return the ID of the file."""
+
+        with self._lock:
+            file_id = f"file{next(self._ids)}"
+            self.files[file_id] = {
+                'id': file_id,
+                'name': name,
+                'parents': list(parents),
+                'mimeType': mime_type,
+                'trashed': False,
+                'size': str(len(content)),
+                'md5Checksum': hashlib.md5(content).hexdigest(),
+                'modifiedTime': datetime.now(timezone.utc).isoformat(),
+                'content': content,
+            }
+
+            if record_change:
+                self.changes.append(file_id)
+
+        return file_id
+
+
+    def metadata(self, file_id) -> dict:
+        return {key: value for key, value in self.files[file_id].items() if key != 'content'}
+
+
+    def handle(self, method, uri, headers=None, body=None) -> tuple:
+        """Answer a request. Return (status, headers, content)."""
+
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        parts = urlsplit(uri)
+        path = parts.path
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        if path.endswith('/changes/startPageToken'):
+            return self._json(200, {'startPageToken': str(len(self.changes))})
+
+        if path.endswith('/changes/watch'):
+            return self._watch(json.loads(body))
+
+        if path.endswith('/changes'):
+            return self._changes_list(query)
+
+        if path.endswith('/channels/stop'):
+            channel = json.loads(body)
+            if self.channels.pop(channel.get('id'), None) is None:
+                return self.error(404, f"Channel {channel.get('id')} not found")
+            return 204, {}, b''
+
+        if path.startswith('/upload/') and path.endswith('/files'):
+            return self._upload(method, query, headers, body)
+
+        match = re.search(r'/files/([^/]+)$', path)
+        if match and method == 'GET':
+            if query.get('alt') == 'media':
+                return self._download(match.group(1), headers)
+            if match.group(1) in self.files:
+                return self._json(200, self.metadata(match.group(1)))
+            return self.error(404, f"File not found: {match.group(1)}")
+
+        if path.endswith('/files') and method == 'GET':
+            return self._files_list(query)
+
+        return self.error(404, f"Not implemented in the fake Drive: {method} {path}")
+
+
+    def _json(self, status, content) -> tuple:
+        return status, {'content-type': 'application/json; charset=UTF-8'}, json.dumps(content).encode('utf-8')
+
+
+    def error(self, status, message) -> tuple:
+        return self._json(status, {'error': {'code': status, 'message': message, 'errors': [{'message': message}]}})
+
+
+    def _changes_list(self, query) -> tuple:
+        start = int(query.get('pageToken', 0))
+        page_size = int(query.get('pageSize', 100))
+
+        with self._lock:
+            file_ids = self.changes[start:start + page_size]
+            end = start + len(file_ids)
+            more = end < len(self.changes)
+
+        reply = {
+            'kind': 'drive#changeList',
+            'changes': [{'fileId': file_id, 'removed': False, 'file': self.metadata(file_id)} for file_id in file_ids],
+        }
+
+        if more:
+            reply['nextPageToken'] = str(end)
+        else:
+            reply['newStartPageToken'] = str(end)
+
+        return self._json(200, reply)
+
+
+    def _files_list(self, query) -> tuple:
+        q = query.get('q', '')
+        parents = re.findall(r"'([^']+)' in parents", q)
+        names = re.findall(r"name = '([^']+)'", q)
+
+        files = [self.metadata(file_id) for file_id, file in self.files.items()
+                 if (not parents or parents[0] in file['parents']) and (not names or file['name'] in names) and not file['trashed']]
+
+        files.sort(key=lambda file: file['modifiedTime'], reverse=True)
+
+        return self._json(200, {'files': files})
+
+
+    def _download(self, file_id, headers) -> tuple:
+        file = self.files.get(file_id)
+
+        if file is None:
+            return self.error(404, f"File not found: {file_id}")
+
+        with self._lock:
+            self.events.setdefault(file['name'].rsplit('.', 1)[0], {}).setdefault('download', time.perf_counter())
+
+        content = file['content']
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+
+        if not match:
+            return 200, {'content-length': str(len(content))}, content
+
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+
+        return 206, {'content-range': f"bytes {start}-{end}/{len(content)}", 'content-length': str(end - start + 1)}, content[start:end + 1]
+
+
+    def _upload(self, method, query, headers, body) -> tuple:
+        if query.get('uploadType') != 'resumable':
+            return self.error(400, 'Only resumable uploads are implemented in the fake Drive')
+
+        if 'upload_id' not in query:
+            # Start of the session: the body is the metadata of the file.
+            session = uuid.uuid4().hex
+            self._sessions[session] = {'metadata': json.loads(body or b'{}'), 'mime_type': headers.get('x-upload-content-type')}
+            location = f"{self.root_url}upload/drive/v3/files?uploadType=resumable&upload_id={session}"
+            return 200, {'location': location}, b''
+
+        session = self._sessions.pop(query['upload_id'], None)
+
+        if session is None:
+            return self.error(404, 'Upload session not found')
+
+        metadata = session['metadata']
+        file_id = self.add_file(metadata.get('name'), body or b'', metadata.get('parents', []), session['mime_type'], record_change=False)
+
+        with self._lock:
+            self.uploads.append(file_id)
+            stem = metadata.get('name', '').rsplit('.', 1)[0]
+            if stem.endswith('_mrkd'):
+                self.events.setdefault(stem[:-len('_mrkd')], {})['upload'] = time.perf_counter()
+
+        reply = self.metadata(file_id)
+        reply['webViewLink'] = f"https://drive.google.com/file/d/{file_id}/view"
+
+        return self._json(200, reply)
+
+
+    def _watch(self, body) -> tuple:
+        resource_id = f"resource{next(self._ids)}"
+        self.channels[body['id']] = dict(body, resourceId=resource_id)
+
+        return self._json(200, {'kind': 'api#channel', 'id': body['id'], 'resourceId': resource_id, 'expiration': body.get('expiration')})
+
+
+class FakeDriveHttp(HttpMock):
+    """httplib2.Http stand-in answering the requests of googleapiclient with a FakeDrive."""
+
+    def __init__(self, drive):
+        super().__init__(headers={'status': '200'})
+        self.drive = drive
+
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=1, connection_type=None):
+        self.uri = uri
+        self.method = method
+        self.body = body
+        self.headers = headers
+
+        if hasattr(body, 'read'):
+            body = body.read()
+
+        status, response_headers, content = self.drive.handle(method, uri, headers, body)
+
+        return httplib2.Response(dict(response_headers, status=str(status))), content
@@ -0,0 +1,277 @@
+"""
+In-memory stand-in of the Firestore client, for the benchmarks and the local harness.
+
+It implements the calls made by the functions package: collection().document() get/set/create/update/delete,
+collection().stream(), subcollections, batch(), get_all(), transaction() with @firestore.transactional, Increment,
+and queries with select(), where(filter=...), order_by(), start_after(snapshot) and limit().
+install() makes firestore.client() return it, and must run before the functions modules are imported.
+"""
+
+import copy
+import operator
+import threading
+from datetime import datetime, timezone
+import firebase_admin
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne, '>=': operator.ge, '>': operator.gt}
+
+
+def _resolve(value, current=None):
+    # Sentinels such as SERVER_TIMESTAMP and Increment are replaced by their value, as Firestore does on write.
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, firestore.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, dict):
+        return {key: _resolve(item) for key, item in value.items()}
+    return value
+
+
+def _merge(current, data) -> dict:
+    """Nested maps merged key by key, as set(merge=True) does."""
+
+    merged = dict(current or {})
+
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = _resolve(value, merged.get(key))
+
+    return merged
+
+
+class FakeSnapshot():
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument():
+    def __init__(self, db, collection, document_id):
+        self._db = db
+        self._collection = collection
+        self.id = document_id
+
+    @property
+    def _key(self):
+        return (self._collection, self.id)
+
+    def get(self, transaction=None):
+        with self._db.lock:
+            return FakeSnapshot(self, copy.deepcopy(self._db.data.get(self._key)))
+
+    def set(self, data, merge=False):
+        with self._db.lock:
+            current = self._db.data.get(self._key) if merge else None
+            self._db.data[self._key] = _merge(current, data)
+
+    def update(self, data):
+        with self._db.lock:
+            if self._key not in self._db.data:
+                raise NotFound(f"No document to update: {self._collection}/{self.id}")
+            self._db.data[self._key].update(_resolve(data))
+
+    def create(self, data):
+        with self._db.lock:
+            if self._key in self._db.data:
+                raise AlreadyExists(f"Document already exists: {self._collection}/{self.id}")
+            self._db.data[self._key] = _resolve(data)
+
+    def delete(self):
+        with self._db.lock:
+            self._db.data.pop(self._key, None)
+
+    def collection(self, name):
+        # Subcollection: a collection named after the path of the document.
+        return FakeCollection(self._db, f"{self._collection}/{self.id}/{name}")
+
+
+class FakeCollection():
+    def __init__(self, db, name):
+        self._db = db
+        self.id = name
+
+    def document(self, document_id=None):
+        return FakeDocument(self._db, self.id, document_id or f"doc{len(self._db.data)}")
+
+    def stream(self):
+        return FakeQuery(self).stream()
+
+    def select(self, field_paths):
+        return FakeQuery(self).select(field_paths)
+
+    def where(self, filter):
+        return FakeQuery(self).where(filter)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return FakeQuery(self).order_by(field, direction)
+
+    def limit(self, count):
+        return FakeQuery(self).limit(count)
+
+
+class FakeQuery():
+    """Query of a collection, evaluated on a copy of its documents when streamed."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._fields = None
+        self._filters = []
+        self._order = []
+        self._after = None
+        self._limit = None
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query._filters = list(self._filters)
+        query._order = list(self._order)
+        query.__dict__.update(changes)
+        return query
+
+    def select(self, field_paths):
+        # Field paths quoted with backticks (FieldPath.to_api_repr()) are unquoted.
+        return self._copy(_fields=[field.strip('`') for field in field_paths])
+
+    def where(self, filter):
+        return self._copy(_filters=self._filters + [(filter.field_path, OPERATORS[filter.op_string], filter.value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(_order=self._order + [(field, direction == 'DESCENDING')])
+
+    def start_after(self, snapshot):
+        return self._copy(_after=snapshot)
+
+    def limit(self, count):
+        return self._copy(_limit=count)
+
+    def stream(self):
+        db = self._collection._db
+
+        with db.lock:
+            items = [(key[1], copy.deepcopy(data)) for key, data in db.data.items() if key[0] == self._collection.id]
+
+        # Documents without an ordered or filtered field are left out, as Firestore does.
+        fields = {field for field, _, _ in self._filters} | {field for field, _ in self._order}
+        items = [(document_id, data) for document_id, data in items if all(field in data for field in fields)]
+        items = [(document_id, data) for document_id, data in items if all(compare(data[field], value) for field, compare, value in self._filters)]
+
+        # Stable sorts, from the last ordering to the first; the ID breaks the ties.
+        items.sort(key=lambda item: item[0], reverse=bool(self._order) and self._order[-1][1])
+        for field, descending in reversed(self._order):
+            items.sort(key=lambda item: item[1][field], reverse=descending)
+
+        if self._after is not None:
+            ids = [document_id for document_id, _ in items]
+            if self._after.id in ids:
+                items = items[ids.index(self._after.id) + 1:]
+
+        for document_id, data in items[:self._limit]:
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+
+            yield FakeSnapshot(self._collection.document(document_id), data)
+
+
+class FakeBatch():
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def set(self, reference, data, merge=False):
+        self._operations.append(('set', reference, data, merge))
+
+    def create(self, reference, data):
+        self._operations.append(('create', reference, data, None))
+
+    def update(self, reference, data):
+        self._operations.append(('update', reference, data, None))
+
+    def delete(self, reference):
+        self._operations.append(('delete', reference, None, None))
+
+    def commit(self):
+        # All or nothing, like a Firestore batch.
+        with self._db.lock:
+            for operation, reference, _, _ in self._operations:
+                if operation == 'create' and reference._key in self._db.data:
+                    raise AlreadyExists(f"Document already exists: {reference._collection}/{reference.id}")
+                if operation == 'update' and reference._key not in self._db.data:
+                    raise NotFound(f"No document to update: {reference._collection}/{reference.id}")
+
+            for operation, reference, data, merge in self._operations:
+                if operation == 'create':
+                    reference.create(data)
+                elif operation == 'update':
+                    reference.update(data)
+                elif operation == 'delete':
+                    reference.delete()
+                else:
+                    reference.set(data, merge=merge)
+
+
+class FakeTransaction(FakeBatch):
+    """Writes of a transaction, applied when the function decorated by transactional() returns."""
+
+
+def transactional(function):
+    """
+    Stand-in of @firestore.transactional: the function runs, and its writes are applied, under the lock of the
+    database, so it never conflicts with another call and is never retried.
+    """
+
+    def run(transaction, *args, **kwargs):
+        with transaction._db.lock:
+            result = function(transaction, *args, **kwargs)
+            transaction.commit()
+
+        return result
+
+    return run
+
+
+class InMemoryFirestore():
+    """Firestore client keeping the documents in a dict, keyed by (collection, document ID)."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def get_all(self, references):
+        for reference in references:
+            yield reference.get()
+
+
+def install() -> InMemoryFirestore:
+    """
+    Make firebase_admin.initialize_app() a no-op, firestore.client() return an InMemoryFirestore, and
+    firestore.transactional run the transactions on it.
+    """
+
+    db = InMemoryFirestore()
+
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: db
+    firestore.transactional = transactional
+
+    return db
@@ -0,0 +1,188 @@
+"""
+Load generator of Google Drive push notifications, to find the saturation point of the webhook service.
+
+Each step sends notifications at a fixed rate (open loop) for a duration, with the X-Goog-* headers sent by
+Google Drive: a 'sync' message when a channel starts, then 'change' messages with increasing message numbers,
+some of them duplicated. Before each notification, images can be added to the fake Drive so that the handler
+has work to do. Each step reports the acknowledgement latency, the status codes and the images processed.
+
+Run from the root of the repository, with local_harness.drive_server and local_harness.serve running:
+    python -m local_harness.load_generator --rates 5,10,20,50,100 --duration 20 --channels 4 --files 1
+"""
+
+import argparse
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+CHANNEL_TOKEN = 'harness-token'
+
+
+class Channel():
+    """Notification channel of one resource, with the message numbers of Google Drive."""
+
+    def __init__(self, index, resource_id):
+        self.id = f"harness-channel-{index}-{uuid.uuid4().hex[:8]}"
+        self.resource_id = resource_id
+        self.numbers = itertools.count(1)
+        self.last = 0
+        self.lock = threading.Lock()
+
+
+    def headers(self, token, duplicate_rate) -> dict:
+        with self.lock:
+            if self.last and random.random() < duplicate_rate:
+                # Google Drive may send a notification again: same message number.
+                number = self.last
+            else:
+                number = self.last = next(self.numbers)
+
+        return {
+            'X-Goog-Channel-ID': self.id,
+            'X-Goog-Channel-Token': token,
+            'X-Goog-Channel-Expiration': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 86400)),
+            'X-Goog-Resource-ID': self.resource_id,
+            'X-Goog-Resource-URI': f"https://www.googleapis.com/drive/v3/changes?alt=json&pageToken={number}",
+            'X-Goog-Resource-State': 'sync' if number == 1 else 'change',
+            'X-Goog-Message-Number': str(number),
+        }
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))] if values else None
+
+
+class LoadGenerator():
+    def __init__(self, url, drive, channels, resources, token, files, image_format, size, duplicate_rate, concurrency):
+        self.url = url
+        self.drive = drive.rstrip('/') if drive else None
+        self.token = token
+        self.files = files
+        self.image_format = image_format
+        self.size = size
+        self.duplicate_rate = duplicate_rate
+
+        self.channels = [Channel(i, f"harness-resource-{i % resources}") for i in range(channels)]
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._local = threading.local()
+
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+
+    def drive_stats(self) -> dict:
+        if not self.drive:
+            return {}
+        return self._session().get(f"{self.drive}/_harness/stats", timeout=10).json()
+
+
+    def notify(self, channel) -> tuple:
+        """Send one notification. Return (status, seconds to the acknowledgement)."""
+
+        session = self._session()
+
+        if self.drive and self.files:
+            session.post(f"{self.drive}/_harness/files", params={'count': self.files, 'format': self.image_format, 'size': self.size}, timeout=30)
+
+        headers = channel.headers(self.token, self.duplicate_rate)
+        start = time.perf_counter()
+
+        try:
+            status = session.post(self.url, headers=headers, timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+
+        return status, time.perf_counter() - start
+
+
+    def step(self, rate, duration, drain=0) -> dict:
+        """Send notifications at rate per second for duration seconds, then wait drain seconds for the handlers."""
+
+        before = self.drive_stats()
+        futures = []
+        start = time.perf_counter()
+        channels = itertools.cycle(self.channels)
+
+        for i in range(int(rate * duration)):
+            # Open loop: the notifications are sent on schedule, whatever the response time.
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self._executor.submit(self.notify, next(channels)))
+
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+        time.sleep(drain)
+        after = self.drive_stats()
+
+        latencies = [seconds for status, seconds in results if status != 'error']
+        statuses = Counter(str(status) for status, _ in results)
+
+        return {
+            'rate': rate,
+            'sent': len(results),
+            'achieved_rate': round(len(results) / elapsed, 2),
+            'ack_p50_ms': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+            'ack_p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+            'ack_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            'statuses': dict(statuses),
+            'images_uploaded': after.get('uploads', 0) - before.get('uploads', 0),
+            'images_added': after.get('changes', 0) - before.get('changes', 0),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--drive', default='http://127.0.0.1:8081', help='Fake Drive server, empty to send notifications only.')
+    parser.add_argument('--rates', default='5,10,20,50', help='Notifications per second of each step, comma separated.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per step.')
+    parser.add_argument('--drain', type=float, default=5, help='Seconds to wait after each step for the handlers to finish, counted in its images uploaded.')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--resources', type=int, default=1, help='Number of distinct X-Goog-Resource-ID over the channels.')
+    parser.add_argument('--files', type=int, default=1, help='Images added to the fake Drive before each notification.')
+    parser.add_argument('--format', default='jpeg')
+    parser.add_argument('--size', default='1280x960')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--token', default=CHANNEL_TOKEN)
+    parser.add_argument('--max-p95-ms', type=float, default=1000, help='Acknowledgement p95 above which the service is saturated.')
+    parser.add_argument('--output', help='Path of the JSON results.')
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.url, args.drive, args.channels, args.resources, args.token, args.files,
+                              args.format, args.size, args.duplicate_rate, args.concurrency)
+    results = []
+    saturation = None
+
+    for rate in (float(param) for param in args.rates.split(',')):
+        result = generator.step(rate, args.duration, args.drain)
+        results.append(result)
+
+        print(f"{rate:7.1f}/s sent {result['sent']:5} at {result['achieved_rate']:7.2f}/s   ack p50 {result['ack_p50_ms']} ms "
+              f"p95 {result['ack_p95_ms']} ms p99 {result['ack_p99_ms']} ms   {result['statuses']}   "
+              f"images {result['images_uploaded']} uploaded / {result['images_added']} added")
+
+        rejected = sum(count for status, count in result['statuses'].items() if status not in ('200', '202'))
+
+        if saturation is None and (rejected > 0.01 * result['sent'] or (result['ack_p95_ms'] or 0) > args.max_p95_ms
+                                   or result['images_uploaded'] < 0.9 * result['images_added']):
+            saturation = rate
+
+    print(f"Saturation from {saturation}/s" if saturation else "No saturation in the rates tested.")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args), 'saturation': saturation, 'steps': results}, f, indent=2)
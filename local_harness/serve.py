@@ -0,0 +1,95 @@
+"""
+Run the webhook service (main.app) against the fake Drive server, without Google credentials.
+
+Firestore is replaced by the in-memory adapter of fake_firestore, unless FIRESTORE_EMULATOR_HOST is set:
+the Firestore client then talks to the emulator (gcloud emulators firestore start).
+The service runs in a temporary working directory, and fetches settings.json and logo.png from the fake Drive.
+
+Run from the root of the repository, with the fake Drive server running:
+    python -m local_harness.serve --port 8080 --drive http://127.0.0.1:8081/drive/v3/
+
+or under gunicorn, as in production (see local_harness/wsgi.py):
+    HARNESS_DRIVE=http://127.0.0.1:8081/drive/v3/ gunicorn --config gunicorn.conf.py local_harness.wsgi:app
+"""
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from local_harness.drive_server import RESULT_FOLDER, SETTINGS_FOLDER, WATCHED_FOLDER
+
+CHANNEL_TOKEN = 'harness-token'
+
+
+def setup(drive, workdir=None, log_level='WARNING'):
+    """
+    Prepare the environment of the service and import main, without starting its background work.
+    Return the main module and the working directory.
+    """
+
+    workdir = workdir or tempfile.mkdtemp(prefix='watermark-harness-')
+    os.makedirs(os.path.join(workdir, 'files', 'downloaded_files'), exist_ok=True)
+    os.chdir(workdir)
+
+    # Read when the functions modules are imported.
+    os.environ['DRIVE_API_ENDPOINT'] = drive
+    os.environ.setdefault('CHANNEL_TOKEN', CHANNEL_TOKEN)
+    os.environ.setdefault('FILE_ID', WATCHED_FOLDER)
+    os.environ.setdefault('RESULT_FILE_ID', RESULT_FOLDER)
+    os.environ.setdefault('SETTING_FILE_ID', SETTINGS_FOLDER)
+    os.environ.setdefault('LOGO_PATH', os.path.join(workdir, 'files', 'logo', 'logo.png'))
+    os.environ['FILE_SAVE_PATH'] = os.path.join(workdir, 'files', 'downloaded_files') + '/'
+
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        from local_harness import fake_firestore
+        fake_firestore.install()
+
+    from google.auth.credentials import AnonymousCredentials
+    import main
+    from functions.webhook import drive_service_factory
+
+    # The fake Drive needs no authorization.
+    credentials = AnonymousCredentials()
+    drive_service_factory.get_credentials = lambda: credentials
+
+    # main configures the root logger at DEBUG, far too verbose under load.
+    logging.getLogger().setLevel(log_level)
+
+    return main, workdir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--drive', default='http://127.0.0.1:8081/drive/v3/', help='DRIVE_API_ENDPOINT of the fake Drive server.')
+    parser.add_argument('--workdir', help='Working directory of the service. The default is a temporary directory.')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    main, workdir = setup(args.drive, args.workdir, args.log_level)
+
+    from werkzeug.serving import make_server
+
+    main.startup()
+    server = make_server(args.host, args.port, main.app, threaded=True)
+    print(f"Webhook service on http://{args.host}:{args.port}/webhook (workdir {workdir}, CHANNEL_TOKEN={os.environ['CHANNEL_TOKEN']})", flush=True)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # SIGTERM, as sent by Cloud Run, drains the service like Ctrl+C.
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        main.shutdown()
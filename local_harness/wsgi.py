@@ -0,0 +1,18 @@
+"""
+WSGI entry point of the harness, to run the webhook service under gunicorn with its production configuration
+(preload, startup() after the fork, drain on SIGTERM), against the fake Drive server:
+    HARNESS_DRIVE=http://127.0.0.1:8081/drive/v3/ gunicorn --config gunicorn.conf.py local_harness.wsgi:app
+
+HARNESS_WORKDIR and HARNESS_LOG_LEVEL set the working directory and the log level, as --workdir and --log-level of serve.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_harness.serve import setup
+
+main, workdir = setup(os.getenv('HARNESS_DRIVE', 'http://127.0.0.1:8081/drive/v3/'), os.getenv('HARNESS_WORKDIR'), os.getenv('HARNESS_LOG_LEVEL', 'WARNING'))
+
+app = main.app
@@ -1,21 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import os
 import sys
+import time
 import logging
 from dotenv import load_dotenv
-import threading
+
+# Before the functions modules are imported: they read their configuration from the environment.
+load_dotenv()
+
 import firebase_admin
 from firebase_admin import firestore
 from functions.gdrive_file_handler import gdrive_file_handler
-from functions.webhook_check import sync_check
+from functions.webhook_check import sync_check, get_tracker, stop_trackers
+from functions.history import history, parse_time
+from functions.job_scheduler import JobScheduler
+from functions.metrics import CONTENT_TYPE, register_scheduler, registry, webhook_ack_seconds, webhook_requests
+from functions.watermark_engine import shutdown_watermark_engine
+from functions.webhook import drive_service_factory
 from webhook_subscribe import webhook_subscribe
 from webhook_unsubscribe import webhook_unsubscribe
 
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+
 root = logging.getLogger()
-root.setLevel(logging.DEBUG)
+root.setLevel(LOG_LEVEL)
 handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
+handler.setLevel(LOG_LEVEL)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 root.addHandler(handler)
@@ -24,6 +35,12 @@ app = Flask(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/drive.readonly']
 
+# Folder of the images downloaded when PIPELINE_MODE is 'disk', or larger than PIPELINE_SPILL_SIZE.
+FILE_SAVE_PATH = os.getenv('FILE_SAVE_PATH', os.getcwd() + '/files/downloaded_files/')
+
+# Seconds given to the jobs in progress to finish when the process is stopped. Cloud Run kills it 10 s after SIGTERM.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 8))
+
 drive_service_receiver = None
 
 try:
@@ -33,6 +50,56 @@ except ValueError:
 
 db = firestore.client()
 
+scheduler = JobScheduler(gdrive_file_handler)
+register_scheduler(scheduler)
+
+
+def startup():
+    """
+    Start the background work of a serving process. Not done at import: the module is imported by the
+    gunicorn master before it forks the workers (preload), and threads or gRPC channels do not survive a fork.
+    """
+
+    # Load the last message number of each channel now, so that the webhook never waits for Firestore.
+    get_tracker('request_message', 'last_number')
+    scheduler.start()
+
+
+def shutdown(timeout=DRAIN_TIMEOUT):
+    """
+    Drain the process before it exits: the running jobs finish within timeout seconds, the jobs waiting are dropped
+    (their changes are read again by the next notification), the message numbers are flushed to Firestore
+    and the watermark processes are stopped.
+    """
+
+    logging.info(f"Draining the jobs in progress ({scheduler.stats()['workers_busy']} running), for at most {timeout} s.")
+
+    drained = scheduler.shutdown(timeout, cancel_pending=True)
+
+    if not drained:
+        logging.error(f"Jobs still running after {timeout} s, stopped with the process: their pages are not committed, and their files are "
+                      f"handled again by the first run after their claims expire (LEDGER_LEASE_SECONDS).")
+
+    stop_trackers()
+    shutdown_watermark_engine(wait=drained)
+
+    logging.info("Process drained.")
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_ack(response):
+    # Time to acknowledge a notification, as seen by Google Drive (without the network).
+    if request.endpoint == 'webhook':
+        webhook_ack_seconds.observe(time.perf_counter() - g.start)
+        webhook_requests.inc(status=response.status_code)
+
+    return response
+
 
 @app.route('/', methods=['GET'])
 def landing_page():
@@ -51,13 +118,14 @@ def landing_page():
         Subscribing to the webhook with the token.
         """
     else:
-        log_times = db.collection("log_time").stream()
-
-        log_times_list = [log.to_dict() for log in log_times]
+        # The last runs and the daily rollups: the cost is one page, whatever the size of the history.
+        runs = history.page()['runs']
 
         name = f"""
         Logs time of files processed:
-        {log_times_list}
+        {runs}
+        Processing time per day:
+        {history.daily()}
         """
 
     return name, 200
@@ -92,26 +160,69 @@ def webhook():
         logging.info(f"Webhook sync acknowledged for resource {resource_id}.")
         return jsonify({"status": "sync_acknowledged"}), 200
 
-    thread_args = (resource_id, resource_state, FILE_SAVE_PATH, message_number)
-    thread = threading.Thread(target=gdrive_file_handler, args=thread_args)
-    thread.start() # Start the thread
+    # Jobs for the same resource are merged during their quiet period (JOB_QUIET_PERIOD, at most JOB_MAX_DELAY),
+    # and never run concurrently: a burst of notifications is handled by one run, plus one follow-up if it was running.
+    if not scheduler.submit(resource_id, resource_state, FILE_SAVE_PATH, message_number):
+        response_data = {"error": "Too many jobs in progress, retry later"}
+        status_code = 503 # 503 Service Unavailable so that Google Drive retries the notification later.
+        return jsonify(response_data), status_code
 
-    logging.info(f"Webhook request {resource_id} accepted, handling it in a thread.")
+    logging.info(f"Webhook request {resource_id} accepted, handling it in the job queue.")
     return jsonify(response_data), status_code # Send back a response immediately to acknowledge the webhook request.
 
 
-if __name__ == '__main__':
-    load_dotenv()
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify({"jobs": scheduler.stats(), "drive_service": drive_service_factory.hit_rates()}), 200
+
+
+@app.route('/history', methods=['GET'])
+def processing_history():
+    """Runs ordered by end time: ?limit=20&cursor=<next_cursor>&start=2025-01-01&end=2025-02-01&order=desc"""
+
+    order = request.args.get('order', 'desc')
 
     try:
-        firebase_admin.initialize_app()
-    except ValueError:
-        None
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"order must be 'asc' or 'desc', got '{order}'")
+
+        page = history.page(
+            limit=request.args.get('limit', type=int),
+            cursor=request.args.get('cursor'),
+            start=parse_time(request.args.get('start')),
+            end=parse_time(request.args.get('end')),
+            descending=order == 'desc',
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(page), 200
 
-    FILE_SAVE_PATH = os.getcwd() + '/files/downloaded_files/' 
 
-    USER_TO_IMPERSONATE = None
-    drive_service_receiver = None
+@app.route('/history/daily', methods=['GET'])
+def processing_history_daily():
+    """Runs, files uploaded and mean, p50 and p95 processing time per day: ?start=2025-01-01&end=2025-01-31"""
 
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    try:
+        rollups = history.daily(start=parse_time(request.args.get('start')), end=parse_time(request.args.get('end')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"days": rollups}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Rendered from the in-memory counters of the process: no Firestore or Drive call.
+    return registry.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+
+if __name__ == '__main__':
+    # Development server only: production runs under gunicorn (gunicorn.conf.py).
+    startup()
+
+    try:
+        app.run(host="0.0.0.0", port=int(os.getenv('PORT', 8080)), debug=os.getenv('FLASK_DEBUG') == '1', use_reloader=False)
+    finally:
+        shutdown()
 
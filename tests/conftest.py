@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_harness import fake_firestore
+
+# Before any functions module is imported: they create their Firestore client at import.
+_db = fake_firestore.install()
+
+
+@pytest.fixture
+def db():
+    """In-memory Firestore of the functions modules, emptied for each test."""
+
+    with _db.lock:
+        _db.data.clear()
+
+    return _db
@@ -0,0 +1,141 @@
+import threading
+import time
+import pytest
+from functions import change_feed
+from functions.change_feed import ChangeFeed
+
+# changes().list() results by page token: three pages, then the end of the feed.
+RESULTS = {
+    't0': {'nextPageToken': 't1', 'changes': [{'fileId': 'a'}]},
+    't1': {'nextPageToken': 't2', 'changes': [{'fileId': 'b'}]},
+    't2': {'newStartPageToken': 't3', 'changes': [{'fileId': 'c'}]},
+}
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    tokens = []
+    monkeypatch.setattr(change_feed, 'save_startpagetoken', lambda resource_id, token: tokens.append(token))
+    return tokens
+
+
+def read_feed(monkeypatch, jobs_per_page=1) -> tuple:
+    """Read every page of the feed, taking jobs_per_page jobs from each. Return the feed and its pages."""
+
+    feed = ChangeFeed('resource', 't0')
+    monkeypatch.setattr(feed, '_fetch', lambda token: RESULTS[token])
+    pages = []
+
+    for page in feed.pages():
+        for _ in range(jobs_per_page):
+            feed.add_job(page)
+        pages.append(page)
+
+    return feed, pages
+
+
+def test_pages_committed_in_order_when_jobs_finish_out_of_order(monkeypatch, saved):
+    feed, pages = read_feed(monkeypatch)
+
+    assert [page.token for page in pages] == ['t0', 't1', 't2']
+    assert saved == []
+
+    feed.job_done(pages[2])
+    assert saved == []
+
+    feed.job_done(pages[0])
+    assert saved == ['t1']
+
+    # Pages 1 and 2 are done: only the token after the last one is saved.
+    feed.job_done(pages[1])
+    assert saved == ['t1', 't3']
+
+
+def test_page_committed_only_when_all_its_jobs_are_done(monkeypatch, saved):
+    feed, pages = read_feed(monkeypatch, jobs_per_page=2)
+
+    feed.job_done(pages[0])
+    assert saved == []
+
+    feed.job_done(pages[0])
+    assert saved == ['t1']
+
+
+def test_pages_without_jobs_committed_when_sealed(monkeypatch, saved):
+    read_feed(monkeypatch, jobs_per_page=0)
+
+    assert saved[-1] == 't3'
+
+
+def test_failed_job_keeps_the_token_before_its_page(monkeypatch, saved):
+    feed, pages = read_feed(monkeypatch)
+
+    feed.job_done(pages[0])
+    feed.job_done(pages[1], ok=False)
+    feed.job_done(pages[2])
+
+    # The next run reads the feed again from the page of the failed job.
+    assert saved == ['t1']
+    assert not pages[1].committed and not pages[2].committed
+
+
+def test_tokens_saved_in_order_when_jobs_end_together(monkeypatch):
+    feed, pages = read_feed(monkeypatch)
+    tokens = []
+
+    def slow_save(resource_id, token):
+        # The save of the first token is slow: the job of page 1 ends meanwhile.
+        if token == 't1':
+            time.sleep(0.2)
+        tokens.append(token)
+
+    monkeypatch.setattr(change_feed, 'save_startpagetoken', slow_save)
+
+    first = threading.Thread(target=feed.job_done, args=(pages[0],))
+    first.start()
+    time.sleep(0.05)
+    feed.job_done(pages[1])
+    first.join()
+
+    assert tokens == ['t1', 't2']
+
+
+class Ledger():
+    """Records the states written by the feed, in the list of events shared with the token saves."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def finish(self, done, failed):
+        self.events.append(('ledger', sorted(done), sorted(failed)))
+
+
+def test_states_of_a_page_written_before_its_token(monkeypatch):
+    events = []
+    monkeypatch.setattr(change_feed, 'save_startpagetoken', lambda resource_id, token: events.append(('token', token)))
+
+    feed = ChangeFeed('resource', 't0', ledger=Ledger(events))
+    monkeypatch.setattr(feed, '_fetch', lambda token: RESULTS[token])
+    pages = []
+
+    for page in feed.pages():
+        feed.add_job(page)
+        feed.add_job(page)
+        pages.append(page)
+
+    feed.job_done(pages[0], file_id='a1')
+    feed.job_done(pages[1], ok=False, file_id='b1')
+    assert events == []
+
+    # Page 0 done: its two states in one write, then its token.
+    feed.job_done(pages[0], file_id='a2')
+    assert events == [('ledger', ['a1', 'a2'], []), ('token', 't1')]
+
+    # Page 1 done with a failure: its states are written, its token is not.
+    feed.job_done(pages[1], file_id='b2')
+    assert events[2:] == [('ledger', ['b2'], ['b1'])]
+
+    # The run stops with page 2 unfinished: the state of its job done is written by flush().
+    feed.job_done(pages[2], file_id='c1')
+    feed.flush()
+    assert events[3:] == [('ledger', ['c1'], [])]
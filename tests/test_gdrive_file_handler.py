@@ -0,0 +1,128 @@
+import hashlib
+import io
+import json
+import os
+import pytest
+from PIL import Image
+from local_harness.fake_drive import FakeDrive, FakeDriveHttp
+from functions import gdrive_file_handler as handler
+from functions.drive_discovery import LazyDriveService
+from functions.idempotency import IdempotencyLedger
+from functions.settings import SettingsStore
+from functions.settings_assets import SettingsAssetResolver
+from functions.watermark_engine import shutdown_watermark_engine
+from functions.webhook import drive_service_factory
+
+RESOURCE_ID = 'resource'
+SETTINGS = {'colors': '(255, 255, 255)', 'opacity': 50}
+
+
+def jpeg(color) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (160, 120), color).save(output, 'JPEG')
+    return output.getvalue()
+
+
+@pytest.fixture
+def drive(db, tmp_path, monkeypatch):
+    """Fake Drive and working directory of a handler run: settings and logo present locally, token at the start of the feed."""
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('files/settings')
+    os.makedirs('files/logo')
+
+    with open('files/settings/settings.json', 'w') as f:
+        json.dump(SETTINGS, f)
+
+    Image.new('RGBA', (40, 20), (0, 0, 0, 255)).save('files/logo/logo.png')
+
+    for name, value in {'FILE_ID': 'watched-folder', 'RESULT_FILE_ID': 'result-folder', 'SETTING_FILE_ID': 'settings-folder',
+                        'LOGO_PATH': str(tmp_path / 'files/logo/logo.png')}.items():
+        monkeypatch.setenv(name, value)
+
+    # The paths of the settings modules are taken from the working directory at import.
+    asset_paths = {'settings.json': str(tmp_path / 'files/settings/settings.json'), 'logo.png': str(tmp_path / 'files/logo/logo.png')}
+    monkeypatch.setattr(handler, 'settings_assets', SettingsAssetResolver(handler.download_file, 'settings-folder', str(tmp_path / 'files/settings/.asset_index.json'), asset_paths))
+    monkeypatch.setattr(handler, 'settings_store', SettingsStore(asset_paths['settings.json'], check_interval=0))
+
+    # The file IDs of the fake Drive start again at file1: the IDs known by the ledger of an earlier test are dropped.
+    monkeypatch.setattr(handler, 'ledger', IdempotencyLedger())
+
+    drive = FakeDrive()
+    credentials = object()
+
+    # New credentials: the services cached by the factory for an earlier fake Drive are dropped.
+    monkeypatch.setattr(drive_service_factory, 'get_credentials', lambda: credentials)
+    monkeypatch.setattr(drive_service_factory, 'build', lambda creds: LazyDriveService(FakeDriveHttp(drive)))
+
+    db.collection('webhook_tokens').document(RESOURCE_ID).set({'token': '0'})
+
+    yield drive
+
+    shutdown_watermark_engine()
+
+
+def run_handler(tmp_path, message_number='1'):
+    save_path = str(tmp_path / 'files/downloaded_files') + '/'
+    handler.gdrive_file_handler(RESOURCE_ID, 'change', save_path, message_number)
+    return save_path
+
+
+def test_images_of_the_same_name_do_not_share_their_files(drive, tmp_path, monkeypatch):
+    monkeypatch.setattr(handler, 'PIPELINE_MODE', 'disk')
+
+    for i in range(6):
+        drive.add_file('IMG_0001.jpg', jpeg((40 * i, 0, 0)), ['watched-folder'], 'image/jpeg')
+
+    save_path = run_handler(tmp_path)
+
+    uploads = [drive.files[file_id] for file_id in drive.uploads]
+    assert [file['name'] for file in uploads] == ['IMG_0001_mrkd.jpg'] * 6
+
+    # Six outputs of six different sources, and nothing left behind.
+    assert len({file['md5Checksum'] for file in uploads}) == 6
+    assert os.listdir(save_path) == []
+
+
+def update_file(drive, file_id, content):
+    """Edit the content of a file of the fake Drive, with a change in the change feed."""
+
+    drive.files[file_id].update(content=content, size=str(len(content)), md5Checksum=hashlib.md5(content).hexdigest())
+    drive.changes.append(file_id)
+
+
+def test_settings_json_change_reloads_the_settings(drive, tmp_path):
+    settings_id = drive.add_file('settings.json', json.dumps(SETTINGS).encode('utf-8'), ['settings-folder'], 'application/json', record_change=False)
+    run_handler(tmp_path)
+    old_version = handler.settings_store.get().version
+
+    update_file(drive, settings_id, json.dumps(dict(SETTINGS, opacity=20)).encode('utf-8'))
+    drive.add_file('photo.jpg', jpeg((0, 0, 255)), ['watched-folder'], 'image/jpeg')
+    run_handler(tmp_path, '2')
+
+    # Downloaded through the change feed, and used for the image of the same page.
+    assert handler.settings_store.get().opacity == 20
+    assert handler.settings_store.get().version != old_version
+    assert len(drive.uploads) == 1
+
+
+def test_settings_assets_downloaded_only_when_their_checksum_changes(drive, tmp_path, monkeypatch):
+    downloads = []
+    download = handler.settings_assets.download
+    monkeypatch.setattr(handler.settings_assets, 'download', lambda drive_service, file_id, **kwargs: downloads.append(file_id) or download(drive_service, file_id, **kwargs))
+
+    settings_id = drive.add_file('settings.json', json.dumps(SETTINGS).encode('utf-8'), ['settings-folder'], 'application/json')
+    drive.add_file('notes.txt', b'not a settings asset', ['settings-folder'], 'text/plain')
+    run_handler(tmp_path)
+    assert downloads == [settings_id]
+
+    # Same content: not downloaded again.
+    update_file(drive, settings_id, json.dumps(SETTINGS).encode('utf-8'))
+    run_handler(tmp_path, '2')
+    assert downloads == [settings_id]
+
+    # Edited after the local copy exists: downloaded again.
+    update_file(drive, settings_id, json.dumps(dict(SETTINGS, colors='(0, 0, 0)')).encode('utf-8'))
+    run_handler(tmp_path, '3')
+    assert downloads == [settings_id, settings_id]
+    assert handler.settings_store.get().colors == (0, 0, 0)
@@ -0,0 +1,29 @@
+from functions.history import HistoryStore, ROLLUP_COLLECTION
+
+
+def test_percentiles_of_runs_longer_than_two_minutes(db):
+    history = HistoryStore(cache_ttl=0)
+
+    for i, seconds in enumerate((40, 400, 500, 700, 1500)):
+        history.record_run(str(i), {'Number of files uploaded': 10}, seconds)
+
+    [rollup] = history.daily()
+
+    assert rollup['runs'] == 5
+    assert rollup['files_uploaded'] == 50
+    assert 300 < rollup['p50_seconds'] <= 600
+    assert 1200 < rollup['p95_seconds'] <= 1800
+
+
+def test_days_recorded_on_the_tracing_buckets(db):
+    history = HistoryStore(cache_ttl=0)
+    history.record_run('0', {}, 3)
+
+    # A run of 3 s and one above 120 s recorded on the 16 buckets of the tracing, before RUN_BUCKETS.
+    [snapshot] = db.collection(ROLLUP_COLLECTION).stream()
+    snapshot.reference.set({'runs': 3, 'processing_seconds': 3 + 3 + 200, 'buckets': {'11': 1, '16': 1}}, merge=True)
+
+    [rollup] = history.daily()
+
+    assert rollup['runs'] == 3
+    assert 120 < rollup['p95_seconds'] <= 300
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+from functions.idempotency import IdempotencyLedger
+
+
+def jobs(*file_ids) -> list:
+    return [{'file_id': file_id, 'name': f"{file_id}.jpg"} for file_id in file_ids]
+
+
+def claim_document(db, file_id) -> dict:
+    return db.collection('file_ledger').document(file_id).get().to_dict()
+
+
+def test_new_files_claimed_in_one_batch(db):
+    ledger = IdempotencyLedger()
+
+    assert ledger.claim(jobs('a', 'b')) == ({'a', 'b'}, set())
+    assert claim_document(db, 'a')['state'] == 'claimed'
+
+    # Known by this process: rejected without reading Firestore.
+    assert ledger.claim(jobs('a', 'b')) == (set(), set())
+    assert ledger.local_hits == 2
+
+
+def test_batch_conflict_falls_back_to_per_file_creates(db, monkeypatch):
+    ledger = IdempotencyLedger()
+    get_all = db.get_all
+
+    def get_all_then_claim_b(references):
+        snapshots = list(get_all(references))
+        # Another run claims b between the read and the batch.
+        db.collection('file_ledger').document('b').create({'state': 'claimed', 'claimed_at': datetime.now(timezone.utc), 'attempts': 1})
+        return snapshots
+
+    monkeypatch.setattr(db, 'get_all', get_all_then_claim_b)
+
+    claimed, held = ledger.claim(jobs('a', 'b', 'c'))
+
+    assert claimed == {'a', 'c'}
+    assert held == {'b'}
+    assert claim_document(db, 'a')['state'] == claim_document(db, 'c')['state'] == 'claimed'
+
+
+def test_claim_in_its_lease_is_held_and_not_remembered(db):
+    IdempotencyLedger().claim(jobs('a'))
+    ledger = IdempotencyLedger()
+
+    assert ledger.claim(jobs('a')) == (set(), {'a'})
+    assert not ledger.is_known('a')
+
+
+def test_expired_claim_taken_over(db):
+    IdempotencyLedger().claim(jobs('a'))
+    db.collection('file_ledger').document('a').update({'claimed_at': datetime.now(timezone.utc) - timedelta(hours=1)})
+
+    ledger = IdempotencyLedger(lease=60)
+
+    assert ledger.claim(jobs('a')) == ({'a'}, set())
+    assert claim_document(db, 'a')['attempts'] == 2
+    assert ledger.takeovers == 1
+
+
+def test_done_claim_never_claimed_again(db):
+    ledger = IdempotencyLedger()
+    ledger.claim(jobs('a'))
+    ledger.finish(['a'], [])
+
+    assert claim_document(db, 'a')['state'] == 'done'
+    assert IdempotencyLedger().claim(jobs('a')) == (set(), set())
+
+
+def test_released_claim_retried_until_max_attempts(db):
+    for attempt in range(1, 4):
+        ledger = IdempotencyLedger(max_attempts=3)
+
+        assert ledger.claim(jobs('a')) == ({'a'}, set())
+        assert claim_document(db, 'a')['attempts'] == attempt
+
+        ledger.finish([], ['a'])
+        assert claim_document(db, 'a')['state'] == 'failed'
+        assert not ledger.is_known('a')
+
+    # Given up: neither claimed nor held, so the page of the change can be committed.
+    ledger = IdempotencyLedger(max_attempts=3)
+    assert ledger.claim(jobs('a')) == (set(), set())
+    assert ledger.is_known('a')
+
+
+def test_states_of_a_page_written_in_one_batch(db, monkeypatch):
+    ledger = IdempotencyLedger()
+    ledger.claim(jobs('a', 'b', 'c'))
+
+    commits = []
+    batch = db.batch
+
+    def counted_batch():
+        writes = batch()
+        commit = writes.commit
+        writes.commit = lambda: commits.append(len(writes._operations)) or commit()
+        return writes
+
+    monkeypatch.setattr(db, 'batch', counted_batch)
+
+    ledger.finish(['a', 'b'], ['c'])
+
+    assert commits == [3]
+    assert [claim_document(db, file_id)['state'] for file_id in 'abc'] == ['done', 'done', 'failed']
+    assert ledger.is_known('a') and not ledger.is_known('c')
+
+
+def test_states_written_one_by_one_when_a_claim_is_missing(db):
+    ledger = IdempotencyLedger()
+    ledger.claim(jobs('a', 'b'))
+    db.collection('file_ledger').document('a').delete()
+
+    ledger.finish(['a', 'b'], [])
+
+    assert claim_document(db, 'b')['state'] == 'done'
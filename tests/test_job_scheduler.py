@@ -0,0 +1,130 @@
+import threading
+import time
+import pytest
+from functions.job_scheduler import JobScheduler
+
+
+class Recorder():
+    def __init__(self, block=False):
+        """Target of the scheduler recording its runs, and the most runs of a key at the same time. With block, each run waits for release."""
+
+        self.runs = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.block = block
+
+        self._running = {}
+        self._lock = threading.Lock()
+        self.max_concurrent = 0
+
+
+    def __call__(self, key, number):
+        with self._lock:
+            self.runs.append((key, number))
+            self._running[key] = self._running.get(key, 0) + 1
+            self.max_concurrent = max(self.max_concurrent, self._running[key])
+
+        self.started.set()
+
+        if self.block:
+            assert self.release.wait(5)
+
+        with self._lock:
+            self._running[key] -= 1
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+def test_burst_merged_into_one_run(recorder):
+    scheduler = JobScheduler(recorder, max_workers=4, quiet_period=0.2, max_delay=5)
+
+    for number in range(5):
+        assert scheduler.submit('resource', number)
+
+    assert recorder.started.wait(2)
+    assert scheduler.shutdown(2)
+
+    # One run, with the arguments of the last notification.
+    assert recorder.runs == [('resource', 4)]
+    assert scheduler.stats()['merged'] == 4
+
+
+def test_jobs_submitted_while_running_merged_into_one_follow_up():
+    recorder = Recorder(block=True)
+    scheduler = JobScheduler(recorder, max_workers=4, quiet_period=0.05, max_delay=1)
+
+    scheduler.submit('resource', 0)
+    assert recorder.started.wait(2)
+
+    for number in range(1, 10):
+        scheduler.submit('resource', number)
+
+    # Past the quiet period of the follow-up: it still waits for the run of its key, on an idle worker.
+    time.sleep(0.2)
+    assert recorder.runs == [('resource', 0)]
+
+    recorder.release.set()
+    assert scheduler.shutdown(2)
+
+    assert recorder.runs == [('resource', 0), ('resource', 9)]
+    assert recorder.max_concurrent == 1
+
+
+def test_keys_run_independently():
+    recorder = Recorder(block=True)
+    scheduler = JobScheduler(recorder, max_workers=4, quiet_period=0.05, max_delay=1)
+
+    scheduler.submit('a', 1)
+    scheduler.submit('b', 2)
+
+    deadline = time.monotonic() + 2
+    while len(recorder.runs) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Both run at the same time, on two workers.
+    assert sorted(recorder.runs) == [('a', 1), ('b', 2)]
+
+    recorder.release.set()
+    assert scheduler.shutdown(2)
+
+
+def test_max_delay_bounds_a_continuous_burst(recorder):
+    scheduler = JobScheduler(recorder, max_workers=1, quiet_period=0.5, max_delay=0.3)
+    start = time.monotonic()
+
+    # Notifications every 50 ms for 1 s: the quiet period never ends.
+    number = 0
+    while time.monotonic() - start < 1:
+        scheduler.submit('resource', number)
+        number += 1
+        time.sleep(0.05)
+
+        if recorder.runs:
+            break
+
+    assert recorder.runs
+    assert time.monotonic() - start < 0.9
+    scheduler.shutdown(2)
+
+
+def test_shutdown_runs_the_jobs_waiting(recorder):
+    scheduler = JobScheduler(recorder, max_workers=2, quiet_period=10, max_delay=10)
+    scheduler.submit('resource', 1)
+
+    # Run at once, without their quiet period.
+    assert scheduler.shutdown(2)
+    assert recorder.runs == [('resource', 1)]
+
+    # New jobs are refused once stopping.
+    assert scheduler.submit('resource', 2) is False
+
+
+def test_shutdown_drops_the_jobs_waiting_when_cancelled(recorder):
+    scheduler = JobScheduler(recorder, max_workers=2, quiet_period=10, max_delay=10)
+    scheduler.submit('resource', 1)
+
+    assert scheduler.shutdown(2, cancel_pending=True)
+    assert recorder.runs == []
@@ -0,0 +1,73 @@
+import io
+import threading
+import pytest
+from PIL import Image
+from functions import large_image
+from functions.encoder import EncoderSettings
+from functions.large_image import BOUNDED, FULL, LARGE, ImageTooLarge, large_image_slot, open_image, route
+from functions.watermark import Watermark
+
+
+@pytest.fixture(autouse=True)
+def budgets(monkeypatch):
+    """Budgets of a few thousand pixels, so that the tests work on small images."""
+
+    monkeypatch.setattr(large_image, 'PIXEL_BUDGET', 10_000)
+    monkeypatch.setattr(large_image, 'MAX_DECODE_PIXELS', 40_000)
+
+
+def encoded(size, image_format, **params) -> io.BytesIO:
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(buffer, image_format, **params)
+    buffer.seek(0)
+    return buffer
+
+
+def decode(buffer) -> Image.Image:
+    wtmrk = Watermark('photo', 'logo.png', encoder=EncoderSettings())
+    return wtmrk.img_fit(open_image(buffer), buffer)
+
+
+def test_routes_by_pixels():
+    assert route(Image.new('L', (100, 100))) == FULL
+    assert route(Image.new('L', (101, 100))) == LARGE
+    assert route(Image.new('L', (200, 200))) == LARGE
+    assert route(Image.new('L', (201, 200))) == BOUNDED
+
+
+def test_slot_held_above_the_budget_only(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(large_image, '_slots', slots)
+
+    with large_image_slot(Image.new('L', (100, 100))):
+        assert slots.acquire(blocking=False)
+        slots.release()
+
+    for size in ((150, 150), (300, 300)):
+        with large_image_slot(Image.new('L', size)):
+            assert not slots.acquire(blocking=False)
+
+
+@pytest.mark.parametrize('image_format', ['JPEG', 'PNG'])
+def test_large_images_keep_their_resolution(image_format):
+    assert decode(encoded((180, 180), image_format)).size == (180, 180)
+
+
+def test_bounded_jpeg_downscaled_to_the_budget(caplog):
+    image = decode(encoded((400, 300), 'JPEG'))
+
+    assert image.width * image.height <= 10_000
+    assert 'its resolution is reduced' in caplog.text
+
+
+def test_bounded_strips_downscaled_to_the_budget():
+    # Strips of 16 rows: decoded band by band.
+    image = decode(encoded((400, 300), 'TIFF', tiffinfo={278: 16}))
+
+    assert image.width * image.height <= 10_000
+    assert image.getpixel((10, 10)) == (200, 100, 50)
+
+
+def test_bounded_image_decoded_whole_refused():
+    with pytest.raises(ImageTooLarge):
+        decode(encoded((400, 300), 'PNG'))
@@ -0,0 +1,65 @@
+import io
+import tempfile
+import pytest
+from multiprocessing import shared_memory
+from PIL import Image
+from functions.watermark_engine import SharedBuffer, WatermarkEngine
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory):
+    path_logo = str(tmp_path_factory.mktemp('logo') / 'logo.png')
+    Image.new('RGBA', (40, 20), (255, 0, 0, 255)).save(path_logo)
+
+    engine = WatermarkEngine(path_logo, max_workers=1)
+    yield engine
+    engine.shutdown()
+
+
+def spooled_jpeg(size=(320, 240)) -> tuple:
+    """JPEG in a spooled temporary file, as download_file() gives it. Return the file and its size."""
+
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    Image.new('RGB', size, (0, 0, 255)).save(file, 'JPEG')
+    size = file.tell()
+    file.seek(0)
+    return file, size
+
+
+def test_file_read_into_shared_memory_and_result_in_shared_memory(engine):
+    file, size = spooled_jpeg()
+
+    with file:
+        output, output_format, _ = engine.submit(file, name='photo.jpg', size=size).result(timeout=60)
+
+    assert isinstance(output, SharedBuffer)
+    name = output.shm.name
+
+    with output:
+        assert Image.open(output).size == (320, 240)
+
+    # The block of the result is unlinked once the result is closed.
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_truncated_file_refused(engine):
+    file, size = spooled_jpeg()
+
+    with file, pytest.raises(ValueError):
+        engine.submit(file, name='photo.jpg', size=size + 10)
+
+
+def test_shared_buffer_reads_in_place():
+    shm = shared_memory.SharedMemory(create=True, size=16)
+    shm.buf[:10] = b'0123456789'
+
+    with SharedBuffer(shm, 10, unlink=True) as buffer:
+        assert buffer.read(4) == b'0123'
+        assert buffer.seek(-2, io.SEEK_END) == 8
+        assert buffer.read() == b'89'
+
+        target = bytearray(5)
+        buffer.seek(3)
+        assert buffer.readinto(target) == 5
+        assert target == b'34567'
@@ -0,0 +1,51 @@
+import pytest
+from functions.webhook_check import MessageNumberTracker
+
+
+@pytest.fixture
+def tracker(db):
+    # Flushed by the tests only.
+    tracker = MessageNumberTracker('request_message', 'last_number', flush_interval=3600)
+    yield tracker
+    tracker.stop()
+
+
+def stored(db, channel) -> int:
+    return db.collection('request_message').document(channel).get().to_dict()['last_number']
+
+
+def test_check_rejects_older_message_numbers(tracker):
+    assert tracker.check('channel', 5) is False
+    assert tracker.check('channel', 4) is True
+    assert tracker.check('channel', 6) is False
+
+    # Channels are independent.
+    assert tracker.check('other', 1) is False
+
+
+def test_marks_rehydrated_from_firestore(db):
+    db.collection('request_message').document('channel').set({'last_number': 9})
+    tracker = MessageNumberTracker('request_message', 'last_number', flush_interval=3600)
+
+    try:
+        assert tracker.check('channel', 8) is True
+        assert tracker.check('channel', 10) is False
+    finally:
+        tracker.stop()
+
+
+def test_flush_never_lowers_a_higher_stored_number(db, tracker):
+    tracker.check('channel', 7)
+
+    # Another process stored a higher number since this one started.
+    db.collection('request_message').document('channel').set({'last_number': 10})
+    tracker.flush()
+
+    assert stored(db, 'channel') == 10
+    # The higher number is now the local mark.
+    assert tracker.check('channel', 8) is True
+
+    tracker.check('channel', 11)
+    tracker.flush()
+
+    assert stored(db, 'channel') == 11